@@ -1,12 +1,19 @@
 import glob
+import queue
+import re
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-import Bio.PDB as bp
 from pathlib import Path
 from scipy import spatial
 from pandda_gemmi.pandda_types import *
+from fragalysis_api.xcimporter import map_io
+from fragalysis_api.xcimporter.align_cache import AlignmentCache, file_sha1
+from fragalysis_api.xcimporter.map_resample import BoxXmap, CrystalMap, MappedMap, ReferenceGeometryCache, \
+    SparseXmap, mapped_chunk_size, model_box, multiply_positions, protein_positions, referenceSave, resample_many, \
+    resample_mapped, resample_point_bytes, stats_point_bytes, write_point_bytes
 import dataclasses
-import pandas as pd
 import os
 import warnings
 import Bio.PDB.PDBExceptions as bpp
@@ -20,7 +27,8 @@ warnings.simplefilter('ignore', bpp.PDBConstructionWarning)
 
 class Align:
 
-    def __init__(self, directory, pdb_ref='', rrf=False, refset=True):
+    def __init__(self, directory, pdb_ref='', rrf=False, refset=True, stats_cache=None, ref_jobs=1, box_margin=None,
+                 memory_budget=None, chain_jobs=1, identity_tolerance=1e-4, asymmetric_unit=False):
         '''
         :param directory: Directory path contain pdbs to be aligned.
         :param pdb_ref: The String Reference of a pdb that you want to
@@ -30,13 +38,45 @@ class Align:
             If True, this will change the behaviour of the alignment to solely align the first
             chain of each structure together, and not consider other chains.
         :param refset: Boolean, Indicate whether or not to automatically set a reference when constructing the alignment class
-            Can be set to False if only using align_to_reference function.
+            Can be set to False if only using align_to_reference function. The reference is only chosen when it is
+            first needed either way, with refset=False pdb_ref is ignored.
+        :param stats_cache: Optional path of a json file where the resolution and length of every pdb are kept
+            between runs, so that choosing the reference does not re-read unchanged files.
+        :param ref_jobs: Number of processes used to read the pdb files when choosing the reference.
+        :param box_margin: Optional margin (in Angstrom). If given the aligned maps are resampled into and written
+            as P1 maps of the box around the reference model plus box_margin instead of the full unit cell, and the
+            resampled values are not spread to their symmetry mates (which lie outside the reference model).
+        :param memory_budget: Optional size in bytes. Maps larger than this are memory-mapped rather than read
+            (see MappedMap) and resampled without any full cell grid (see resample_mapped and SparseXmap). Their
+            statistics, resampling and writing run in chunks of memory_budget // *_point_bytes grid points (see
+            mapped_chunk_size), which bounds the memory of each stage by the budget (the slabs of the statistics
+            and of the writing hold at least one section of the map). On top of it are the pages of the map files,
+            which the system maps and drops as needed, and what grows with the reference model rather than with the
+            maps: its masked points and their positions (48 bytes per point, twice that while they are gathered)
+            and the resampled values with their symmetry mates (up to about 100 bytes per point and symmetry
+            operation while they are spread). Maps that cannot be memory-mapped, maps written with box_margin and maps of
+            self referenced crystals (sr) are read as usual.
+        :param chain_jobs: Number of threads aligning the chains of a crystal (and resampling their maps) at once in
+            rrf mode. The chains share the parsed structure and the maps of the crystal.
+        :param identity_tolerance: Distance in Angstrom, or None. A transform moving no atom by more than this (e.g.
+            a crystal aligned to itself) is taken as the identity: the atoms are written as they were read and the
+            maps are not resampled, they are written normalised as they were read (as in sr mode).
+        :param asymmetric_unit: Bool, if True the maps are symmetrized per set of symmetry mates of the reference
+            mask instead of over the whole cell (see resample_many). The maps are the same.
         '''
 
         self.directory = directory
-        if refset:
-            self._get_ref = pdb_ref
+        self.stats_cache = stats_cache
+        self.ref_jobs = ref_jobs
+        # Resolved (and kept) by _get_ref the first time the reference is needed
+        self.__requested_ref = pdb_ref if refset else ''
+        self.__pdb_ref = None
         self.rrf = rrf
+        self.box_margin = box_margin
+        self.memory_budget = memory_budget
+        self.chain_jobs = chain_jobs
+        self.identity_tolerance = identity_tolerance
+        self.asymmetric_unit = asymmetric_unit
         self.ref_map = ''
 
     @property
@@ -62,8 +102,11 @@ class Align:
         """
         Determines the best reference structure for alignments if not user provided.
         Chosen based on longest length with lowest resolution.
+        Scanning the pdbs is deferred to the first call, the choice is then kept.
         :return: str of .pdb filename of reference:
         """
+        if self.__pdb_ref is None:
+            self._get_ref = self.__requested_ref
         return self.__pdb_ref
 
     @_get_ref.setter
@@ -94,126 +137,37 @@ class Align:
         :param pdb_files: List of pdb filepaths
         :return: str of filename with best .pdb file
         """
-        a_df = pd.DataFrame(pdb_files, columns=['file'])
-        a_df[['resolution', 'p_len', 'pdb']] = a_df.file.apply(
-            self.__get_length_and_resolution)
+        stats = pdb_stats(pdb_files, cache_file=self.stats_cache, jobs=self.ref_jobs)
+        # Longest first, then best resolution (files without a resolution last), ties keep the file order
+        best = sorted(stats, key=lambda x: (-x[1], float('inf') if x[0] is None else x[0]))
+        return best[0][2]
 
-        return a_df.sort_values(by=['p_len', 'resolution'], ascending=[False, True]).pdb[0]
-
-    def __get_length_and_resolution(self, file):
-        """
-        Determine resolution, sequence and length of .pdb file.
-        :param file: pdb file path.
-        :return: pandas series with resolution, sequence and length and .pdb filename.
-        """
-        parser = bp.PDBParser()
-        ppb = bp.PPBuilder()
-        structure = parser.get_structure(
-            os.path.splitext(os.path.basename(file))[0], file)
-
-        seq_len = 0
-
-        # Retrieve length by looping through each chain in the protein
-        for pp in ppb.build_peptides(structure):
-            seq_len += len(pp.get_sequence())
-
-        # using a functions from PDBParser parser class to get the resolution and protein id from the pdb file
-        return pd.Series([structure.header['resolution'], seq_len, structure.id])
-
-    def align_to_reference(self, in_file, reference_pdb, out_dir, sr=False):
+    def align_to_reference(self, in_file, reference_pdb, out_dir, sr=False, map_encoding=None):
         '''
         Aligns a single pdb file to a reference and adds it to the specified output directory.
         :param in_file: filepath to corresponding pdb file to align. Accompanying map files should be located within
             the same directory as input file.
         :param reference_pdb: the reference pdb file to align to.
         :param out_dir: The desired output directory for the aligned pdb file.
+        :param map_encoding: None to write plain ccp4 maps, or one of map_io.map_encodings ('gzip', 'int16', 'int8').
         :return: an aligned pdb file in the output directory with the same name as input.
         '''
         input_files = in_file
-        map_list = self._get_maplist
         base_names = os.path.splitext(os.path.basename(input_files))[0]
         crystals = [y for y in [x for x in [base_names]
                                 if 'event' not in x] if 'fofc' not in y]
         ref = reference_pdb
-        dir = self.directory
-        rrf = self.rrf
 
         reference_pdb = Structure.from_file(file=Path(ref))
+        geometry_cache = ReferenceGeometryCache()
+        sequence_cache = SequenceScoreCache()
         s = time.time()
         for num, name in enumerate(crystals):
-            all_maps = [j for j in map_list if name in j]
-            # TGS Code here
-            current_pdb = assign_small_mols_to_chains(f=in_file)
-            #current_pdb = Structure.from_file(file=Path(in_file))
-            rrf = can_rrf(f=in_file, r=ref)
-            if rrf:
-                # current_pdb.structure, chains = split_chain_str(
-                chains = split_chain_str(os.path.join(dir, f'{name}.pdb'))
-            else:
-                chains = ['']
-            for chain in chains:
-                if rrf:
-                    print(
-                        f'Aligning Chain {chain} of {name} to first chain of {ref}')
-                # TGS Here...
-                current_pdb = assign_small_mols_to_chains(f=in_file)
-                #current_pdb = Structure.from_file(file=Path(in_file))
-                try:
-                    current_pdb, transform = current_pdb.align_to(
-                        other=reference_pdb, rrf=rrf, chain_id=chain
-                    )
-                except Exception as e:
-                    print(f'{e}')
-                    continue
-                # Write new structure according to chain-name?
-                if rrf:
-                    current_pdb.structure.write_pdb(
-                        os.path.join(out_dir, f'{name}_{chain}_bound.pdb')
-                    )
-                    transform.to_json(filename=os.path.join(
-                        out_dir, f'{name}_{chain}_transform.json'))
-                    if os.path.exists(os.path.join(self.directory, f'{name}_smiles.txt')):
-                        shutil.copyfile(os.path.join(self.directory, f'{name}_smiles.txt'), os.path.join(
-                            out_dir, f'{name}_{chain}_smiles.txt'))
-                else:
-                    current_pdb.structure.write_pdb(
-                        os.path.join(out_dir, f'{name}_bound.pdb')
-                    )
-                    transform.to_json(filename=os.path.join(
-                        out_dir, f'{name}_transform.json'))
-                    if os.path.exists(os.path.join(self.directory, f'{name}_smiles.txt')):
-                        shutil.copyfile(os.path.join(self.directory, f'{name}_smiles.txt'), os.path.join(
-                            out_dir, f'{name}_smiles.txt'))
-
-                # Align Xmaps + save!
-                for i in all_maps:
-                    base, ext = os.path.splitext(os.path.basename(i))
-                    s2 = time.time()
-                    map = Xmap.from_file(
-                        file=Path(os.path.join(dir, f'{base}{ext}')))
-                    array = np.array(map.xmap, copy=False)
-                    array[~np.isfinite(array)] = 0
-                    array_mean = np.mean(array)
-                    array_sd = np.std(array)
-                    array[:, :, :] = (array[:, :, :] - array_mean) / array_sd
-                    template = Path(os.path.join(dir, f'{base}{ext}'))
-                    if sr:
-                        newmap = map
-                    else:
-                        newmap = resample(
-                            moving_xmap=map, transform=transform, reference_structure=reference_pdb)
-                    if rrf:
-                        base = base.replace(name, f'{name}_{chain}')
-                    fn = f'{base}{ext}'
-                    referenceSave(
-                        template_map_path=template,
-                        xmap=newmap,
-                        path_to_save=Path(os.path.join(out_dir, fn))
-                    )
-                    e2 = time.time()
-                    print(f'{int(e2 - s2)} seconds to transform map...')
-                    e = time.time()
-                    print(f'Total Running time: {int(e - s) / 60} minutes.')
+            self.align_crystal(name=name, in_file=in_file, reference_pdb=reference_pdb,
+                               reference_file=ref, out_dir=out_dir, sr=sr, geometry_cache=geometry_cache,
+                               sequence_cache=sequence_cache, map_encoding=map_encoding)
+        e = time.time()
+        print(f'Total Running time: {int(e - s) / 60} minutes.')
 
     def write_align_ref(self, output):
         '''
@@ -224,103 +178,750 @@ class Align:
         fn = os.path.join(self.directory, f'{self._get_ref}.pdb')
         shutil.copyfile(fn, os.path.join(output, 'reference.pdb'))
 
-    def align(self, out_dir):
+    def align(self, out_dir, jobs=1, map_encoding=None, cache_dir=None, pipeline_depth=0):
         """
         Aligns all pdb structures and map files (if any) using gemmi, and save them to a new directory.
         :param out_dir: directory to save aligned pdbs in
+        :param jobs: Number of worker processes to align crystals with. If > 1 the crystals are spread over a
+            process pool, each worker loads the reference once and a failing crystal does not stop the others.
+        :param map_encoding: None to write plain ccp4 maps, or one of map_io.map_encodings: 'gzip' (.gz compressed)
+            or 'int16'/'int8' (quantised and compressed).
+        :param cache_dir: Optional directory of an AlignmentCache. Crystals whose pdb, maps, smiles, reference and
+            options are unchanged since they were stored there are restored from it instead of being aligned again.
+        :param pipeline_depth: If > 0 (and jobs is 1), a background thread reads the pdbs and maps of up to
+            pipeline_depth crystals ahead of the one being aligned, and another one writes the outputs (at most
+            4 * pipeline_depth writes waiting), so that disk reads and writes overlap with the resampling.
         :return: saves the pdbs + transforms map files (if any!)
         """
         # load ref
         input_files = self._get_files
-        map_list = self._get_maplist
         crystals = [os.path.splitext(os.path.basename(f))[0]
                     for f in input_files]
+        # Chosen here at the latest, so that the workers below receive it with self
         ref = self._get_ref
         dir = self.directory
-        rrf = self.rrf
-
-        # Reference stuff
-        reference_pdb = Structure.from_file(
-            file=Path(os.path.join(dir, f'{ref}.pdb')))
+        reference_file = os.path.join(dir, f'{ref}.pdb')
+        alignment_cache = None if cache_dir is None else AlignmentCache(cache_dir)
 
         s = time.time()
-        for num, name in enumerate(crystals):
-            all_maps = [j for j in map_list if name in j]
-            # Logic to do...
-            # Align Chain N to First Chain in Reference
-            # TGS Here
-            current_pdb = assign_small_mols_to_chains(
-                f=os.path.join(dir, f'{name}.pdb'))
-            # current_pdb = Structure.from_file(
-            #    file=Path(os.path.join(dir, f'{name}.pdb')))
-            rrf = can_rrf(f=os.path.join(
-                dir, f'{name}.pdb'), r=os.path.join(dir, f'{ref}.pdb'))
-            if rrf:
-                chains = split_chain_str(
-                    os.path.join(dir, f'{name}.pdb'))
+        if int(jobs) > 1:
+            errors = {}
+            with ProcessPoolExecutor(max_workers=int(jobs), initializer=init_align_worker,
+                                     initargs=(reference_file,)) as pool:
+                futures = {pool.submit(align_crystal_in_worker, self, name, os.path.join(dir, f'{name}.pdb'),
+                                       reference_file, out_dir, map_encoding, alignment_cache): name
+                           for name in crystals}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors[futures[future]] = e
+            for name, e in errors.items():
+                print(f'Could not align {name}: {e}')
+        else:
+            # Reference stuff
+            reference_pdb = Structure.from_file(file=Path(reference_file))
+            # The reference mask and the sequence scores are computed once and reused by every crystal
+            geometry_cache = ReferenceGeometryCache()
+            sequence_cache = SequenceScoreCache()
+            if int(pipeline_depth) > 0:
+                writer = BackgroundWriter(max_pending=4 * int(pipeline_depth))
+                inputs = read_ahead(
+                    lambda name: self.read_crystal(name=name, in_file=os.path.join(dir, f'{name}.pdb'),
+                                                   reference_file=reference_file, map_encoding=map_encoding,
+                                                   alignment_cache=alignment_cache),
+                    crystals, depth=int(pipeline_depth))
             else:
-                chains = ['']
+                writer = None
+                inputs = [None] * len(crystals)
+            try:
+                for name, crystal_inputs in zip(crystals, inputs):
+                    self.align_crystal(name=name, in_file=os.path.join(dir, f'{name}.pdb'),
+                                       reference_pdb=reference_pdb, reference_file=reference_file, out_dir=out_dir,
+                                       geometry_cache=geometry_cache, sequence_cache=sequence_cache,
+                                       map_encoding=map_encoding, alignment_cache=alignment_cache,
+                                       inputs=crystal_inputs, writer=writer)
+            finally:
+                if writer is not None:
+                    writer.close()
+        e = time.time()
+        print(f'Total Running time: {int(e - s) / 60} minutes.')
+
+    def cache_key(self, name, in_file, reference_file, sr=False, map_encoding=None):
+        '''
+        :return: str, AlignmentCache key of the files align_crystal writes for a crystal, see align_crystal.
+        '''
+        all_maps = [j for j in self._get_maplist if name in j]
+        smiles_file = os.path.join(self.directory, f'{name}_smiles.txt')
+        return AlignmentCache.key(in_file, all_maps, reference_file,
+                                  smiles_file if os.path.exists(smiles_file) else None,
+                                  rrf=self.rrf, sr=sr, map_encoding=map_encoding, box_margin=self.box_margin,
+                                  memory_budget=self.memory_budget, identity_tolerance=self.identity_tolerance,
+                                  asymmetric_unit=self.asymmetric_unit)
+
+    def read_crystal(self, name, in_file, reference_file, sr=False, map_encoding=None, alignment_cache=None):
+        '''
+        Read the pdb and the maps of a crystal for align_crystal, so that it can be done ahead (see align).
+        Parameters as align_crystal.
+        :return: CrystalInputs, only holding the cache key if alignment_cache already has the crystal.
+        '''
+        key = None
+        if alignment_cache is not None:
+            key = self.cache_key(name, in_file, reference_file, sr=sr, map_encoding=map_encoding)
+            if alignment_cache.has(key):
+                return CrystalInputs(cache_key=key)
+        all_maps = [j for j in self._get_maplist if name in j]
+        for f in [in_file] + all_maps:
+            read_file_ahead(f)
+        return CrystalInputs(context=StructureContext.from_file(in_file),
+                             maps={i: self.read_map(i, sr=sr) for i in all_maps},
+                             cache_key=key)
+
+    def align_crystal(self, name, in_file, reference_pdb, reference_file, out_dir, sr=False, geometry_cache=None,
+                      sequence_cache=None, map_encoding=None, alignment_cache=None, inputs=None, writer=None):
+        '''
+        Align a single crystal (each chain separately in rrf mode) and its map files to the reference.
+        :param name: Name of the crystal, the pdb filename without extension.
+        :param in_file: Filepath of the pdb file of the crystal.
+        :param reference_pdb: Structure of the reference.
+        :param reference_file: Filepath of the reference pdb file.
+        :param out_dir: The desired output directory for the aligned files.
+        :param sr: Bool, if True the maps are written without being resampled (the crystal is its own reference).
+        :param geometry_cache: Optional ReferenceGeometryCache shared by all the crystals aligned to reference_pdb.
+        :param sequence_cache: Optional SequenceScoreCache shared by all the crystals aligned to reference_pdb.
+        :param map_encoding: None or one of map_io.map_encodings, see align.
+        :param alignment_cache: Optional AlignmentCache the output files are restored from or stored in.
+        :param inputs: Optional CrystalInputs of the crystal from read_crystal, otherwise the files are read here.
+        :param writer: Optional BackgroundWriter the output files are written by, otherwise they are written here.
+        :return: the aligned pdb, transform and map files in out_dir.
+        '''
+        if alignment_cache is not None:
+            key = inputs.cache_key if inputs is not None else self.cache_key(name, in_file, reference_file, sr=sr,
+                                                                               map_encoding=map_encoding)
+            if alignment_cache.restore(key, out_dir) is not None:
+                print(f'{name} restored from the alignment cache')
+                return
+        write = writer.submit if writer is not None else call
+        # Every file written, stored in the alignment cache if all the chains could be aligned
+        written = []
+        failed = False
+        for aligned in self.align_chains(name=name, in_file=in_file, reference_pdb=reference_pdb,
+                                         reference_file=reference_file, sr=sr, geometry_cache=geometry_cache,
+                                         sequence_cache=sequence_cache, inputs=inputs):
+            if aligned is None:
+                failed = True
+                continue
+            written += aligned.write(out_dir, map_encoding=map_encoding, write=write)
+
+        if alignment_cache is not None and not failed:
+            # After the writes above when they are done in the background
+            write(alignment_cache.store, key, written)
+
+    def align_chains(self, name, in_file, reference_pdb, reference_file, sr=False, geometry_cache=None,
+                     sequence_cache=None, inputs=None):
+        '''
+        Align a single crystal (each chain separately in rrf mode) and resample its maps, without writing anything.
+        Parameters as align_crystal.
+        :return: generator of an AlignedCrystal per chain, or None for a chain that could not be aligned.
+        '''
+        all_maps = [j for j in self._get_maplist if name in j]
+        smiles_file = os.path.join(self.directory, f'{name}_smiles.txt')
+        # Logic to do...
+        # Align Chain N to First Chain in Reference
+        # Parse once, every helper below works from the same context.
+        if inputs is not None and inputs.context is not None:
+            context = inputs.context
+            maps = dict(inputs.maps)
+        else:
+            context = StructureContext.from_file(in_file)
+            maps = {}
+        rrf = can_rrf(f=in_file, r=reference_file, context=context,
+                      reference=reference_pdb, sequence_cache=sequence_cache)
+        if rrf:
+            chains = split_chain_str(in_file, context=context)
+        else:
+            chains = ['']
+        # The small molecule chains are assigned once, align_to works inplace so each chain aligns its own copy
+        assigned = assign_small_mols_to_chains(context=context)
+        smiles_file = smiles_file if os.path.exists(smiles_file) else None
+
+        def align_chain(chain):
+            if rrf:
+                print(
+                    f'Aligning Chain {chain} of {name} to first chain of {reference_file}')
+            current_pdb = Structure(assigned.structure.clone()) if len(chains) > 1 else assigned
+            try:
+                current_pdb, transform = current_pdb.align_to(
+                    other=reference_pdb, rrf=rrf, chain_id=chain, identity_tolerance=self.identity_tolerance
+                )
+            except Exception as e:
+                print(f'{e}')
+                return None
+
+            # Output names according to chain-name
+            prefix = f'{name}_{chain}' if rrf else name
+
+            # Align Xmaps!
+            newmaps = self.transform_maps(name=name, prefix=prefix, all_maps=all_maps, maps=maps,
+                                          transform=transform, reference_pdb=reference_pdb, sr=sr,
+                                          geometry_cache=geometry_cache,
+                                          identity=not sr and self.is_identity(transform, reference_pdb,
+                                                                               geometry_cache))
+
+            return AlignedCrystal(name=prefix, structure=current_pdb, transform=transform, maps=newmaps,
+                                  smiles_file=smiles_file, box=self.map_box(reference_pdb))
+
+        jobs = int(self.chain_jobs)
+        if jobs > 1 and len(chains) > 1:
+            # Read before the threads share them, transform_maps only reads the maps that are missing
+            for i in all_maps:
+                if i not in maps:
+                    maps[i] = self.read_map(i, sr=sr)
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                # jobs chains at a time, so that at most jobs chains of resampled maps are held
+                for start in range(0, len(chains), jobs):
+                    yield from pool.map(align_chain, chains[start:start + jobs])
+        else:
             for chain in chains:
-                # TGS Here
-                current_pdb = assign_small_mols_to_chains(
-                    f=os.path.join(dir, f'{name}.pdb'))
-                # current_pdb = Structure.from_file(
-                #    file=Path(os.path.join(dir, f'{name}.pdb')))
+                yield align_chain(chain)
+
+    def map_box(self, reference_pdb):
+        '''
+        :param reference_pdb: Structure in the reference frame.
+        :return: (low, high) orthogonal corners of the box of the written maps, or None for the full cell.
+        '''
+        if self.box_margin is None:
+            return None
+        return model_box(reference_pdb, float(self.box_margin))
+
+    def transform_maps(self, name, prefix, all_maps, maps, transform, reference_pdb, sr=False, geometry_cache=None,
+                       identity=False):
+        '''
+        Resample the maps of a crystal into the frame of the reference.
+        :param name: Name of the crystal.
+        :param prefix: Name of the outputs, name replaces it in the map filenames.
+        :param all_maps: Filepaths of the maps of the crystal.
+        :param maps: Dict of filepath to the CrystalMaps (or MappedMaps, see read_map) already read, the maps read
+            here are added to it so that they are read and normalised once per crystal and shared by every chain.
+        :param transform: Transform of the crystal to the reference.
+        :param reference_pdb: Structure in the reference frame whose polymer atoms define the region resampled.
+        :param sr: Bool, if True the maps are not resampled.
+        :param geometry_cache: Optional ReferenceGeometryCache for reference_pdb.
+        :param identity: Bool, True if the transform is the identity (see is_identity), the maps are then not
+            resampled either.
+        :return: Dict of output map filename to (resampled Xmap, CrystalMap), see AlignedCrystal.maps.
+        '''
+        newmaps = {}
+        if len(all_maps) > 0:
+            s2 = time.time()
+            for i in all_maps:
+                if i not in maps:
+                    maps[i] = self.read_map(i, sr=sr)
+            if sr or identity:
+                # Written as they were read (normalised), see AlignedCrystal.write_map
+                resampled = [maps[i].xmap if isinstance(maps[i], CrystalMap) else maps[i] for i in all_maps]
+            else:
+                in_memory = [i for i in all_maps if isinstance(maps[i], CrystalMap)]
+                mapped = [i for i in all_maps if i not in in_memory]
+                # All the maps share the transform, so the sample positions are only computed once
+                resampled = dict(zip(in_memory, resample_many(
+                    moving_xmaps=[maps[i].xmap for i in in_memory], transform=transform,
+                    reference_structure=reference_pdb, geometry_cache=geometry_cache,
+                    box=self.map_box(reference_pdb), asymmetric_unit=self.asymmetric_unit)))
+                if len(mapped) > 0:
+                    resampled.update(zip(mapped, resample_mapped(
+                        mapped_maps=[maps[i] for i in mapped], transform=transform,
+                        reference_structure=reference_pdb, geometry_cache=geometry_cache,
+                        chunk_size=mapped_chunk_size(self.memory_budget, resample_point_bytes),
+                        asymmetric_unit=self.asymmetric_unit,
+                        write_chunk_size=mapped_chunk_size(self.memory_budget, write_point_bytes))))
+                resampled = [resampled[i] for i in all_maps]
+            for i, newmap in zip(all_maps, resampled):
+                base, ext = os.path.splitext(os.path.basename(i))
+                newmaps[f'{base.replace(name, prefix)}{ext}'] = (newmap, maps[i])
+            e2 = time.time()
+            print(f'{int(e2 - s2)} seconds to transform {len(all_maps)} maps...')
+        return newmaps
+
+    def is_identity(self, transform, reference_pdb, geometry_cache=None):
+        '''
+        :param transform: Transform of a crystal to the reference.
+        :param reference_pdb: Structure in the reference frame whose polymer atoms define the region resampled.
+        :param geometry_cache: Optional ReferenceGeometryCache for reference_pdb, keeps its atom positions.
+        :return: Bool, True if the transform moves none of the polymer atoms of reference_pdb by more than
+            identity_tolerance.
+        '''
+        if self.identity_tolerance is None:
+            return False
+        if geometry_cache is None:
+            positions = protein_positions(reference_pdb)
+        else:
+            positions = geometry_cache.positions(reference_pdb)
+        return transform.is_identity(positions, self.identity_tolerance)
+
+    def read_map(self, map_file, sr=False):
+        '''
+        :param map_file: Filepath of a map of a crystal.
+        :param sr: Bool, True if the crystal is its own reference (its maps are not resampled).
+        :return: MappedMap if the map is larger than memory_budget (and can be memory-mapped), otherwise CrystalMap
+            (normalised in its template when sr, as it is written without being resampled).
+        '''
+        if self.memory_budget is not None and self.box_margin is None and not sr \
+                and os.path.getsize(map_file) > int(self.memory_budget):
+            mapped = MappedMap.from_file(map_file,
+                                         chunk_size=mapped_chunk_size(self.memory_budget, stats_point_bytes),
+                                         write_chunk_size=mapped_chunk_size(self.memory_budget, write_point_bytes))
+            if mapped is not None:
+                return mapped
+            print(f'{map_file} cannot be memory-mapped, it is read in memory')
+        return CrystalMap.from_file(Path(map_file), in_place=sr)
+
+    def replay(self, out_dir, transform_dir, map_encoding=None, reference_file=None):
+        '''
+        Apply the transforms written by a previous alignment to the current pdbs and maps of the directory (e.g. new
+        event maps or a re-refined model of crystals already aligned), without choosing or matching to a reference.
+        Crystals without a transform in transform_dir are skipped.
+        :param out_dir: directory to save the transformed pdbs and maps in.
+        :param transform_dir: Directory of the {name}_transform.json (or {name}_{chain}_transform.json in rrf mode)
+            files, as written by align.
+        :param map_encoding: None or one of map_io.map_encodings, see align.
+        :param reference_file: Optional filepath of the reference pdb, only used to choose the region of the maps
+            resampled, as align does. By default the region around the transformed crystal itself is resampled.
+        :return: saves the pdbs + transforms map files (if any!)
+        '''
+        s = time.time()
+        for aligned in self.replayed_crystals(transform_dir=transform_dir, reference_file=reference_file):
+            aligned.write(out_dir, map_encoding=map_encoding)
+        e = time.time()
+        print(f'Total Running time: {int(e - s) / 60} minutes.')
+
+    def replayed_crystals(self, transform_dir, in_files=None, reference_file=None):
+        '''
+        Apply stored transforms without writing anything, the replay counterpart of aligned_crystals.
+        :param transform_dir: Directory of the transform files, see replay.
+        :param in_files: pdb filepaths to transform, all the pdbs of the directory by default.
+        :param reference_file: Optional filepath of the reference pdb, see replay.
+        :return: generator of AlignedCrystal, one per transform file of each crystal.
+        '''
+        if in_files is None:
+            in_files = self._get_files
+        reference_pdb = None if reference_file is None else Structure.from_file(file=Path(reference_file))
+        geometry_cache = ReferenceGeometryCache()
+        for in_file in in_files:
+            name = os.path.splitext(os.path.basename(in_file))[0]
+            transform_files = find_transform_files(transform_dir, name)
+            if len(transform_files) == 0:
+                print(f'No transform of {name} in {transform_dir}, skipped')
+                continue
+            for aligned in self.replay_chains(name=name, in_file=in_file, transform_files=transform_files,
+                                              reference_pdb=reference_pdb, geometry_cache=geometry_cache):
+                yield aligned
+
+    def replay_chains(self, name, in_file, transform_files, reference_pdb=None, geometry_cache=None):
+        '''
+        Transform a crystal and resample its maps with stored transforms, the replay counterpart of align_chains.
+        :param name: Name of the crystal, the pdb filename without extension.
+        :param in_file: Filepath of the pdb file of the crystal.
+        :param transform_files: Dict of output name to transform filepath, see find_transform_files.
+        :param reference_pdb: Optional Structure of the reference defining the region of the maps resampled,
+            otherwise the transformed crystal is used.
+        :param geometry_cache: Optional ReferenceGeometryCache for reference_pdb.
+        :return: generator of an AlignedCrystal per transform file.
+        '''
+        all_maps = [j for j in self._get_maplist if name in j]
+        smiles_file = os.path.join(self.directory, f'{name}_smiles.txt')
+        assigned = assign_small_mols_to_chains(context=StructureContext.from_file(in_file))
+        maps = {}
+        for prefix, transform_file in transform_files.items():
+            transform = Transform.from_json(transform_file)
+            current_pdb = Structure(assigned.structure.clone()) if len(transform_files) > 1 else assigned
+            current_pdb.transform_to_reference(transform, identity_tolerance=self.identity_tolerance)
+            if reference_pdb is None:
+                # Every crystal is its own mask, there is nothing to share between them
+                mask_pdb = current_pdb
+                newmaps = self.transform_maps(name=name, prefix=prefix, all_maps=all_maps, maps=maps,
+                                              transform=transform, reference_pdb=current_pdb,
+                                              identity=self.is_identity(transform, current_pdb))
+            else:
+                mask_pdb = reference_pdb
+                newmaps = self.transform_maps(name=name, prefix=prefix, all_maps=all_maps, maps=maps,
+                                              transform=transform, reference_pdb=reference_pdb,
+                                              geometry_cache=geometry_cache,
+                                              identity=self.is_identity(transform, reference_pdb, geometry_cache))
+            yield AlignedCrystal(name=prefix, structure=current_pdb, transform=transform, maps=newmaps,
+                                 smiles_file=smiles_file if os.path.exists(smiles_file) else None,
+                                 box=self.map_box(mask_pdb))
+
+    def aligned_crystals(self, in_files=None, reference_file=None, sr=False, pipeline_depth=0):
+        '''
+        Align pdb structures and their maps to a reference without writing anything, to hand them straight to the
+        next stage (see xcimporter in_memory) instead of going through files.
+        :param in_files: pdb filepaths to align, all the pdbs of the directory by default.
+        :param reference_file: Filepath of the reference pdb, the one chosen from the directory by default.
+        :param sr: Bool, if True the maps are not resampled (each crystal is its own reference, see align_crystal).
+        :param pipeline_depth: If > 0, the pdbs and maps of up to pipeline_depth crystals are read ahead, see align.
+        :return: generator of AlignedCrystal, one per crystal or per chain in rrf mode. Chains that cannot be aligned
+            are skipped.
+        '''
+        if in_files is None:
+            in_files = self._get_files
+        if reference_file is None:
+            reference_file = os.path.join(self.directory, f'{self._get_ref}.pdb')
+        reference_pdb = Structure.from_file(file=Path(reference_file))
+        geometry_cache = ReferenceGeometryCache()
+        sequence_cache = SequenceScoreCache()
+        if int(pipeline_depth) > 0:
+            inputs = read_ahead(
+                lambda in_file: self.read_crystal(name=os.path.splitext(os.path.basename(in_file))[0],
+                                                  in_file=in_file, reference_file=reference_file, sr=sr),
+                in_files, depth=int(pipeline_depth))
+        else:
+            inputs = [None] * len(in_files)
+        for in_file, crystal_inputs in zip(in_files, inputs):
+            for aligned in self.align_chains(name=os.path.splitext(os.path.basename(in_file))[0], in_file=in_file,
+                                             reference_pdb=reference_pdb, reference_file=reference_file, sr=sr,
+                                             geometry_cache=geometry_cache, sequence_cache=sequence_cache,
+                                             inputs=crystal_inputs):
+                if aligned is not None:
+                    yield aligned
+
+
+def find_transform_files(transform_dir, name):
+    '''
+    Find the transforms Align.align wrote for a crystal.
+    :param transform_dir: Directory of the transform files.
+    :param name: Name of the crystal.
+    :return: Dict of output name ({name}, or {name}_{chain} in rrf mode) to transform filepath, sorted by name.
+    '''
+    single = os.path.join(transform_dir, f'{name}_transform.json')
+    if os.path.isfile(single):
+        return {name: single}
+    pattern = re.compile(re.escape(name) + r'_[^_]+_transform\.json$')
+    files = sorted(f for f in os.listdir(transform_dir) if pattern.match(f))
+    return {f[:-len('_transform.json')]: os.path.join(transform_dir, f) for f in files}
+
+
+# Reference structure of the current align worker process, see Align.align(jobs=...)
+_worker_reference = {}
+
+
+def init_align_worker(reference_file):
+    '''
+    Process pool initializer, loads the reference structure once per worker.
+    :param reference_file: Filepath of the reference pdb file.
+    '''
+    _worker_reference['structure'] = Structure.from_file(file=Path(reference_file))
+    _worker_reference['geometry_cache'] = ReferenceGeometryCache()
+    _worker_reference['sequence_cache'] = SequenceScoreCache()
+
+
+def align_crystal_in_worker(align_obj, name, in_file, reference_file, out_dir, map_encoding=None,
+                            alignment_cache=None):
+    '''
+    Run Align.align_crystal inside a worker started with init_align_worker.
+    '''
+    return align_obj.align_crystal(name=name, in_file=in_file, reference_pdb=_worker_reference['structure'],
+                                   reference_file=reference_file, out_dir=out_dir,
+                                   geometry_cache=_worker_reference['geometry_cache'],
+                                   sequence_cache=_worker_reference['sequence_cache'], map_encoding=map_encoding,
+                                   alignment_cache=alignment_cache)
+
+
+@dataclasses.dataclass()
+class AlignedCrystal:
+    '''
+    A crystal (or one of its chains in rrf mode) aligned to the reference, as Align.align_crystal writes it.
+    name: base of the output filenames, the crystal name (followed by _chain in rrf mode).
+    structure: the aligned Structure.
+    transform: the Transform from the crystal to the reference.
+    maps: output map filename (e.g. x0001_A_event.ccp4) -> (resampled Xmap, CrystalMap it was resampled from),
+        (BoxXmap, CrystalMap) for the maps resampled into a box (see Align box_margin), or (SparseXmap, MappedMap)
+        for the maps resampled out of core (see Align memory_budget). The maps that are not resampled (sr or an
+        identity transform) are (CrystalMap.xmap, CrystalMap) or (MappedMap, MappedMap).
+    smiles_file: Filepath of the smiles of the crystal, or None.
+    box: (low, high) orthogonal corners of the box the maps are written as (P1), or None to write the full cell.
+        The maps which are not BoxXmaps already (not resampled, sr) are cut to it when written.
+    '''
+    name: str
+    structure: 'Structure'
+    transform: 'Transform'
+    maps: dict
+    smiles_file: str = None
+    box: tuple = None
+
+    def pdb_lines(self):
+        '''
+        :return: list of the lines of the aligned pdb file, as write would write it.
+        '''
+        # write_pdb is the headers (ending with CRYST1), then the model (starting with CRYST1 again) and END
+        headers = self.structure.structure.make_pdb_headers().splitlines(keepends=True)
+        model = self.structure.structure.make_minimal_pdb().splitlines(keepends=True)
+        if model and model[0].startswith('CRYST1') and any(line.startswith('CRYST1') for line in headers):
+            model = model[1:]
+        return headers + model + ['END'.ljust(80) + '\n']
+
+    def write_map(self, map_name, path, encoding=None):
+        '''
+        Write one of the resampled maps with the header of its original.
+        :param map_name: Key of maps.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        xmap, crystal_map = self.maps[map_name]
+        if isinstance(xmap, SparseXmap):
+            return xmap.write(crystal_map.words, path, encoding=encoding)
+        if isinstance(xmap, (BoxXmap, MappedMap)):
+            return xmap.write(path, encoding=encoding)
+        if self.box is not None:
+            return map_io.write_map_box(xmap.xmap, self.box[0], self.box[1], path, encoding=encoding, p1=True)
+        if xmap is crystal_map.xmap:
+            # Not resampled
+            return crystal_map.write(path, encoding=encoding)
+        return referenceSave(template_map_path=crystal_map.path, xmap=xmap, path_to_save=Path(path),
+                             template_map=crystal_map.template, encoding=encoding)
+
+    def write_map_cutout(self, map_name, low, high, path, encoding=None):
+        '''
+        Write the box of one of the resampled maps between two orthogonal corners, e.g. around a ligand.
+        :param map_name: Key of maps.
+        :param low: Lowest orthogonal coordinates of the box.
+        :param high: Highest orthogonal coordinates of the box.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        xmap, _ = self.maps[map_name]
+        if isinstance(xmap, (BoxXmap, SparseXmap, MappedMap)):
+            return xmap.write_cutout(low, high, path, encoding=encoding)
+        return map_io.write_map_box(xmap.xmap, low, high, path, encoding=encoding)
+
+    def write(self, out_dir, map_encoding=None, write=None):
+        '''
+        Write the aligned pdb, transform, smiles and maps into out_dir.
+        :param out_dir: Output directory.
+        :param map_encoding: None or one of map_io.map_encodings.
+        :param write: Optional function the writes are run through, e.g. BackgroundWriter.submit.
+        :return: list of the filepaths written.
+        '''
+        if write is None:
+            write = call
+        written = [os.path.join(out_dir, f'{self.name}_bound.pdb'),
+                   os.path.join(out_dir, f'{self.name}_transform.json')]
+        write(self.structure.structure.write_pdb, written[0])
+        write(self.transform.to_json, filename=written[1])
+        if self.smiles_file is not None:
+            written.append(os.path.join(out_dir, f'{self.name}_smiles.txt'))
+            write(shutil.copyfile, self.smiles_file, written[-1])
+        for map_name in self.maps:
+            write(self.write_map, map_name, os.path.join(out_dir, map_name), encoding=map_encoding)
+            written.append(map_io.encoded_path(os.path.join(out_dir, map_name), map_encoding))
+        return written
+
+
+@dataclasses.dataclass()
+class CrystalInputs:
+    '''
+    What Align.align_crystal reads from disk for a crystal, see Align.read_crystal. context is None (and maps empty)
+    when the crystal is restored from the alignment cache instead.
+    '''
+    context: 'StructureContext' = None
+    maps: dict = dataclasses.field(default_factory=dict)
+    cache_key: str = None
+
+
+def call(fn, *args, **kwargs):
+    '''
+    fn(*args, **kwargs), the synchronous counterpart of BackgroundWriter.submit.
+    '''
+    return fn(*args, **kwargs)
+
+
+def read_file_ahead(file, block_size=2 ** 22):
+    '''
+    Read a file and drop its content. Python releases the GIL while reading, so this brings the file into the page
+    cache without stalling the other threads, the gemmi parse that follows (which keeps the GIL) is then fast.
+    :param file: Filepath.
+    :param block_size: Size of the reads in bytes.
+    '''
+    buffer = bytearray(block_size)
+    with open(file, 'rb', buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def read_ahead(read, items, depth=1):
+    '''
+    Generator of read(item) for each item, computed by a background thread. At most depth results wait to be
+    consumed. An exception raised by read is raised by the generator when its item is reached.
+    :param read: Function of an item.
+    :param items: List of items.
+    :param depth: Number of results that may be computed ahead.
+    '''
+    results = queue.Queue(maxsize=max(1, int(depth)))
+    stop = threading.Event()
+
+    def produce():
+        for item in items:
+            try:
+                result = (read(item), None)
+            except Exception as e:
+                result = (None, e)
+            # Give up if the generator is closed while the queue is full
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        for _ in items:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        stop.set()
+
+
+class BackgroundWriter:
+    '''
+    Runs calls (writing output files) in order on a background thread. submit blocks while max_pending calls are
+    waiting, so finished outputs do not pile up in memory. The first exception raised by a call is raised again by
+    the next submit or by close, the calls after it are skipped.
+    '''
+
+    def __init__(self, max_pending=4):
+        self._calls = queue.Queue(maxsize=max(1, int(max_pending)))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._calls.get()
+            if task is None:
+                return
+            if self._error is None:
+                fn, args, kwargs = task
                 try:
-                    current_pdb, transform = current_pdb.align_to(
-                        other=reference_pdb, rrf=rrf, chain_id=chain
-                    )
+                    fn(*args, **kwargs)
                 except Exception as e:
-                    print(f'{e}')
+                    self._error = e
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Run fn(*args, **kwargs) on the background thread.
+        '''
+        self._raise()
+        self._calls.put((fn, args, kwargs))
+
+    def close(self):
+        '''
+        Wait for the submitted calls to be done.
+        '''
+        self._calls.put(None)
+        self._thread.join()
+        self._raise()
+
+
+# The residues counted towards the length of a pdb, see scan_pdb_stats
+standard_aa_names = ['ALA', 'CYS', 'ASP', 'GLU', 'PHE', 'GLY', 'HIS', 'ILE', 'LYS', 'LEU', 'MET', 'ASN', 'PRO', 'GLN',
+                     'ARG', 'SER', 'THR', 'VAL', 'TRP', 'TYR']
+
+
+def scan_pdb_stats(file):
+    '''
+    Read the resolution and the protein length of a pdb file in a single pass over its lines.
+    The resolution comes from the REMARK 2 header record (as Bio.PDB.parse_pdb_header reads it), the length is the
+    number of standard amino acids with backbone N, CA and C atoms in the first model (so CA only traces, which
+    Bio.PDB.PPBuilder could not build peptides from, still count as empty).
+    :param file: pdb file path.
+    :return: (resolution or None, length, name of the pdb without extension)
+    '''
+    resolution = None
+    in_header = True
+    residues = {}
+    with open(file) as f:
+        for line in f:
+            record = line[0:6]
+            if in_header:
+                if record not in ('ATOM  ', 'HETATM', 'MODEL '):
+                    if re.search('REMARK   2 RESOLUTION.', line):
+                        r = re.sub(r'\s\s\s\s+[\w]{4}.\s+\d*\Z', '', re.sub('REMARK   2 RESOLUTION.', '', line))
+                        r = re.sub(r'\s+ANGSTROM.*', '', r)
+                        try:
+                            resolution = float(r)
+                        except ValueError:
+                            resolution = None
                     continue
+                in_header = False
+            if record == 'ENDMDL':
+                break
+            if record in ('ATOM  ', 'HETATM') and line[12:16].strip() in ('N', 'CA', 'C') and \
+                    line[17:20].strip() in standard_aa_names:
+                residues.setdefault((line[21], line[22:27]), set()).add(line[12:16].strip())
+    length = len([x for x in residues.values() if len(x) == 3])
+    return resolution, length, os.path.splitext(os.path.basename(file))[0]
 
-                # Write new structure according to chain-name?
-                if rrf:
-                    current_pdb.structure.write_pdb(
-                        os.path.join(out_dir, f'{name}_{chain}_bound.pdb')
-                    )
-                    transform.to_json(filename=os.path.join(
-                        out_dir, f'{name}_{chain}_transform.json'))
-                    if os.path.exists(os.path.join(self.directory, f'{name}_smiles.txt')):
-                        shutil.copyfile(os.path.join(self.directory, f'{name}_smiles.txt'), os.path.join(
-                            out_dir, f'{name}_{chain}_smiles.txt'))
-                else:
-                    current_pdb.structure.write_pdb(
-                        os.path.join(out_dir, f'{name}_bound.pdb')
-                    )
-                    transform.to_json(filename=os.path.join(
-                        out_dir, f'{name}_transform.json'))
-                    if os.path.exists(os.path.join(self.directory, f'{name}_smiles.txt')):
-                        shutil.copyfile(os.path.join(self.directory, f'{name}_smiles.txt'), os.path.join(
-                            out_dir, f'{name}_smiles.txt'))
-
-                # Align Xmaps + save!
-                for i in all_maps:
-                    base, ext = os.path.splitext(os.path.basename(i))
-                    s2 = time.time()
-                    map = Xmap.from_file(
-                        file=Path(os.path.join(dir, f'{base}{ext}')))
-                    array = np.array(map.xmap, copy=False)
-                    array[~np.isfinite(array)] = 0
-                    array_mean = np.mean(array)
-                    array_sd = np.std(array)
-                    array[:, :, :] = (array[:, :, :] - array_mean) / array_sd
-                    newmap = resample(
-                        moving_xmap=map, transform=transform, reference_structure=reference_pdb)
-                    template = Path(
-                        os.path.join(dir, f'{base}{ext}'))
-                    if rrf:
-                        base = base.replace(name, f'{name}_{chain}')
-                    fn = f'{base}{ext}'
-                    referenceSave(
-                        template_map_path=template,
-                        xmap=newmap,
-                        path_to_save=Path(os.path.join(out_dir, fn))
-                    )
-                    e2 = time.time()
-                    print(f'{int(e2 - s2)} seconds to transform map...')
-                    e = time.time()
-                    print(f'Total Running time: {int(e - s) / 60} minutes.')
+
+def pdb_stats(pdb_files, cache_file=None, jobs=1):
+    '''
+    scan_pdb_stats for many files. With a cache file the stats are stored per file together with its modification
+    time and sha1, unchanged files are not scanned again.
+    :param pdb_files: List of pdb filepaths.
+    :param cache_file: Optional path of the json stats cache, created if it does not exist.
+    :param jobs: Number of processes used to scan the files.
+    :return: list of (resolution, length, pdb name), in the order of pdb_files.
+    '''
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            print(f'Could not read {cache_file}, the pdb stats will be recomputed')
+
+    stats = {}
+    hashes = {}
+    for file in pdb_files:
+        key = os.path.abspath(file)
+        entry = cache.get(key)
+        if entry is None:
+            continue
+        if entry['mtime'] == os.path.getmtime(file):
+            stats[file] = tuple(entry['stats'])
+            continue
+        # Touched but maybe not changed
+        hashes[file] = file_sha1(file)
+        if entry['sha1'] == hashes[file]:
+            stats[file] = tuple(entry['stats'])
+
+    missing = [file for file in pdb_files if file not in stats]
+    if int(jobs) > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=int(jobs)) as pool:
+            stats.update(zip(missing, pool.map(scan_pdb_stats, missing)))
+    else:
+        stats.update((file, scan_pdb_stats(file)) for file in missing)
+
+    if cache_file is not None and (missing or hashes):
+        for file in missing + [file for file in hashes if file not in missing]:
+            cache[os.path.abspath(file)] = {'mtime': os.path.getmtime(file),
+                                            'sha1': hashes[file] if file in hashes else file_sha1(file),
+                                            'stats': list(stats[file])}
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+
+    return [stats[file] for file in pdb_files]
 
 
 @dataclasses.dataclass()
@@ -381,6 +982,41 @@ class Transform:
                                               transformed_vector[2] + self.com_reference[2])
         return transformed_position
 
+    def apply_many(self, positions):
+        '''
+        Vectorised apply.
+        :param positions: (N, 3) array of positions.
+        :return: (N, 3) array of the transformed positions.
+        '''
+        return Transform.apply_transform_many(self.transform, positions, self.com_reference, self.com_moving)
+
+    def apply_inverse_many(self, positions):
+        '''
+        Vectorised apply_inverse.
+        :param positions: (N, 3) array of positions.
+        :return: (N, 3) array of the transformed positions.
+        '''
+        return Transform.apply_transform_many(self.transform.inverse(), positions, self.com_moving,
+                                              self.com_reference)
+
+    def is_identity(self, positions, tolerance):
+        '''
+        :param positions: (N, 3) array of positions.
+        :param tolerance: Distance in Angstrom.
+        :return: Bool, True if apply_inverse moves none of the positions by more than tolerance.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        moved = self.apply_inverse_many(positions)
+        return bool(np.all(np.sum((moved - positions) ** 2, axis=1) <= tolerance ** 2))
+
+    @staticmethod
+    def apply_transform_many(transform, positions, com_from, com_to):
+        # Same arithmetic as gemmi.Transform.apply, so the result matches apply/apply_inverse exactly
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3) - np.asarray(com_from, dtype=float)
+        transformed = multiply_positions(np.array(transform.mat.tolist()), positions) + \
+            np.array(transform.vec.tolist())
+        return transformed + np.asarray(com_to, dtype=float)
+
     @staticmethod
     def from_json(json_file):
         with open(json_file) as jfile:
@@ -388,7 +1024,7 @@ class Transform:
         transform = gemmi.Transform()
         transform.mat.fromlist(data['transform_mat'])
         transform.vec.fromlist(data['transform_vec'])
-        return Transform(transform, data['com_reference'], data['com_moving'])
+        return Transform(transform, np.array(data['com_reference']), np.array(data['com_moving']))
 
     def to_json(self, filename):
         data = {
@@ -452,48 +1088,50 @@ class Structure:
                     for atom in residue:
                         yield atom
 
-    def align_to(self, other, rrf=False, chain_id=''):
+    def ca_index(self):
+        '''
+        CAIndex of the structure, built on first use. Only meant for structures that are not modified afterwards,
+        such as the reference of an alignment.
+        :return: CAIndex
+        '''
+        if self.__dict__.get('_ca_index') is None:
+            self._ca_index = CAIndex.from_structure(self.structure)
+        return self._ca_index
+
+    def align_to(self, other, rrf=False, chain_id='', identity_tolerance=None):
         # TODO: CHANGE
         # Warning: inplace!
         # Aligns structures usings carbon alphas and transform self into the frame of the other
+        # identity_tolerance: see transform_to_reference
 
+        other_index = other.ca_index()
         ca_self = []
-        ca_other = []
-        ca_res_self_names = []
-        ca_res_other_names = []
+        ca_keys = []
         # Get CAs
         for model in self.structure:
             for chain in model:
                 if rrf and chain.name not in chain_id:
                     continue
                 else:
+                    # In rrf mode every chain is matched against the first chain of the reference
+                    other_chain = other_index.first_chains.get(model.name) if rrf else chain.name
                     for res_self in chain.get_polymer():
                         if 'LIG' in str(res_self):
                             continue
-                        try:
-                            current_res_id = ResidueID.from_residue_chain(
-                                model, chain, res_self)
-                            if rrf:  # TODO CHANGE?
-                                res_other = other.structure[current_res_id.model][0][current_res_id.insertion][0]
-                            else:
-                                res_other = \
-                                    other.structure[current_res_id.model][current_res_id.chain][current_res_id.insertion][0]
-                            self_ca_pos = res_self["CA"][0].pos
-                            other_ca_pos = res_other["CA"][0].pos
-                            ca_res_self_names.append(res_self)
-                            ca_res_other_names.append(res_other)
-                        except:
+                        self_ca = res_self.find_atom('CA', '*')
+                        if self_ca is None:
                             continue
+                        ca_self.append(Transform.pos_to_list(self_ca.pos))
+                        ca_keys.append((model.name, other_chain, res_self.seqid.num))
 
-                        ca_list_self = Transform.pos_to_list(self_ca_pos)
-                        ca_list_other = Transform.pos_to_list(other_ca_pos)
-
-                        ca_self.append(ca_list_self)
-                        ca_other.append(ca_list_other)
+        # Match the residues to the reference CAs in one go
+        found, ca_other = other_index.lookup(ca_keys)
+        if not np.any(found):
+            raise ValueError('No residue could be matched to a CA of the reference')
 
         # Make coord matricies
-        matrix_self = np.array(ca_self)
-        matrix_other = np.array(ca_other)
+        matrix_self = np.array(ca_self)[found]
+        matrix_other = ca_other[found]
 
         # Find means
         mean_self = np.mean(matrix_self, axis=0)
@@ -516,40 +1154,272 @@ class Structure:
                                                         mean_self,
                                                         )
         # Transform positions
-        for atom in self.all_atoms():
-            atom.pos = transform.apply_inverse(atom.pos)
+        self.transform_to_reference(transform, identity_tolerance=identity_tolerance)
 
         return self, transform
 
+    def transform_to_reference(self, transform, identity_tolerance=None):
+        '''
+        Move every atom into the frame of the reference, inplace.
+        :param transform: Transform from align_to (or Transform.from_json of a stored one).
+        :param identity_tolerance: Optional distance in Angstrom, if no atom would move by more than this the atoms
+            are left as they are.
+        :return: self
+        '''
+        atoms = list(self.all_atoms())
+        current = np.array([Transform.pos_to_list(atom.pos) for atom in atoms], dtype=float).reshape(-1, 3)
+        positions = transform.apply_inverse_many(current)
+        if identity_tolerance is not None and np.all(
+                np.sum((positions - current) ** 2, axis=1) <= identity_tolerance ** 2):
+            return self
+        for atom, position in zip(atoms, positions.tolist()):
+            atom.pos = gemmi.Position(*position)
+        return self
 
-def split_chain_str(f):
-    aa_codes = {'V': 'VAL', 'I': 'ILE', 'L': 'LEU', 'E': 'GLU', 'Q': 'GLN', 'D': 'ASP', 'N': 'ASN', 'H': 'HIS',
-                'W': 'TRP', 'F': 'PHE', 'Y': 'TYR', 'R': 'ARG', 'K': 'LYS', 'S': 'SER', 'T': 'THR', 'M': 'MET',
-                'A': 'ALA', 'G': 'GLY', 'P': 'PRO', 'C': 'CYS'}
-    base_structure = gemmi.read_structure(f)
-    base_models = base_structure[0]
-    all_chains = [x.name for x in base_models]
-    HOH_chains = find_water_chains(f)
-    nonHOH_chains = list(set(all_chains) - set(HOH_chains))
-    chain_centers = {}
-    chain_names = []
-    for i in nonHOH_chains:
-        chain_centers[i] = get_chain_center(chain_name=i, file=f)
-        span = base_structure[0][i].whole()
-        residues = [x.name for x in span]
-        # Possible to convert this to a %age
-        if any([True for v in residues if v in aa_codes.values()]):
-            chain_names.append(i)
-    alt_chains = list(set(nonHOH_chains) - set(chain_names))
-    return list(set(nonHOH_chains) - set(alt_chains))
 
+@dataclasses.dataclass()
+class CAIndex:
+    '''
+    CA positions of a structure keyed by (model name, chain name, residue number), stored as sorted integer keys
+    so that many residues can be looked up at once. The keys follow the gemmi lookups structure[model][chain][num]:
+    first model and chain of a given name, first residue without insertion code of a given number, first CA atom.
+    '''
+    keys: np.ndarray
+    positions: np.ndarray
+    model_ids: dict
+    chain_ids: dict
+    first_chains: dict
 
-def can_rrf(f, r):
-    # Convert to run on Structure class??
-    blosum62 = gemmi.prepare_blosum62_scoring()
-    base_structure = gemmi.read_structure(f)
-    ref_structure = gemmi.read_structure(r)
-    r_s = list(ref_structure[0][0].get_polymer().make_one_letter_sequence())
+    @staticmethod
+    def from_structure(structure):
+        '''
+        :param structure: gemmi.Structure to index.
+        :return: CAIndex
+        '''
+        model_ids = {}
+        chain_ids = {}
+        first_chains = {}
+        codes = []
+        positions = []
+        for model in structure:
+            if model.name in model_ids:
+                continue
+            model_ids[model.name] = len(model_ids)
+            chains_seen = set()
+            for chain in model:
+                first_chains.setdefault(model.name, chain.name)
+                if chain.name in chains_seen:
+                    continue
+                chains_seen.add(chain.name)
+                chain_ids.setdefault(chain.name, len(chain_ids))
+                nums_seen = set()
+                for res in chain:
+                    if res.seqid.icode.strip() or res.seqid.num in nums_seen:
+                        continue
+                    nums_seen.add(res.seqid.num)
+                    ca = res.find_atom('CA', '*')
+                    if ca is None:
+                        continue
+                    codes.append((model_ids[model.name], chain_ids[chain.name], res.seqid.num))
+                    positions.append(Transform.pos_to_list(ca.pos))
+        keys = CAIndex.encode(np.array(codes, dtype=np.int64).reshape(-1, 3))
+        order = np.argsort(keys)
+        return CAIndex(keys[order], np.array(positions).reshape(-1, 3)[order], model_ids, chain_ids, first_chains)
+
+    @staticmethod
+    def encode(codes):
+        '''
+        Pack (model id, chain id, residue number) rows into single int64 keys.
+        :param codes: (N, 3) int64 array.
+        :return: (N,) int64 array.
+        '''
+        return (codes[:, 0] << 48) + (codes[:, 1] << 32) + (codes[:, 2] + 2 ** 31)
+
+    def lookup(self, residue_keys):
+        '''
+        Find the CA positions of many residues.
+        :param residue_keys: list of (model name, chain name, residue number).
+        :return: (found, positions), a (N,) bool array and the (N, 3) CA positions (undefined where not found).
+        '''
+        if len(residue_keys) == 0 or len(self.keys) == 0:
+            return np.zeros(len(residue_keys), dtype=bool), np.zeros((len(residue_keys), 3))
+        codes = np.array([(self.model_ids.get(model, -1), self.chain_ids.get(chain, -1), num)
+                          for model, chain, num in residue_keys], dtype=np.int64)
+        known = (codes[:, 0] >= 0) & (codes[:, 1] >= 0)
+        keys = CAIndex.encode(codes)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = known & (self.keys[rows] == keys)
+        return found, self.positions[rows]
+
+
+@dataclasses.dataclass()
+class StructureContext:
+    '''
+    A pdb file parsed once, together with the chain classification, chain centers and small molecule chain
+    assignments that the alignment helpers (assign_small_mols_to_chains, can_rrf, split_chain_str) would otherwise
+    re-read the file for.
+    The structure held here is never modified, use assign_small_mols_to_chains(context=...) to get a copy to align.
+    '''
+    path: str
+    structure: gemmi.Structure
+    water_chains: list
+    protein_chains: list
+    small_mol_chains: list
+    chain_centers: dict
+    chain_assignments: dict
+
+    @staticmethod
+    def from_file(f):
+        return StructureContext.from_structure(gemmi.read_structure(str(f)), path=str(f))
+
+    @staticmethod
+    def from_structure(structure, path=''):
+        aa_codes = {'V': 'VAL', 'I': 'ILE', 'L': 'LEU', 'E': 'GLU', 'Q': 'GLN', 'D': 'ASP', 'N': 'ASN', 'H': 'HIS',
+                    'W': 'TRP', 'F': 'PHE', 'Y': 'TYR', 'R': 'ARG', 'K': 'LYS', 'S': 'SER', 'T': 'THR', 'M': 'MET',
+                    'A': 'ALA', 'G': 'GLY', 'P': 'PRO', 'C': 'CYS'}
+        model = structure[0]
+        all_chains = list(dict.fromkeys([x.name for x in model]))
+        water_chains = find_water_chains(structure=structure)
+        nonHOH_chains = [x for x in all_chains if x not in water_chains]
+        chain_centers = {}
+        chain_names = []
+        # From nonHOH chains, identify if they contain any aminoacids, if they do. Assume they are full chains.
+        # else, they will be attached to nearest chain by center.
+        for i in nonHOH_chains:
+            chain_centers[i] = get_chain_center(chain_name=i, structure=structure)
+            residues = [x.name for x in model[i].whole()]
+            if any([True for v in residues if v in aa_codes.values()]):
+                chain_names.append(i)
+        alt_chains = [x for x in nonHOH_chains if x not in chain_names]
+        return StructureContext(path=path,
+                                structure=structure,
+                                water_chains=water_chains,
+                                protein_chains=chain_names,
+                                small_mol_chains=alt_chains,
+                                chain_centers=chain_centers,
+                                chain_assignments=contact_chain_assignments(structure, chain_names, alt_chains,
+                                                                            chain_centers))
+
+
+def contact_chain_assignments(structure, protein_chains, small_mol_chains, chain_centers, contact_distance=4.0):
+    '''
+    Find the protein chain each small molecule chain belongs to: the protein chain with the most atoms in contact with
+    the atoms of the small molecule chain, ties going to the closest contact. Chains without any contact fall back to
+    the protein chain with the nearest center of mass.
+    A single KD-tree of the protein atoms is built and queried with the atoms of all the small molecule chains at once.
+    :param structure: gemmi structure.
+    :param protein_chains: Names of the chains containing amino acids.
+    :param small_mol_chains: Names of the other non water chains.
+    :param chain_centers: Dict of chain name to center of mass, for the fallback.
+    :param contact_distance: Distance (in Angstrom) below which two atoms are in contact.
+    :return: Dict of small molecule chain name to protein chain name, chains that cannot be assigned are left out.
+    '''
+    assignments = {}
+    if not protein_chains or not small_mol_chains:
+        return assignments
+
+    def atom_positions(names):
+        positions = []
+        labels = []
+        for chain in structure[0]:
+            if chain.name in names:
+                for residue in chain:
+                    for atom in residue:
+                        positions.append([atom.pos.x, atom.pos.y, atom.pos.z])
+                        labels.append(chain.name)
+        return np.array(positions, dtype=float).reshape(-1, 3), np.array(labels, dtype=object)
+
+    protein_positions, protein_labels = atom_positions(set(protein_chains))
+    small_mol_positions, small_mol_labels = atom_positions(set(small_mol_chains))
+    contacts = {}
+    if len(protein_positions) and len(small_mol_positions):
+        tree = spatial.cKDTree(protein_positions)
+        distances, indices = tree.query(small_mol_positions, distance_upper_bound=contact_distance)
+        for small_mol_chain, distance, index in zip(small_mol_labels, distances, indices):
+            if np.isfinite(distance):
+                count, closest = contacts.setdefault(small_mol_chain, {}).get(protein_labels[index], (0, np.inf))
+                contacts[small_mol_chain][protein_labels[index]] = (count + 1, min(closest, distance))
+
+    for j in small_mol_chains:
+        if j in contacts:
+            assignments[j] = max(contacts[j], key=lambda z: (contacts[j][z][0], -contacts[j][z][1]))
+        else:
+            chain_dists = {z: chain_centers[j].dist(chain_centers[z]) for z in protein_chains}
+            assignments[j] = min(chain_dists, key=chain_dists.get)
+    return assignments
+
+
+def split_chain_str(f, context=None):
+    '''
+    Find the names of the chains in a pdb file that contain amino acids.
+    :param f: File name of the pdb file.
+    :param context: Optional StructureContext of f, if given f is not read from disk.
+    :return: A list of protein chain names.
+    '''
+    if context is None:
+        context = StructureContext.from_file(f)
+    return list(context.protein_chains)
+
+
+class SequenceScoreCache:
+    '''
+    Blosum62 scoring, reference sequences and alignment scores for can_rrf, shared by all the crystals of a target.
+    Scores are memoised by (chain sequence, reference sequence), so each distinct chain is only aligned once.
+    '''
+
+    def __init__(self):
+        self._blosum62 = None
+        self._reference_sequences = {}
+        self._scores = {}
+
+    def reference_sequence(self, ref_structure):
+        '''
+        :param ref_structure: gemmi.Structure of the reference.
+        :return: One letter sequence of the polymer of the first chain of the reference.
+        '''
+        key = id(ref_structure)
+        if key not in self._reference_sequences:
+            # Keep the structure alive so that its id cannot be reused by another structure
+            self._reference_sequences[key] = (ref_structure,
+                                              ref_structure[0][0].get_polymer().make_one_letter_sequence())
+        return self._reference_sequences[key][1]
+
+    def score(self, sequence, reference_sequence):
+        '''
+        :param sequence: One letter sequence of a chain.
+        :param reference_sequence: One letter sequence of the reference chain.
+        :return: Score of the global alignment of the two sequences with blosum62.
+        '''
+        key = (sequence, reference_sequence)
+        if key not in self._scores:
+            if self._blosum62 is None:
+                self._blosum62 = gemmi.prepare_blosum62_scoring()
+            self._scores[key] = gemmi.align_string_sequences(
+                list(sequence), list(reference_sequence), [], self._blosum62).score
+        return self._scores[key]
+
+
+def can_rrf(f, r, context=None, reference=None, sequence_cache=None):
+    '''
+    Check whether every liganded chain of a pdb file can be aligned to the first chain of the reference.
+    :param f: File name of the pdb file.
+    :param r: File name of the reference pdb file.
+    :param context: Optional StructureContext of f, if given f is not read from disk.
+    :param reference: Optional parsed reference (anything with a gemmi .structure), if given r is not read from disk.
+    :param sequence_cache: Optional SequenceScoreCache shared by the crystals aligned to the same reference.
+    :return: Bool, True if all liganded chains score positively against the reference.
+    '''
+    if sequence_cache is None:
+        sequence_cache = SequenceScoreCache()
+    if context is None:
+        base_structure = gemmi.read_structure(f)
+    else:
+        base_structure = context.structure
+    if reference is None:
+        ref_structure = gemmi.read_structure(r)
+    else:
+        ref_structure = reference.structure
+    r_s = sequence_cache.reference_sequence(ref_structure)
     # Find chains with ligands...
     model = base_structure[0]
     liganded_chains = []
@@ -560,45 +1430,30 @@ def can_rrf(f, r):
             if 'LIG' in res.name:
                 action = True
         if action:
-            liganded_chains.append(
-                list(chain.get_polymer().make_one_letter_sequence()))
+            liganded_chains.append(chain.get_polymer().make_one_letter_sequence())
     # Compare chains to A of reference... if first chain cannot alo?
-    scores = [gemmi.align_string_sequences(
-        x, r_s, [], blosum62).score for x in liganded_chains]
+    scores = [sequence_cache.score(x, r_s) for x in liganded_chains]
     return all([x > 0 for x in scores])
 
 
-def assign_small_mols_to_chains(f):
-    # Return a gemmi file???
-    aa_codes = {'V': 'VAL', 'I': 'ILE', 'L': 'LEU', 'E': 'GLU', 'Q': 'GLN', 'D': 'ASP', 'N': 'ASN', 'H': 'HIS',
-                'W': 'TRP', 'F': 'PHE', 'Y': 'TYR', 'R': 'ARG', 'K': 'LYS', 'S': 'SER', 'T': 'THR', 'M': 'MET',
-                'A': 'ALA', 'G': 'GLY', 'P': 'PRO', 'C': 'CYS'}
-    base_structure = gemmi.read_structure(f)
-    base_models = base_structure[0]
-    all_chains = [x.name for x in base_models]
-    HOH_chains = find_water_chains(f)
-    nonHOH_chains = list(set(all_chains) - set(HOH_chains))
-    chain_centers = {}
-    chain_names = []
-    for i in nonHOH_chains:
-        chain_centers[i] = get_chain_center(chain_name=i, file=f)
-        span = base_structure[0][i].whole()
-        residues = [x.name for x in span]
-        # Possible to convert this to a %age
-        if any([True for v in residues if v in aa_codes.values()]):
-            chain_names.append(i)
-    alt_chains = list(set(nonHOH_chains) - set(chain_names))
-    temp = gemmi.read_structure(f)
-    for j in alt_chains:
-        chain_dists = {}
-        for z in chain_names:
-            chain_dists[z] = chain_centers[j].dist(chain_centers[z])
+def assign_small_mols_to_chains(f=None, context=None):
+    '''
+    Rename every non-water chain that contains no amino acids to the protein chain it is in contact with (or the one
+    with the nearest center of mass if it contacts none, see contact_chain_assignments) and merge the chain parts.
+    :param f: File name of the pdb file.
+    :param context: Optional StructureContext of f, if given the structure is cloned rather than read from disk.
+    :return: A Structure with the small molecule chains assigned to protein chains.
+    '''
+    if context is None:
+        context = StructureContext.from_file(f)
+    chain_names = context.protein_chains
+    temp = context.structure.clone()
+    for j in context.small_mol_chains:
         try:
-            temp[0][j].name = min(chain_dists, key=chain_dists.get)
+            temp[0][j].name = context.chain_assignments[j]
         except:
-            print(f'Cannot compress {j} to {chain_names} in {f}')
-    struc = Structure.from_file(Path(f))
-    struc.structure = temp
+            print(f'Cannot compress {j} to {chain_names} in {context.path}')
+    struc = Structure(temp)
     struc.structure.merge_chain_parts()
     # clean up...
     for chain in struc.structure[0]:
@@ -659,176 +1514,32 @@ def split_chains(f):
     return filenames
 
 
-def get_chain_center(chain_name, file):
+def get_chain_center(chain_name, file=None, structure=None):
     '''
     Calculate the center of mass for a particular chain within a particular pdb file
     :param chain_name: Name of the chain
     :param file: Filepath of pdb file.
+    :param structure: Optional gemmi structure of file, if given file is not read from disk.
     :return: The center of mass of the specified chain.
     '''
-    structure = gemmi.read_pdb(file)[0]
-    names = [x.name for x in structure]
-    for i in names:
-        if i == chain_name:
-            continue
-        else:
-            structure.remove_chain(i)
-    return structure.calculate_center_of_mass()
+    if structure is None:
+        structure = gemmi.read_pdb(file)
+    model = gemmi.Model(structure[0].name)
+    for chain in structure[0]:
+        if chain.name == chain_name:
+            model.add_chain(chain)
+    return model.calculate_center_of_mass()
 
 
-def find_water_chains(file):
+def find_water_chains(file=None, structure=None):
     '''
     Find which chain(s) contain only water molecules
     :param file: A pdb file name.
+    :param structure: Optional gemmi structure of file, if given file is not read from disk.
     :return: A list of chains that contain water
     '''
-    structure = gemmi.read_pdb(file)
+    if structure is None:
+        structure = gemmi.read_pdb(file)
     old = [x.name for x in structure[0]]
-    structure.remove_waters()
-    structure.remove_empty_chains()
-    new = [x.name for x in structure[0]]
+    new = [x.name for x in structure[0] if not all([res.is_water() for res in x])]
     return list(set(old) - set(new))
-
-
-def resample(
-        moving_xmap: Xmap,
-        transform: Transform,
-        reference_structure: Structure
-):
-    interpolated_grid = gridFromTemplate(moving_xmap)
-    mask = gemmi.FloatGrid(moving_xmap.xmap.nu,
-                           moving_xmap.xmap.nv,
-                           moving_xmap.xmap.nw, )
-    mask.set_unit_cell(moving_xmap.xmap.unit_cell)
-    mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-
-    for model in reference_structure.structure:
-        for chain in model:
-            for residue in chain.get_polymer():
-                for atom in residue:
-                    mask.set_points_around(atom.pos, 5.0, 1.0)
-
-    mask_array = np.array(mask)
-    mask_indicies = np.hstack([x.reshape((len(x), 1))
-                              for x in np.nonzero(mask)])
-    fractional_coords = []
-    for model in reference_structure.structure:
-        for chain in model:
-            for residue in chain.get_polymer():
-                for atom in residue:
-                    fractional = moving_xmap.xmap.unit_cell.fractionalize(
-                        atom.pos)
-                    fractional_coords.append(
-                        [fractional.x, fractional.y, fractional.z])
-
-    fractional_coords_array = np.array(fractional_coords)
-    max_coord = np.max(fractional_coords_array, axis=0)
-    min_coord = np.min(fractional_coords_array, axis=0)
-
-    min_index = np.floor(
-        min_coord * np.array([interpolated_grid.nu, interpolated_grid.nv, interpolated_grid.nw]))
-    max_index = np.floor(
-        max_coord * np.array([interpolated_grid.nu, interpolated_grid.nv, interpolated_grid.nw]))
-
-    points = itertools.product(range(int(min_index[0]), int(max_index[0])),
-                               range(int(min_index[1]), int(max_index[1])),
-                               range(int(min_index[2]), int(max_index[2])),
-                               )
-
-    # Unpack the points, poitions and transforms
-    point_list: List[Tuple[int, int, int]] = []
-    position_list: List[Tuple[float, float, float]] = []
-    transform_list: List[gemmi.transform] = []
-    com_moving_list: List[np.array] = []
-    com_reference_list: List[np.array] = []
-
-    transform_rotate_reference_to_moving = transform.transform
-    transform_rotate_reference_to_moving.vec.fromlist([0.0, 0.0, 0.0])
-
-    transform_reference_to_centered = gemmi.Transform()
-    transform_reference_to_centered.vec.fromlist(
-        (-transform.com_reference).tolist())
-    transform_reference_to_centered.mat.fromlist(np.eye(3).tolist())
-
-    transform_centered_to_moving = gemmi.Transform()
-    transform_centered_to_moving.vec.fromlist(transform.com_moving.tolist())
-    transform_centered_to_moving.mat.fromlist(np.eye(3).tolist())
-
-    # indicies to positions
-    #   mask_array = np.array(mask)
-    # mask_indicies = np.hstack([x.reshape((len(x), 1))
-    #                          for x in np.nonzero(mask)])
-    #points2 = [x for x in points]
-    #ma, mb, mc = zip(*mask_indicies)
-    ##sma = set(ma)
-    #smb = set(mb)
-    #smc = set(mc)
-    #points_filtered = [(x, y, z) for x, y, z in points2 if x in sma and y in smb and z in smc]
-    for point in points:  # points_filtered:
-
-        position = interpolated_grid.point_to_position(
-            interpolated_grid.get_point(point[0], point[1], point[2]))
-
-        if mask.interpolate_value(position) <= 0:
-            continue
-        # Tranform to origin frame
-        trtc = transform_reference_to_centered.apply(position)
-        position_origin_reference = gemmi.Position(trtc[0], trtc[1], trtc[2])
-
-        # Rotate
-        trrtm = transform_rotate_reference_to_moving.apply(
-            position_origin_reference)
-        position_origin_moving = gemmi.Position(trrtm[0], trrtm[1], trrtm[2])
-
-        # Transform to moving frame
-        tctm = transform_centered_to_moving.apply(position_origin_moving)
-        position_moving = gemmi.Position(tctm[0], tctm[1], tctm[2])
-
-        # Interpolate moving map
-        interpolated_map_value = moving_xmap.xmap.interpolate_value(
-            position_moving)
-
-        # Set original point
-        interpolated_grid.set_value(
-            point[0], point[1], point[2], interpolated_map_value)
-
-    # interpolated_grid.symmetrize_max()
-    interpolated_array = np.array(interpolated_grid)
-
-    interpolated_grid_neg = gridFromTemplate(moving_xmap)
-    interpolated_array_neg = np.array(interpolated_grid_neg, copy=False)
-    interpolated_array_neg[:, :, :] = -interpolated_array[:, :, :]
-    interpolated_grid_neg.symmetrize_max()
-
-    interpolated_grid_pos = gridFromTemplate(moving_xmap)
-    interpolated_array_pos = np.array(interpolated_grid_pos, copy=False)
-    interpolated_array_pos[:, :, :] = interpolated_array[:, :, :]
-    interpolated_grid_pos.symmetrize_max()
-
-    interpolated_grid_sym = gridFromTemplate(moving_xmap)
-    interpolated_array_sym = np.array(interpolated_grid_sym, copy=False)
-    interpolated_array_sym[:, :, :] = interpolated_array_pos[:,
-                                                             :, :] - interpolated_array_neg[:, :, :]
-
-    return Xmap(interpolated_grid_sym)
-
-
-def referenceSave(template_map_path, xmap, path_to_save):
-    # Open Template map
-    ccp4 = gemmi.read_ccp4_map(str(template_map_path))
-    ccp4.setup()
-    # Replace Template map data
-    ccp4.grid = xmap.xmap
-    ccp4.setup()
-    # Save Template Map...
-    ccp4.write_ccp4_map(str(path_to_save))
-
-
-def gridFromTemplate(template):
-    interpolated_grid = gemmi.FloatGrid(
-        template.xmap.nu,
-        template.xmap.nv,
-        template.xmap.nw, )
-    interpolated_grid.set_unit_cell(template.xmap.unit_cell)
-    interpolated_grid.spacegroup = template.xmap.spacegroup
-    return interpolated_grid
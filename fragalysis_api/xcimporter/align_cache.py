@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Bumped whenever the files written by Align.align_crystal change for the same inputs
+cache_version = 2
+
+
+def file_sha1(file):
+    '''
+    :param file: file path.
+    :return: hex sha1 of the content of file.
+    '''
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class AlignmentCache:
+    '''
+    Content addressed store of the files Align.align_crystal writes for a crystal (bound pdbs, transforms, smiles and
+    resampled maps). Entries are keyed by the sha1 of everything the output depends on (see key), so re-importing a
+    target only aligns the new or changed crystals.
+    Each entry is a directory directory/<key> holding the files and a files.json listing them. Entries are written to
+    a temporary directory first and renamed into place, so a crashed run or parallel workers never leave a partial
+    entry.
+    '''
+
+    def __init__(self, directory, link=True):
+        '''
+        :param directory: Directory of the cache, created if it does not exist.
+        :param link: Bool, if True restored files are hardlinked to the cache when possible (so they must only be
+            replaced, not modified in place), otherwise they are copied.
+        '''
+        self.directory = directory
+        self.link = link
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(in_file, map_files, reference_file, smiles_file=None, **options):
+        '''
+        :param in_file: Filepath of the pdb of the crystal.
+        :param map_files: Filepaths of the maps of the crystal.
+        :param reference_file: Filepath of the reference pdb.
+        :param smiles_file: Filepath of the smiles of the crystal, if any.
+        :param options: Any other option changing the output (e.g. rrf, sr, map_encoding), must be json serialisable.
+        :return: str, hex sha1 identifying the output of the alignment.
+        '''
+        content = {'version': cache_version,
+                   'pdb': file_sha1(in_file),
+                   'maps': sorted([os.path.basename(x), file_sha1(x)] for x in map_files),
+                   'reference': file_sha1(reference_file),
+                   'smiles': None if smiles_file is None else file_sha1(smiles_file),
+                   'options': options}
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def has(self, key):
+        '''
+        :param key: Key of the entry, see key.
+        :return: Bool, True if there is an entry for key.
+        '''
+        return os.path.isfile(os.path.join(self.directory, key, 'files.json'))
+
+    def restore(self, key, out_dir):
+        '''
+        Put the files of an entry in out_dir.
+        :param key: Key of the entry, see key.
+        :param out_dir: Output directory.
+        :return: list of the filepaths restored, or None if there is no entry for key.
+        '''
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'files.json')) as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        restored = []
+        for file in files:
+            path = os.path.join(out_dir, file)
+            if os.path.lexists(path):
+                os.remove(path)
+            linked = False
+            if self.link:
+                try:
+                    os.link(os.path.join(entry, file), path)
+                    linked = True
+                except OSError:
+                    # Not allowed or the cache is on another filesystem
+                    pass
+            if not linked:
+                shutil.copyfile(os.path.join(entry, file), path)
+            restored.append(path)
+        return restored
+
+    def store(self, key, files):
+        '''
+        Add an entry, unless there already is one for key.
+        :param key: Key of the entry, see key.
+        :param files: Filepaths of the output files, they are copied into the cache.
+        '''
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+        tmp = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.directory)
+        try:
+            names = []
+            for file in files:
+                name = os.path.basename(file)
+                shutil.copyfile(file, os.path.join(tmp, name))
+                names.append(name)
+            with open(os.path.join(tmp, 'files.json'), 'w') as f:
+                json.dump(names, f)
+            os.rename(tmp, entry)
+        except OSError:
+            # Stored in the meantime by another process (or the cache cannot be written), nothing to keep
+            shutil.rmtree(tmp, ignore_errors=True)
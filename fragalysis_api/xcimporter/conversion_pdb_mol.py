@@ -16,10 +16,14 @@ import gemmi
 import shutil
 import re
 
+from fragalysis_api.xcimporter import map_io
+
 
 class Ligand:
-    def __init__(self, target_name, infile, RESULTS_DIRECTORY):
+    def __init__(self, target_name, infile, RESULTS_DIRECTORY, pdb_lines=None, name=None):
         self.infile = infile
+        # Base of the ligand names, e.g. x0001_A in rrf mode (infile x0001_A_bound.pdb)
+        self.name = os.path.basename(infile).replace(".pdb", "").replace("_bound", "") if name is None else name
         self.target_name = target_name
         self.mol_lst = []
         self.mol_dict = {"directory": [], "mol": [], "file_base": []}
@@ -27,7 +31,8 @@ class Ligand:
         self.non_ligs = json.load(
             open(os.path.join(os.path.dirname(__file__), "non_ligs.json"), "r")
         )
-        self.pdbfile = open(os.path.abspath(infile)).readlines()
+        # Lines of infile, unless they are given (then infile may be None)
+        self.pdbfile = open(os.path.abspath(infile)).readlines() if pdb_lines is None else pdb_lines
         self.hetatms = []
         self.conects = []
         self.final_hets = []
@@ -77,7 +82,7 @@ class Ligand:
 
         for lig in all_ligands:
             if rrf:
-                if not os.path.basename(self.infile).rsplit('_', 2)[1][0] == lig[21]:
+                if not self.name.rsplit('_', 1)[1][0] == lig[21]:
                     continue
             if lig[17:20].strip() not in self.non_ligs:
                 self.wanted_ligs.append(lig[16:20].strip() + lig[20:26])
@@ -226,11 +231,12 @@ class Ligand:
         # out directory and filename for lig pdb
         # This can be optimised... (probably easier to just infer targetname??)
 
-        if self.target_name in os.path.abspath(self.infile):
-            file_base = f'{os.path.abspath(self.infile).split("/")[-1].replace(".pdb", "").replace("_bound", "")}'
+        # Crystals named explicitly come straight from the alignment, named as the files of tmp{target_name}
+        if self.infile is None or self.target_name in os.path.abspath(self.infile):
+            file_base = f'{self.name}'
         else:
             # Add target name to file_base?
-            file_base = f'{self.target_name}-{os.path.abspath(self.infile).split("/")[-1].replace(".pdb", "").replace("_bound", "")}'
+            file_base = f'{self.target_name}-{self.name}'
         if reduce:
             chain = file_base.split("_")[-1]
             file_base = file_base[:-2]  # remove _chainname from end?
@@ -401,9 +407,9 @@ class Ligand:
 
 
 class pdb_apo:
-    def __init__(self, infile, target_name, RESULTS_DIRECTORY, filebase, biomol=None):
+    def __init__(self, infile, target_name, RESULTS_DIRECTORY, filebase, biomol=None, pdb_lines=None):
         self.target_name = target_name
-        self.pdbfile = open(infile).readlines()
+        self.pdbfile = open(infile).readlines() if pdb_lines is None else pdb_lines
         self.RESULTS_DIRECTORY = RESULTS_DIRECTORY
         self.filebase = filebase
         self.non_ligs = json.load(
@@ -510,17 +516,62 @@ class pdb_apo:
         prot_file.close()
 
 
-def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, covalent=False, keep_headers=False):
+def write_map_cutout(ccp4, positions, margin, path, encoding=None):
+    """
+    Write the box of a map around some positions. The box keeps the grid, cell and origin of the full map.
+    :param ccp4: gemmi.Ccp4Map of the full cell, after setup(). It is not modified.
+    :param positions: (N, 3) array of orthogonal coordinates, e.g. the atoms of a ligand.
+    :param margin: Margin (in Angstrom) added around the positions.
+    :param path: Filepath of the map to write.
+    :param encoding: None or one of map_io.map_encodings, compressed cutouts are written to path.gz.
+    """
+    low = np.min(positions, axis=0) - margin
+    high = np.max(positions, axis=0) + margin
+    map_io.write_map_box(ccp4.grid, low, high, path, encoding=encoding)
+
+
+def write_aligned_files(aligned, directory, name, positions, map_margin=None, map_encoding=None):
+    """
+    Write the transform and maps of an aligned crystal for one of its ligands, as set_up copies them from the
+    aligned files.
+    :param aligned: align.AlignedCrystal
+    :param directory: Directory of the ligand.
+    :param name: Name replacing aligned.name in the filenames.
+    :param positions: (N, 3) array of the ligand atoms positions, for the map cutouts.
+    :param map_margin: Float, if given the maps are cut to a box of map_margin Angstrom around the ligand.
+    :param map_encoding: None or one of map_io.map_encodings.
+    """
+    aligned.transform.to_json(filename=os.path.join(directory, f'{name}_transform.json'))
+    for map_name in aligned.maps:
+        path = os.path.join(directory, map_name.replace(aligned.name, name))
+        if map_margin is None:
+            aligned.write_map(map_name, path, encoding=map_encoding)
+        else:
+            # As the cutouts of the written maps (see write_map_cutout), compressed but not quantised
+            aligned.write_map_cutout(map_name, low=np.min(positions, axis=0) - float(map_margin),
+                                     high=np.max(positions, axis=0) + float(map_margin), path=path,
+                                     encoding=None if map_encoding is None else 'gzip')
+
+
+def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, covalent=False, keep_headers=False,
+           map_margin=None, aligned=None, map_encoding=None, name=None):
     """
     For each ligand inside a pdb file, process each ligand seperately and create own outputs in individual folders.
     :param target_name: Name of the folder in out_dir
-    :param infile: pdb file to be processed
+    :param infile: pdb file to be processed, or None if aligned is given
     :param out_dir: Overall location of outputs
     :param rrf: Bool, indicate whether or not data is to be set to a single reference frame
     :param smiles_file: Filepath pointing to text file containing smiles string (if exists)
     :param biomol: Filepath pointing to text file containing biomol/header information for pdbs (if exists)
     :param covalent: Bool, indicate whether or not output mol files should find covalent attachment.
     :param keep_headers: Bool, indicate whether or not keep headers on apo files.
+    :param map_margin: Float, if given the maps are cut to a box of map_margin Angstrom around each ligand instead
+        of being copied in full to every ligand directory.
+    :param aligned: Optional align.AlignedCrystal, straight from Align.aligned_crystals. The aligned pdb, transform
+        and maps are then taken from it and written directly to the ligand directories instead of read from infile.
+    :param map_encoding: None or one of map_io.map_encodings, the encoding of the maps written from aligned.
+    :param name: Name the ligands are named after (e.g. x0001_A in rrf mode), by default the name of infile without
+        _bound.pdb. Required when infile is None.
     :return: for each ligand: pdb, mol, sdf and _apo.pdb in seperate directorys inside out_dir/target_name
     """
     RESULTS_DIRECTORY = os.path.join(out_dir, target_name, 'aligned')
@@ -528,9 +579,12 @@ def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, cov
         os.makedirs(RESULTS_DIRECTORY)
     # if the input is _bound.pdb and not _A_bound.pdb to indicate rrf mode hasnt been used...
     # This will need cleaning up...
-    rrf = len(infile.rsplit('_')[-2]) == 1
+    if name is None:
+        name = os.path.basename(infile).replace(".pdb", "").replace("_bound", "")
+    rrf = len(name.rsplit('_')[-1]) == 1
+    pdb_lines = None if aligned is None else aligned.pdb_lines()
     new = Ligand(
-        target_name, infile, RESULTS_DIRECTORY
+        target_name, infile, RESULTS_DIRECTORY, pdb_lines=pdb_lines, name=name
     )  # takes in pdb file and returns specific ligand files
     new.hets_and_cons()  # takes only hetatm and conect file lines from pdb file
     new.remove_nonligands()  # removes ions and solvents from list of ligands
@@ -540,6 +594,7 @@ def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, cov
         new.create_pdb_for_ligand(
             new.wanted_ligs[i], count=i, reduce=rrf, smiles_file=smiles_file, covalent=covalent
         )  # creates pdb file and mol object for specific ligand
+    maps = {}  # maps read for the cutouts, shared by all the ligands
     for i in range(len(new.mol_dict["directory"])):
         if not new.mol_dict["mol"][i]:
             warnings.warn(
@@ -550,21 +605,49 @@ def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, cov
                 )
             )
             continue
-        shutil.copy(infile,
-                    os.path.join(new.mol_dict["directory"][i], str(new.mol_dict["file_base"][i] + "_bound.pdb")))
-
-        inpath = infile.replace('_bound.pdb', '')
-        basebase = os.path.basename(inpath)
-        fofcmap_files = glob.glob(f'{inpath}_*.map')
-        event_files = glob.glob(f'{inpath}_*.ccp4')
-        json_files = glob.glob(f'{inpath}_*.json')
-        other_files = fofcmap_files + event_files + json_files
+        bound_file = os.path.join(new.mol_dict["directory"][i], str(new.mol_dict["file_base"][i] + "_bound.pdb"))
+        if aligned is None:
+            shutil.copy(infile, bound_file)
+        else:
+            with open(bound_file, 'w') as f:
+                f.writelines(pdb_lines)
+
+        if aligned is not None:
+            # Straight from the alignment, there are no aligned files to copy
+            write_aligned_files(aligned=aligned,
+                                directory=new.mol_dict["directory"][i],
+                                name=new.mol_dict["file_base"][i],
+                                positions=new.mol_dict["mol"][i].GetConformer().GetPositions(),
+                                map_margin=map_margin,
+                                map_encoding=map_encoding)
+            other_files = []
+        else:
+            inpath = infile.replace('_bound.pdb', '')
+            basebase = os.path.basename(inpath)
+            # Aligned maps may have been written compressed (map_io), these are .map.gz/.ccp4.gz
+            fofcmap_files = glob.glob(f'{inpath}_*.map') + glob.glob(f'{inpath}_*.map.gz')
+            event_files = glob.glob(f'{inpath}_*.ccp4') + glob.glob(f'{inpath}_*.ccp4.gz')
+            json_files = glob.glob(f'{inpath}_*.json')
+            other_files = fofcmap_files + event_files + json_files
         for other_file in other_files:
             other_base = os.path.basename(other_file)
             other_base = other_base.replace(
                 basebase, new.mol_dict["file_base"][i])
-            shutil.copy(other_file,
-                        os.path.join(new.mol_dict["directory"][i], other_base))
+            if map_margin is not None and other_file not in json_files:
+                if other_file not in maps:
+                    maps[other_file] = map_io.read_ccp4_map(other_file)
+                    maps[other_file].setup()
+                # Cutouts of compressed maps are compressed too (quantised maps are cut as floats)
+                compressed = other_base.endswith('.gz')
+                write_map_cutout(ccp4=maps[other_file],
+                                 positions=new.mol_dict["mol"][i].GetConformer().GetPositions(),
+                                 margin=float(map_margin),
+                                 path=os.path.join(new.mol_dict["directory"][i],
+                                                   other_base[:-len('.gz')] if compressed else other_base),
+                                 encoding='gzip' if compressed else None)
+            else:
+                shutil.copy(other_file,
+                            os.path.join(new.mol_dict["directory"][i], other_base))
         new_mol = new.create_mol_file(
             directory=new.mol_dict["directory"][i],
             file_base=new.mol_dict["file_base"][i],
@@ -592,7 +675,8 @@ def set_up(target_name, infile, out_dir, rrf, smiles_file=None, biomol=None, cov
             target_name,
             new.mol_dict["directory"][i],
             new.mol_dict["file_base"][i],
-            biomol=biomol
+            biomol=biomol,
+            pdb_lines=pdb_lines
         )
         # creates pdb file that doesn't contain any ligand information
         new_apo.make_apo_file(keep_headers=keep_headers)
@@ -0,0 +1,364 @@
+import gzip
+import io
+import itertools
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import gemmi
+import numpy as np
+
+# Encodings of the aligned maps, see write_ccp4_map
+map_encodings = ['gzip', 'int16', 'int8']
+# Start of the header label written to quantised maps, followed by the scale and offset of the data
+quantised_label = 'FRAGALYSIS QUANTISED'
+# Numpy type and largest value of the data of each ccp4 mode
+mode_dtypes = {0: '<i1', 1: '<i2', 2: '<f4', 6: '<u2'}
+quantised_modes = {'int8': (0, 127), 'int16': (1, 32767)}
+
+
+def encoded_path(path, encoding=None):
+    """
+    Filepath a map is written to with an encoding.
+    :param path: Filepath of the uncompressed map.
+    :param encoding: None or one of map_encodings.
+    :return: str, path with .gz appended for the compressed encodings.
+    """
+    if encoding is None:
+        return str(path)
+    return f'{path}.gz'
+
+
+def write_ccp4_map(ccp4, path, encoding=None, jobs=1, chunk_size=2 ** 24):
+    """
+    Write a map, optionally gzip compressed and quantised.
+    - None: plain ccp4, as gemmi.Ccp4Map.write_ccp4_map.
+    - 'gzip': the same file compressed into path.gz.
+    - 'int16'/'int8': the data is stored as mode 1/0 integers (value = offset + scale * integer), with the scale and
+      offset in a header label, then compressed into path.gz. Use read_ccp4_map to read them back as floats.
+    The compressed file is made of independent gzip members of chunk_size bytes, so it can be compressed by several
+    threads and is still read as one stream by gzip and gemmi.
+    :param ccp4: gemmi.Ccp4Map with its header, it is not modified.
+    :param path: Filepath of the uncompressed map.
+    :param encoding: None or one of map_encodings.
+    :param jobs: Number of threads compressing the chunks.
+    :param chunk_size: Size in bytes of the uncompressed chunks.
+    :return: str, filepath written.
+    """
+    if encoding is None:
+        ccp4.write_ccp4_map(str(path))
+        return str(path)
+    return write_ccp4_data(header_words(ccp4), np.array(ccp4.grid, copy=False), path, encoding=encoding, jobs=jobs,
+                           chunk_size=chunk_size)
+
+
+def header_words(ccp4):
+    """
+    :param ccp4: gemmi.Ccp4Map
+    :return: np.array of the header words of the map, including the symmetry records.
+    """
+    return np.array([ccp4.header_i32(w) for w in range(1, 257 + ccp4.header_i32(24) // 4)], dtype='<i4')
+
+
+def write_ccp4_data(words, data, path, encoding=None, jobs=1, chunk_size=2 ** 24):
+    """
+    Write a map from its header words and data, see write_ccp4_map. The data is converted one chunk at a time, so
+    it can be a np.memmap larger than the memory. The quantised encodings scan the values before writing them:
+    at once for a np.ndarray held in memory, slab by slab (of the chunks) otherwise, see quantise_slabs.
+    :param words: np.array of the header words (including the symmetry records), it is not modified.
+    :param data: (nu, nv, nw) array of the map values, in the axis order of the header, or any object with a shape
+        that returns them for [:, :, start:stop] slices.
+    :param path: Filepath of the uncompressed map.
+    :param encoding: None or one of map_encodings.
+    :param jobs: Number of threads compressing the chunks.
+    :param chunk_size: Size in bytes of the uncompressed chunks.
+    :return: str, filepath written.
+    """
+    if encoding is not None and encoding not in map_encodings:
+        raise ValueError(f'Unknown map encoding {encoding}, use one of {map_encodings}')
+    words = np.array(words, dtype='<i4')
+    mode = quantised_modes[encoding][0] if encoding in quantised_modes else int(words[4 - 1])
+    dtype = mode_dtypes[mode]
+    # Sections (w) are the slowest axis of the file, u the fastest
+    step = max(1, chunk_size // max(1, data.shape[0] * data.shape[1] * np.dtype(dtype).itemsize))
+    if encoding in quantised_modes:
+        if isinstance(data, np.ndarray) and not isinstance(data, np.memmap):
+            mode, data = quantise(data, encoding, words)
+        else:
+            mode, data = quantise_slabs(data, encoding, words, step)
+
+    def chunks():
+        yield words.tobytes()
+        for start in range(0, data.shape[2], step):
+            yield data[:, :, start:start + step].astype(dtype).tobytes(order='F')
+
+    out_path = encoded_path(path, encoding)
+    with open(out_path, 'wb') as f:
+        if encoding is None:
+            f.writelines(chunks())
+        elif int(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=int(jobs)) as pool:
+                batch = []
+                for chunk in chunks():
+                    batch.append(chunk)
+                    if len(batch) == int(jobs):
+                        f.writelines(pool.map(compress, batch))
+                        batch = []
+                f.writelines(pool.map(compress, batch))
+        else:
+            for chunk in chunks():
+                f.write(compress(chunk))
+    return out_path
+
+
+def box_extent(unit_cell, shape, low, high):
+    """
+    Grid indices of the box between two orthogonal corners, rounded inwards as gemmi.Ccp4Map.set_extent does.
+    :param unit_cell: gemmi.UnitCell of the map.
+    :param shape: (nu, nv, nw) of the grid of the full cell.
+    :param low: Lowest orthogonal coordinates of the box.
+    :param high: Highest orthogonal coordinates of the box.
+    :return: (start, size) integer arrays: the grid index of the first point of the box (it may lie outside the
+        cell, the box wraps around it) and the number of points of the box along each axis.
+    """
+    shape = np.asarray(shape)
+    box = gemmi.FractionalBox()
+    for corner in itertools.product(*zip(low, high)):
+        box.extend(unit_cell.fractionalize(gemmi.Position(*corner)))
+    start = np.ceil(np.array(box.minimum.tolist()) * shape).astype(int)
+    size = np.floor(np.array(box.maximum.tolist()) * shape).astype(int) - start + 1
+    return start, size
+
+
+def write_grid_box(grid, start, shape, path, encoding=None):
+    """
+    Write a box of a map from a grid holding only the box.
+    :param grid: gemmi.FloatGrid of the size of the box, with the unit cell and space group of the map. It is not
+        modified.
+    :param start: Grid index of the first point of the box in the cell (header words 5-7), see box_extent.
+    :param shape: (nu, nv, nw) of the grid of the full cell (header words 8-10).
+    :param path: Filepath of the uncompressed map.
+    :param encoding: None or one of map_encodings.
+    :return: str, filepath written.
+    """
+    box_map = gemmi.Ccp4Map()
+    box_map.grid = grid
+    box_map.update_ccp4_header(2, False)
+    for word, value in zip([5, 6, 7, 8, 9, 10], list(start) + list(shape)):
+        box_map.set_header_i32(word, int(value))
+    # Header statistics of the box (DMIN, DMAX, DMEAN and RMS)
+    data = np.array(box_map.grid, copy=False)
+    box_map.set_header_float(20, float(np.min(data)))
+    box_map.set_header_float(21, float(np.max(data)))
+    box_map.set_header_float(22, float(np.mean(data)))
+    box_map.set_header_float(55, float(np.std(data)))
+    return write_ccp4_map(box_map, path, encoding=encoding)
+
+
+def write_map_box(grid, low, high, path, encoding=None, p1=False):
+    """
+    Write the box of a map between two orthogonal corners. The box keeps the grid and cell of the full map, its
+    start (header words 5-7) places it in the cell.
+    :param grid: gemmi.FloatGrid of the full cell. It is not modified.
+    :param low: Lowest orthogonal coordinates of the box.
+    :param high: Highest orthogonal coordinates of the box.
+    :param path: Filepath of the uncompressed map.
+    :param encoding: None or one of map_encodings.
+    :param p1: Bool, if True the map is written as P1 (its other symmetry mates are not part of the data).
+    :return: str, filepath written.
+    """
+    shape = np.array([grid.nu, grid.nv, grid.nw])
+    start, size = box_extent(grid.unit_cell, shape, low, high)
+    box = gemmi.FloatGrid(*[int(n) for n in size])
+    box.set_unit_cell(grid.unit_cell)
+    box.spacegroup = gemmi.find_spacegroup_by_name('P 1') if p1 else grid.spacegroup
+    index = np.ix_(*[np.arange(s, s + n) % m for s, n, m in zip(start, size, shape)])
+    np.array(box, copy=False)[:, :, :] = np.array(grid, copy=False)[index]
+    return write_grid_box(box, start, shape, path, encoding=encoding)
+
+
+def compress(data):
+    """
+    gzip.compress with a zero timestamp, so that the same map is always written to the same bytes.
+    :param data: bytes
+    :return: bytes of a gzip member.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def quantise(data, encoding, words):
+    """
+    Quantise map values to integers and record the scale and offset in the header words.
+    :param data: array of the map values.
+    :param encoding: 'int16' or 'int8'.
+    :param words: np.array of the header words, updated in place (mode, statistics and label).
+    :return: (mode, array of the integer values).
+    """
+    mode, largest = quantised_modes[encoding]
+    finite = data[np.isfinite(data)]
+    low, high = (float(np.min(finite)), float(np.max(finite))) if finite.size else (0.0, 0.0)
+    scale, offset = quantisation_scale(low, high, largest)
+    values = quantised_values(data, scale, offset, largest)
+    set_quantised_words(words, mode, [values.min(), values.max(), values.mean(), values.std()], scale, offset)
+    return mode, values
+
+
+def quantise_slabs(data, encoding, words, step):
+    """
+    quantise for data that is not held in memory (a np.memmap or a SparseXmap): the values are read slab by slab,
+    once for their range and twice for the statistics of the integers, so that only one slab is converted at a time.
+    :param data: (nu, nv, nw) array-like returning the map values for [:, :, start:stop] slices.
+    :param encoding: 'int16' or 'int8'.
+    :param words: np.array of the header words, updated in place (mode, statistics and label).
+    :param step: Number of sections (along w) per slab.
+    :return: (mode, QuantisedSlabs of data).
+    """
+    mode, largest = quantised_modes[encoding]
+    slabs = [slice(start, start + step) for start in range(0, data.shape[2], step)]
+    low, high = np.inf, -np.inf
+    for w in slabs:
+        values = np.asarray(data[:, :, w])
+        finite = values[np.isfinite(values)]
+        if finite.size:
+            low, high = min(low, float(np.min(finite))), max(high, float(np.max(finite)))
+    if low > high:
+        low, high = 0.0, 0.0
+    scale, offset = quantisation_scale(low, high, largest)
+    quantised = QuantisedSlabs(data, scale, offset, largest)
+    count = max(1, int(np.prod(data.shape)))
+    minimum, maximum, total = np.inf, -np.inf, 0.0
+    for w in slabs:
+        values = quantised[:, :, w]
+        minimum, maximum = min(minimum, float(values.min())), max(maximum, float(values.max()))
+        total += float(np.sum(values))
+    mean = total / count
+    variance = sum(float(np.sum((quantised[:, :, w] - mean) ** 2)) for w in slabs) / count
+    set_quantised_words(words, mode, [minimum, maximum, mean, np.sqrt(variance)], scale, offset)
+    return mode, quantised
+
+
+class QuantisedSlabs:
+    """
+    Integer values of map data, converted slab by slab as they are indexed (see quantise_slabs).
+    :param data: (nu, nv, nw) array-like returning the map values for [:, :, start:stop] slices.
+    :param scale: Map value of one integer step.
+    :param offset: Map value of the integer 0.
+    :param largest: Largest absolute integer value.
+    """
+    def __init__(self, data, scale, offset, largest):
+        self.data = data
+        self.shape = data.shape
+        self.scale = scale
+        self.offset = offset
+        self.largest = largest
+
+    def __getitem__(self, index):
+        return quantised_values(np.asarray(self.data[index]), self.scale, self.offset, self.largest)
+
+
+def quantisation_scale(low, high, largest):
+    """
+    :param low: Lowest finite map value.
+    :param high: Highest finite map value.
+    :param largest: Largest absolute integer value.
+    :return: (scale, offset) mapping [-largest, largest] onto [low, high].
+    """
+    offset = (high + low) / 2
+    scale = (high - low) / (2 * largest) if high > low else 1.0
+    return scale, offset
+
+
+def quantised_values(data, scale, offset, largest):
+    """
+    :param data: array of the map values, non finite values are quantised as the offset.
+    :return: array of the integer values (as floats).
+    """
+    return np.clip(np.rint((np.nan_to_num(data, nan=offset) - offset) / scale), -largest, largest)
+
+
+def set_quantised_words(words, mode, statistics, scale, offset):
+    """
+    Record the mode, the statistics and the scale and offset of quantised values in the header words.
+    :param words: np.array of the header words, updated in place.
+    :param mode: Map mode of the integers.
+    :param statistics: [minimum, maximum, mean, rms] of the integer values.
+    :param scale: Map value of one integer step.
+    :param offset: Map value of the integer 0.
+    """
+    words[4 - 1] = mode
+    # DMIN, DMAX, DMEAN and RMS, in stored units
+    for w, value in zip([20, 21, 22, 55], statistics):
+        words[w - 1] = struct.unpack('<i', struct.pack('<f', value))[0]
+    # Labels are ten 80 character strings from word 57, word 56 is the number in use
+    n_labels = int(words[56 - 1])
+    index = min(n_labels, 9)
+    label = f'{quantised_label} SCALE={scale:.10g} OFFSET={offset:.10g}'.ljust(80)
+    words[57 - 1 + 20 * index:57 - 1 + 20 * (index + 1)] = np.frombuffer(label.encode('ascii'), dtype='<i4')
+    words[56 - 1] = min(n_labels + 1, 10)
+
+
+def quantisation(ccp4):
+    """
+    Scale and offset of a map written by write_ccp4_map with a quantised encoding.
+    :param ccp4: gemmi.Ccp4Map
+    :return: (scale, offset), or None if the map is not quantised.
+    """
+    for index in range(min(ccp4.header_i32(56), 10)):
+        label = ccp4.header_str(57 + 20 * index, 80)
+        if label.startswith(quantised_label):
+            fields = dict(x.split('=') for x in label[len(quantised_label):].split())
+            return float(fields['SCALE']), float(fields['OFFSET'])
+    return None
+
+
+def ccp4_memmap(path):
+    """
+    Memory-map the data of a ccp4 map instead of reading it, for maps too large to hold in memory. Only maps whose
+    data can be indexed as the full cell are mapped: uncompressed little endian float (mode 2) maps covering the
+    whole cell from the origin, with columns, rows and sections along x, y and z.
+    :param path: Filepath of the map.
+    :return: (np.array of the header words, (nu, nv, nw) read only view of a np.memmap of the data), or None if the
+        map cannot be mapped (read it with read_ccp4_map instead).
+    """
+    path = str(path)
+    if path.endswith('.gz'):
+        return None
+    with open(path, 'rb') as f:
+        head = np.frombuffer(f.read(1024), dtype='<i4')
+        if len(head) < 256 or head[53 - 1].tobytes() != b'MAP ' or head[54 - 1].tobytes()[:2] != b'\x44\x41':
+            return None
+        words = np.concatenate([head, np.frombuffer(f.read(max(0, int(head[24 - 1]))), dtype='<i4')])
+    size = words[0:3]
+    if words[4 - 1] != 2 or list(words[17 - 1:20 - 1]) != [1, 2, 3] or np.any(words[5 - 1:8 - 1] != 0) \
+            or np.any(size != words[8 - 1:11 - 1]):
+        return None
+    data = np.memmap(path, dtype='<f4', mode='r', offset=1024 + int(words[24 - 1]),
+                     shape=(int(size[2]), int(size[1]), int(size[0])))
+    return words, data.transpose(2, 1, 0)
+
+
+def header_cell(words):
+    """
+    :param words: np.array of the header words of a map.
+    :return: list of the six unit cell parameters, rounded to 5 decimals as gemmi does when it reads a map.
+    """
+    return [float(np.floor(1e5 * float(x) + 0.5) / 1e5) for x in words[11 - 1:17 - 1].view('<f4')]
+
+
+def read_ccp4_map(path):
+    """
+    Read a map written by write_ccp4_map (or any ccp4 map, gzipped or not). Quantised maps are turned back into
+    floats, the returned map then has mode 2.
+    :param path: Filepath of the map.
+    :return: gemmi.Ccp4Map, setup() has not been called.
+    """
+    ccp4 = gemmi.read_ccp4_map(str(path))
+    quantised = quantisation(ccp4)
+    if quantised is not None:
+        scale, offset = quantised
+        array = np.array(ccp4.grid, copy=False)
+        array[:, :, :] = array * scale + offset
+        ccp4.set_header_i32(4, 2)
+    return ccp4
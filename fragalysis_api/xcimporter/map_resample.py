@@ -0,0 +1,1216 @@
+import dataclasses
+import itertools
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import gemmi
+import numpy as np
+from pandda_gemmi.pandda_types import Xmap
+from scipy import ndimage
+
+from fragalysis_api.xcimporter import map_io
+
+
+def resample(
+        moving_xmap: Xmap,
+        transform,
+        reference_structure,
+        chunk_size: int = 2 ** 20,
+        sparse: bool = True,
+        geometry_cache=None
+):
+    '''
+    Resample a map into the frame of the reference structure. Vectorised equivalent of resample_reference:
+    every grid point of the reference box is turned into a moving-frame grid coordinate with a single affine
+    transform and the moving map is interpolated for all of them at once.
+    :param moving_xmap: The (normalised) map to resample.
+    :param transform: Transform from align_to, mapping the reference frame onto the moving frame.
+    :param reference_structure: The reference Structure, its polymer atoms define the region to resample.
+    :param chunk_size: Maximum number of grid points transformed at once, bounds the memory used.
+    :param sparse: Bool, if True only the masked points of the box (and their neighbours, which the mask
+        interpolation can reach) are visited instead of every point of the box. The output is the same.
+    :param geometry_cache: Optional ReferenceGeometryCache, the mask of the reference is then only computed
+        once for each grid geometry instead of once per call.
+    :return: Xmap of the resampled map on the grid of moving_xmap.
+    '''
+    return resample_many([moving_xmap], transform, reference_structure, chunk_size=chunk_size, sparse=sparse,
+                         geometry_cache=geometry_cache)[0]
+
+
+def resample_many(
+        moving_xmaps: List[Xmap],
+        transform,
+        reference_structure,
+        chunk_size: int = 2 ** 20,
+        sparse: bool = True,
+        geometry_cache=None,
+        box=None,
+        asymmetric_unit: bool = False
+):
+    '''
+    Resample several maps of the same crystal with one transform, see resample. The maps are grouped by grid
+    geometry (unit cell and grid shape); within a group the moving-frame positions and the interpolation stencils
+    are computed once and applied to every map.
+    :param moving_xmaps: List of the (normalised) maps to resample.
+    :param transform: Transform from align_to, mapping the reference frame onto the moving frame.
+    :param reference_structure: The reference Structure, its polymer atoms define the region to resample.
+    :param chunk_size: Maximum number of grid points transformed at once, bounds the memory used.
+    :param sparse: Bool, see resample.
+    :param geometry_cache: Optional ReferenceGeometryCache, see resample.
+    :param box: Optional (low, high) orthogonal corners, see model_box. If given each map is resampled into a
+        BoxXmap of this box of its cell, for maps only written around the reference model: only the points within
+        the reference mask are set, and the values are not spread to their symmetry mates (see symmetrize).
+    :param asymmetric_unit: Bool, if True (and no box) the values of the mask points are reduced per orbit (set of
+        symmetry mates), see asymmetric_unit_points, and written to the points of each orbit instead of
+        symmetrizing the whole cell. The result is the same as symmetrize's, the orbits where the mask overlaps
+        its own mates included.
+    :return: List of Xmaps (BoxXmaps with box), in the order of moving_xmaps.
+    '''
+    asymmetric_unit = asymmetric_unit and box is None
+    groups = {}
+    for num, moving_xmap in enumerate(moving_xmaps):
+        cell = moving_xmap.xmap.unit_cell
+        key = ((cell.a, cell.b, cell.c, cell.alpha, cell.beta, cell.gamma),
+               (moving_xmap.xmap.nu, moving_xmap.xmap.nv, moving_xmap.xmap.nw))
+        if asymmetric_unit:
+            # The orbits depend on the space group of the map
+            spacegroup = moving_xmap.xmap.spacegroup
+            key += (None if spacegroup is None else spacegroup.hm,)
+        groups.setdefault(key, []).append(num)
+
+    # As in resample_reference only the rotation of the gemmi transform is used.
+    rotation = np.array(transform.transform.mat.tolist())
+    com_reference = np.asarray(transform.com_reference)
+    com_moving = np.asarray(transform.com_moving)
+
+    resampled = [None] * len(moving_xmaps)
+    for key, nums in groups.items():
+        template = moving_xmaps[nums[0]]
+        if geometry_cache is None:
+            geometry = ReferenceGeometry.from_xmap(template, reference_structure, chunk_size, sparse)
+        else:
+            geometry = geometry_cache.get(template, reference_structure, chunk_size, sparse)
+
+        shape = np.array([template.xmap.nu, template.xmap.nv, template.xmap.nw])
+        fractional = np.array(template.xmap.unit_cell.fractionalization_matrix.tolist())
+        if box is None:
+            interpolated_grids = [gridFromTemplate(moving_xmaps[num]) for num in nums]
+        else:
+            # Only the box is allocated, the points are placed relative to its start
+            box_start, box_size = map_io.box_extent(template.xmap.unit_cell, shape, *box)
+            interpolated_grids = [gridFromTemplate(moving_xmaps[num], size=box_size) for num in nums]
+        moving_arrays = [np.array(moving_xmaps[num].xmap, copy=False) for num in nums]
+        interpolated_arrays = [np.array(grid, copy=False) for grid in interpolated_grids]
+        if asymmetric_unit:
+            picked, mates, orbit_of, partial = geometry.asymmetric_unit(shape, template.xmap.spacegroup)
+            all_points, all_positions = geometry.points[picked], geometry.positions[picked]
+            picked_values = [[] for _ in nums]
+        else:
+            all_points, all_positions = geometry.points, geometry.positions
+
+        for start in range(0, len(all_points), chunk_size):
+            points = all_points[start:start + chunk_size]
+            positions = all_positions[start:start + chunk_size]
+            # Reference frame -> centered -> rotated -> moving frame
+            moving_positions = multiply_positions(rotation, positions - com_reference) + com_moving
+            stencil = trilinear_stencil(shape, multiply_positions(fractional, moving_positions) * shape)
+            values = [apply_trilinear_stencil(moving_array, stencil) for moving_array in moving_arrays]
+            if box is not None:
+                rows, points = points_in_box(points, box_start, box_size, shape)
+                values = [chunk_values[rows] for chunk_values in values]
+            if asymmetric_unit:
+                for map_values, chunk_values in zip(picked_values, values):
+                    map_values.append(chunk_values)
+                continue
+            for interpolated_array, chunk_values in zip(interpolated_arrays, values):
+                interpolated_array[points[:, 0], points[:, 1], points[:, 2]] = chunk_values
+
+        if asymmetric_unit:
+            # The grids in file order, indexed by the linear indices of the mates
+            for interpolated_array, map_values in zip(interpolated_arrays, picked_values):
+                values = orbit_values(np.concatenate(map_values), orbit_of, partial)
+                interpolated_array.T.reshape(-1)[mates] = values[orbit_of][:, np.newaxis]
+
+        for num, interpolated_grid in zip(nums, interpolated_grids):
+            if box is not None:
+                resampled[num] = BoxXmap(interpolated_grid, box_start, tuple(shape))
+                continue
+            if not asymmetric_unit:
+                interpolated_grid = symmetrize(interpolated_grid, moving_xmaps[num])
+            resampled[num] = Xmap(interpolated_grid)
+    return resampled
+
+
+def resample_mapped(
+        mapped_maps,
+        transform,
+        reference_structure,
+        chunk_size: int = 2 ** 20,
+        geometry_cache=None,
+        asymmetric_unit: bool = False,
+        write_chunk_size: int = 2 ** 22
+):
+    '''
+    resample_many for MappedMaps, without holding any full cell grid: the points of the maps around the sampled
+    positions are read from disk one chunk at a time, and the symmetry mates are filled in with symmetrize_sparse.
+    The values are those of resample_many on the maps read with CrystalMap, up to the rounding of the
+    normalisation (see MappedMap).
+    :param mapped_maps: List of MappedMaps to resample.
+    :param transform: Transform from align_to, mapping the reference frame onto the moving frame.
+    :param reference_structure: The reference Structure, its polymer atoms define the region to resample.
+    :param chunk_size: Maximum number of grid points transformed at once, bounds the memory used.
+    :param geometry_cache: Optional ReferenceGeometryCache, see resample.
+    :param asymmetric_unit: Bool, see resample_many.
+    :param write_chunk_size: Maximum number of grid points per slab when the SparseXmaps are written.
+    :return: List of SparseXmaps, in the order of mapped_maps.
+    '''
+    rotation = np.array(transform.transform.mat.tolist())
+    com_reference = np.asarray(transform.com_reference)
+    com_moving = np.asarray(transform.com_moving)
+
+    resampled = []
+    for mapped in mapped_maps:
+        cell = mapped.unit_cell
+        shape = np.array(mapped.shape)
+        if geometry_cache is None:
+            geometry = ReferenceGeometry.from_cell(cell, shape, reference_structure, chunk_size)
+        else:
+            geometry = geometry_cache.get_cell(cell, shape, reference_structure, chunk_size)
+        fractional = np.array(cell.fractionalization_matrix.tolist())
+        if asymmetric_unit:
+            picked, mates, orbit_of, partial = geometry.asymmetric_unit(shape, mapped.spacegroup)
+            all_points, all_positions = geometry.points[picked], geometry.positions[picked]
+        else:
+            all_points, all_positions = geometry.points, geometry.positions
+        values = [np.zeros(0, dtype=np.float32)]
+        for start in range(0, len(all_points), chunk_size):
+            positions = all_positions[start:start + chunk_size]
+            moving_positions = multiply_positions(rotation, positions - com_reference) + com_moving
+            stencil = trilinear_stencil(shape, multiply_positions(fractional, moving_positions) * shape)
+            values.append(apply_trilinear_stencil(mapped, stencil))
+        if asymmetric_unit:
+            indices, values = spread_orbits(mates, orbit_of,
+                                            orbit_values(np.concatenate(values), orbit_of, partial))
+        else:
+            indices, values = symmetrize_sparse(geometry.points, np.concatenate(values), shape, mapped.spacegroup)
+        resampled.append(SparseXmap(tuple(int(x) for x in shape), cell, mapped.spacegroup, indices, values,
+                                    chunk_size=write_chunk_size))
+    return resampled
+
+
+@dataclasses.dataclass()
+class ReferenceGeometry:
+    '''
+    The grid points resampled by resample: the points of the reference box that lie within the reference mask,
+    with their orthogonal positions. Only depends on the reference structure and the grid geometry of the map.
+    asymmetric_units: asymmetric_unit_points of the points for each space group seen, see asymmetric_unit.
+    '''
+    points: np.ndarray
+    positions: np.ndarray
+    asymmetric_units: dict = dataclasses.field(default_factory=dict, repr=False)
+
+    def asymmetric_unit(self, shape, spacegroup):
+        '''
+        :param shape: (nu, nv, nw) of the grid.
+        :param spacegroup: gemmi.SpaceGroup of the map, None for P1.
+        :return: asymmetric_unit_points of points, computed once per space group.
+        '''
+        key = None if spacegroup is None else spacegroup.hm
+        if key not in self.asymmetric_units:
+            self.asymmetric_units[key] = asymmetric_unit_points(self.points, shape, spacegroup)
+        return self.asymmetric_units[key]
+
+    @staticmethod
+    def from_xmap(moving_xmap, reference_structure, chunk_size=2 ** 20, sparse=True):
+        '''
+        :param moving_xmap: Xmap providing the grid geometry.
+        :param reference_structure: The reference Structure.
+        :param chunk_size: Maximum number of grid points tested against the mask at once.
+        :param sparse: Bool, if True only the points in or next to the mask are tested, see masked_box_points.
+        :return: ReferenceGeometry
+        '''
+        mask = reference_mask(moving_xmap, reference_structure)
+        min_index, max_index = reference_box(moving_xmap, reference_structure)
+
+        shape = np.array([moving_xmap.xmap.nu, moving_xmap.xmap.nv, moving_xmap.xmap.nw])
+        mask_array = np.array(mask, copy=False)
+        orthogonal = np.array(moving_xmap.xmap.unit_cell.orthogonalization_matrix.tolist())
+        fractional = np.array(moving_xmap.xmap.unit_cell.fractionalization_matrix.tolist())
+
+        if sparse:
+            point_chunks = masked_box_points(mask_array, min_index, max_index, chunk_size)
+        else:
+            point_chunks = box_points(min_index, max_index, chunk_size)
+        all_points = [np.zeros((0, 3), dtype=int)]
+        all_positions = [np.zeros((0, 3))]
+        for points in point_chunks:
+            points = np.mod(points, shape)
+            positions = multiply_positions(orthogonal, points * (1.0 / shape))
+            # Mask test done exactly as gemmi would, so the same points are kept as in resample_reference
+            in_mask = interpolate_trilinear(mask_array, multiply_positions(fractional, positions) * shape) > 0
+            all_points.append(points[in_mask])
+            all_positions.append(positions[in_mask])
+        return ReferenceGeometry(np.concatenate(all_points), np.concatenate(all_positions))
+
+    @staticmethod
+    def from_cell(unit_cell, shape, reference_structure, chunk_size=2 ** 20):
+        '''
+        from_xmap without the grid of the mask, for maps that are not held in memory (see MappedMap). The mask is
+        kept as the linear indices of its points, so the memory used depends on the size of the reference model and
+        not on the size of the cell. The points are the same as from_xmap's, but each is listed once where from_xmap
+        repeats the points of a box wider than the cell.
+        :param unit_cell: gemmi.UnitCell of the grid.
+        :param shape: (nu, nv, nw) of the grid.
+        :param reference_structure: The reference Structure.
+        :param chunk_size: Maximum number of grid points tested against the mask at once.
+        :return: ReferenceGeometry
+        '''
+        shape = np.array(shape)
+        mask = SparseMask(sparse_reference_mask(unit_cell, shape, reference_structure, chunk_size=chunk_size), shape)
+        min_index, max_index = reference_box_in_cell(unit_cell, shape, reference_structure)
+        orthogonal = np.array(unit_cell.orthogonalization_matrix.tolist())
+        fractional = np.array(unit_cell.fractionalization_matrix.tolist())
+
+        all_points = [np.zeros((0, 3), dtype=int)]
+        all_positions = [np.zeros((0, 3))]
+        for points in mask.box_points(min_index, max_index, chunk_size):
+            positions = multiply_positions(orthogonal, points * (1.0 / shape))
+            in_mask = interpolate_trilinear(mask, multiply_positions(fractional, positions) * shape) > 0
+            all_points.append(points[in_mask])
+            all_positions.append(positions[in_mask])
+        return ReferenceGeometry(np.concatenate(all_points), np.concatenate(all_positions))
+
+
+class ReferenceGeometryCache:
+    '''
+    ReferenceGeometry of each (reference, unit cell, grid shape) seen, so that aligning many maps to the same
+    reference builds the mask once per grid geometry, and the atom positions of each reference. It can be shared
+    by threads (see Align chain_jobs), a geometry is then built by the first thread that needs it while the others
+    wait for it.
+    '''
+
+    def __init__(self):
+        self._geometries = {}
+        self._lock = threading.Lock()
+
+    def get(self, moving_xmap, reference_structure, chunk_size=2 ** 20, sparse=True):
+        '''
+        :param moving_xmap: Xmap providing the grid geometry.
+        :param reference_structure: The reference Structure.
+        :param chunk_size: Passed to ReferenceGeometry.from_xmap on a miss.
+        :param sparse: Passed to ReferenceGeometry.from_xmap on a miss.
+        :return: ReferenceGeometry
+        '''
+        cell = moving_xmap.xmap.unit_cell
+        key = (id(reference_structure),
+               (cell.a, cell.b, cell.c, cell.alpha, cell.beta, cell.gamma),
+               (moving_xmap.xmap.nu, moving_xmap.xmap.nv, moving_xmap.xmap.nw))
+        with self._lock:
+            if key not in self._geometries:
+                # Keep the reference alive with its geometry so that its id cannot be reused by another structure
+                self._geometries[key] = (reference_structure,
+                                         ReferenceGeometry.from_xmap(moving_xmap, reference_structure,
+                                                                     chunk_size, sparse))
+            return self._geometries[key][1]
+
+    def get_cell(self, unit_cell, shape, reference_structure, chunk_size=2 ** 20):
+        '''
+        :param unit_cell: gemmi.UnitCell of the grid.
+        :param shape: (nu, nv, nw) of the grid.
+        :param reference_structure: The reference Structure.
+        :param chunk_size: Passed to ReferenceGeometry.from_cell on a miss.
+        :return: ReferenceGeometry
+        '''
+        key = (id(reference_structure), 'cell',
+               (unit_cell.a, unit_cell.b, unit_cell.c, unit_cell.alpha, unit_cell.beta, unit_cell.gamma),
+               tuple(int(x) for x in shape))
+        with self._lock:
+            if key not in self._geometries:
+                self._geometries[key] = (reference_structure,
+                                         ReferenceGeometry.from_cell(unit_cell, shape, reference_structure,
+                                                                     chunk_size))
+            return self._geometries[key][1]
+
+    def positions(self, reference_structure):
+        '''
+        :param reference_structure: The reference Structure.
+        :return: (N, 3) array of the positions of its polymer atoms, see protein_positions.
+        '''
+        key = (id(reference_structure), 'positions')
+        with self._lock:
+            if key not in self._geometries:
+                self._geometries[key] = (reference_structure, protein_positions(reference_structure))
+            return self._geometries[key][1]
+
+
+def protein_positions(structure):
+    '''
+    :param structure: Structure
+    :return: (N, 3) array of the positions of its polymer atoms.
+    '''
+    positions = [[atom.pos.x, atom.pos.y, atom.pos.z] for atom in structure.protein_atoms()]
+    return np.array(positions, dtype=float).reshape(-1, 3)
+
+
+def reference_mask(moving_xmap, reference_structure):
+    '''
+    Mask of the grid points within 5A of the polymer atoms of the reference structure.
+    :param moving_xmap: Xmap providing the grid geometry.
+    :param reference_structure: The reference Structure.
+    :return: gemmi.FloatGrid with 1 inside the mask and 0 outside.
+    '''
+    mask = gemmi.FloatGrid(moving_xmap.xmap.nu,
+                           moving_xmap.xmap.nv,
+                           moving_xmap.xmap.nw, )
+    mask.set_unit_cell(moving_xmap.xmap.unit_cell)
+    mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+
+    for atom in reference_structure.protein_atoms():
+        mask.set_points_around(atom.pos, 5.0, 1.0)
+    return mask
+
+
+def sparse_reference_mask(unit_cell, shape, reference_structure, radius=5.0, chunk_size=2 ** 20):
+    '''
+    The points of reference_mask as sorted linear indices (in file order, see SparseMask) rather than a grid. Each
+    atom marks the grid points closer than radius as gemmi's set_points_around does, with the same arithmetic, so
+    the points are exactly those of reference_mask.
+    :param unit_cell: gemmi.UnitCell of the grid.
+    :param shape: (nu, nv, nw) of the grid.
+    :param reference_structure: The reference Structure.
+    :param radius: Radius of the mask around each polymer atom, in Angstrom.
+    :param chunk_size: Maximum number of grid points tested at once (at least the points around one atom), bounds
+        the memory used on top of the masked points.
+    :return: sorted np.array of the linear indices of the masked points.
+    '''
+    shape = np.array(shape)
+    positions = protein_positions(reference_structure)
+    fractional = np.array(unit_cell.fractionalization_matrix.tolist())
+    orthogonal = np.array(unit_cell.orthogonalization_matrix.tolist())
+    centers = multiply_positions(fractional, positions.reshape(-1, 3))
+    centers = centers - np.floor(centers)
+    reciprocal = unit_cell.reciprocal()
+    # Points visited around each atom, as in gemmi: ceil(radius / spacing) steps each side of the nearest point
+    spacing = 1.0 / (shape * np.array([reciprocal.a, reciprocal.b, reciprocal.c]))
+    steps = np.ceil(radius / spacing).astype(int)
+    offsets = np.stack(np.meshgrid(*[np.arange(-x, x + 1) for x in steps], indexing='ij'), axis=-1).reshape(-1, 3)
+    nearest = np.floor(centers * shape + 0.5).astype(int)
+    step = 1.0 / shape
+    atoms_per_chunk = max(1, chunk_size // len(offsets))
+    masked = np.zeros(0, dtype=int)
+    # The points of neighbouring atoms overlap, they are merged into masked once they add up to as many points
+    pending = []
+    for start in range(0, len(centers), atoms_per_chunk):
+        points = (nearest[start:start + atoms_per_chunk, None, :] + offsets[None]).reshape(-1, 3)
+        delta = multiply_positions(
+            orthogonal, np.repeat(centers[start:start + atoms_per_chunk], len(offsets), axis=0) - points * step)
+        close = delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1] + delta[:, 2] * delta[:, 2] < radius * radius
+        pending.append(np.unique(np.ravel_multi_index(np.mod(points[close], shape).T, shape, order='F')))
+        if sum(len(x) for x in pending) > max(chunk_size, len(masked)):
+            masked = np.unique(np.concatenate([masked] + pending))
+            pending = []
+    return np.unique(np.concatenate([masked] + pending))
+
+
+class SparseMask:
+    '''
+    A mask stored as the sorted linear indices of its points, indexed like the (nu, nv, nw) array of the mask grid
+    (1.0 inside, 0.0 outside) so that interpolate_trilinear can test points against it.
+    Linear indices are in file order (u fastest), see np.ravel_multi_index(order='F').
+    '''
+
+    def __init__(self, indices, shape):
+        self.indices = np.asarray(indices)
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, index):
+        linear = np.ravel_multi_index(index, self.shape, order='F')
+        if len(self.indices) == 0:
+            return np.zeros(np.shape(linear), dtype=self.dtype)
+        found = np.minimum(np.searchsorted(self.indices, linear), len(self.indices) - 1)
+        return (self.indices[found] == linear).astype(self.dtype)
+
+    def box_points(self, min_index, max_index, chunk_size):
+        '''
+        The equivalent of masked_box_points: the points of the cell in the mask or next to it that the box reaches
+        (the box is wrapped into the cell), each listed once, in file order. They are found a slab of sections (w)
+        at a time, from the mask points of the slab and of the sections on either side.
+        :param min_index: First index of the box along each axis.
+        :param max_index: Index past the end of the box along each axis.
+        :param chunk_size: Maximum number of points per chunk, each of the 27 neighbours of a mask point counts.
+        :return: generator of (N, 3) integer arrays of indices within the cell.
+        '''
+        shape = np.array(self.shape)
+        extent = np.array(max_index) - np.array(min_index)
+        if np.any(extent <= 0) or len(self.indices) == 0:
+            return
+        plane = self.shape[0] * self.shape[1]
+        per_chunk = max(1, chunk_size // 27)
+        start = 0
+        while start < self.shape[2]:
+            first = np.searchsorted(self.indices, start * plane)
+            if first + per_chunk >= len(self.indices):
+                stop = self.shape[2]
+            else:
+                stop = max(start + 1, int(self.indices[first + per_chunk]) // plane)
+            # Mask points of the sections start - 1 to stop (wrapping around the cell)
+            if stop - start + 2 >= self.shape[2]:
+                sources = self.indices
+            else:
+                sources = np.concatenate([
+                    self.indices[slice(*np.searchsorted(self.indices, [w * plane, (w + n) * plane]))]
+                    for w, n in [((start - 1) % self.shape[2], 1), (start, stop - start),
+                                 (stop % self.shape[2], 1)]])
+            points = np.column_stack(np.unravel_index(sources, self.shape, order='F'))
+            neighbours = np.unique(np.concatenate([
+                np.ravel_multi_index(np.mod(points + offset, shape).T, self.shape, order='F')
+                for offset in itertools.product([-1, 0, 1], repeat=3)]))
+            neighbours = neighbours[(neighbours >= start * plane) & (neighbours < stop * plane)]
+            neighbours = np.column_stack(np.unravel_index(neighbours, self.shape, order='F'))
+            in_box = np.all((np.mod(neighbours - np.array(min_index), shape) < extent) | (extent >= shape), axis=1)
+            neighbours = neighbours[in_box]
+            for offset in range(0, len(neighbours), chunk_size):
+                yield neighbours[offset:offset + chunk_size]
+            start = stop
+
+
+def reference_box(moving_xmap, reference_structure):
+    '''
+    Grid index box spanned by the polymer atoms of the reference structure.
+    :param moving_xmap: Xmap providing the grid geometry.
+    :param reference_structure: The reference Structure.
+    :return: (min_index, max_index), the box is min_index <= index < max_index and may lie outside the cell.
+    '''
+    return reference_box_in_cell(moving_xmap.xmap.unit_cell,
+                                 [moving_xmap.xmap.nu, moving_xmap.xmap.nv, moving_xmap.xmap.nw],
+                                 reference_structure)
+
+
+def reference_box_in_cell(unit_cell, shape, reference_structure):
+    '''
+    reference_box for a grid given by its unit cell and shape.
+    '''
+    positions = protein_positions(reference_structure)
+    fractional = np.array(unit_cell.fractionalization_matrix.tolist())
+    fractional_coords_array = multiply_positions(fractional, positions)
+    max_coord = np.max(fractional_coords_array, axis=0)
+    min_coord = np.min(fractional_coords_array, axis=0)
+    shape = np.array(shape)
+    min_index = np.floor(min_coord * shape).astype(int)
+    max_index = np.floor(max_coord * shape).astype(int)
+    return min_index, max_index
+
+
+def model_box(structure, margin):
+    '''
+    Orthogonal box around the polymer atoms of a structure.
+    :param structure: Structure
+    :param margin: Margin (in Angstrom) added on every side.
+    :return: (low, high) orthogonal corners of the box.
+    '''
+    positions = np.array([[atom.pos.x, atom.pos.y, atom.pos.z] for atom in structure.protein_atoms()])
+    return np.min(positions, axis=0) - margin, np.max(positions, axis=0) + margin
+
+
+def box_points(min_index, max_index, chunk_size):
+    '''
+    Generate the grid indices of a box in slabs along the first axis.
+    :param min_index: First index of the box along each axis.
+    :param max_index: Index past the end of the box along each axis.
+    :param chunk_size: Maximum number of points per slab (at least one plane is always returned).
+    :return: generator of (N, 3) integer arrays.
+    '''
+    extent = np.maximum(np.array(max_index) - np.array(min_index), 0)
+    plane = int(extent[1] * extent[2])
+    if plane == 0:
+        return
+    step = max(1, chunk_size // plane)
+    v, w = np.meshgrid(np.arange(min_index[1], max_index[1]),
+                       np.arange(min_index[2], max_index[2]), indexing='ij')
+    v, w = v.ravel(), w.ravel()
+    for start in range(int(min_index[0]), int(max_index[0]), step):
+        u = np.arange(start, min(start + step, int(max_index[0])))
+        yield np.column_stack([np.repeat(u, plane), np.tile(v, len(u)), np.tile(w, len(u))])
+
+
+def masked_box_points(mask_array, min_index, max_index, chunk_size):
+    '''
+    Generate the grid indices of a box that lie in the mask, or next to it. The neighbours are included because
+    the mask is tested by interpolation, which can pick up a masked point one step away.
+    :param mask_array: (nu, nv, nw) mask array, > 0 inside the mask.
+    :param min_index: First index of the box along each axis.
+    :param max_index: Index past the end of the box along each axis.
+    :param chunk_size: Maximum number of points per chunk.
+    :return: generator of (N, 3) integer arrays, in the unwrapped index range of the box.
+    '''
+    min_index, max_index = np.array(min_index), np.array(max_index)
+    if np.any(max_index <= min_index):
+        return
+    # Take one extra point each side so that neighbours outside the box are seen by the dilation
+    axes = [np.arange(lo - 1, hi + 1) % n for lo, hi, n in zip(min_index, max_index, mask_array.shape)]
+    box_mask = ndimage.binary_dilation(mask_array[np.ix_(*axes)] > 0, structure=np.ones((3, 3, 3)))
+    points = np.column_stack(np.nonzero(box_mask[1:-1, 1:-1, 1:-1])) + min_index
+    for start in range(0, len(points), chunk_size):
+        yield points[start:start + chunk_size]
+
+
+def multiply_positions(matrix, positions):
+    '''
+    Multiply many positions by a 3x3 matrix, summing in the same order as gemmi's Mat33.multiply.
+    :param matrix: (3, 3) array.
+    :param positions: (N, 3) array.
+    :return: (N, 3) array.
+    '''
+    return np.column_stack([matrix[i, 0] * positions[:, 0] + matrix[i, 1] * positions[:, 1] +
+                            matrix[i, 2] * positions[:, 2] for i in range(3)])
+
+
+def interpolate_trilinear(array, grid_coords):
+    '''
+    Periodic trilinear interpolation of many points. Follows the arithmetic of gemmi's Grid.interpolate_value
+    (nested lerps, rounded to the grid precision after the y and z steps), so values match it exactly.
+    :param array: (nu, nv, nw) array of map values.
+    :param grid_coords: (N, 3) array of positions in grid units (fractional coordinate * grid size).
+    :return: (N,) array of interpolated values, with the dtype of array.
+    '''
+    return apply_trilinear_stencil(array, trilinear_stencil(array.shape, grid_coords))
+
+
+def trilinear_stencil(shape, grid_coords):
+    '''
+    The corner indices and weights used by interpolate_trilinear, which only depend on the grid shape. They can
+    be computed once and applied to every map sampled at the same positions.
+    :param shape: (nu, nv, nw) of the grid.
+    :param grid_coords: (N, 3) array of positions in grid units.
+    :return: tuple of the lower and upper corner indices along each axis and the (N,) fractional offsets.
+    '''
+    shape = np.array(shape)
+    base = np.floor(grid_coords)
+    xd, yd, zd = (grid_coords - base).T
+    u, v, w = np.mod(base.astype(int), shape).T
+    u2, v2, w2 = (u + 1) % shape[0], (v + 1) % shape[1], (w + 1) % shape[2]
+    return u, v, w, u2, v2, w2, xd, yd, zd
+
+
+def apply_trilinear_stencil(array, stencil):
+    '''
+    Interpolate array with a stencil from trilinear_stencil.
+    :param array: (nu, nv, nw) array of map values.
+    :param stencil: tuple returned by trilinear_stencil for the shape of array.
+    :return: (N,) array of interpolated values, with the dtype of array.
+    '''
+    u, v, w, u2, v2, w2, xd, yd, zd = stencil
+
+    def lerp(a, b, t):
+        return a + (b - a) * t
+
+    def corner(uu, vv, ww):
+        return array[uu, vv, ww].astype(np.float64)
+
+    avg = [lerp(lerp(corner(u, v, wi), corner(u2, v, wi), xd),
+                lerp(corner(u, v2, wi), corner(u2, v2, wi), xd),
+                yd).astype(array.dtype).astype(np.float64) for wi in (w, w2)]
+    return lerp(avg[0], avg[1], zd).astype(array.dtype)
+
+
+def symmetrize(interpolated_grid, template):
+    '''
+    Fill in the symmetry mates of the resampled points, keeping negative density.
+    The result is max over the mates of the values minus max over the mates of the negated values, computed in place
+    with a single scratch grid (for the negated values).
+    :param interpolated_grid: gemmi.FloatGrid holding the resampled values, overwritten with the result.
+    :param template: Xmap the scratch grid is modeled on.
+    :return: interpolated_grid, with symmetrized values.
+    '''
+    interpolated_array = np.array(interpolated_grid, copy=False)
+
+    interpolated_grid_neg = gridFromTemplate(template)
+    interpolated_array_neg = np.array(interpolated_grid_neg, copy=False)
+    np.negative(interpolated_array, out=interpolated_array_neg)
+    interpolated_grid_neg.symmetrize_max()
+
+    interpolated_grid.symmetrize_max()
+    interpolated_array -= interpolated_array_neg
+    return interpolated_grid
+
+
+def symmetrize_sparse(points, values, shape, spacegroup):
+    '''
+    symmetrize for a map that is zero except at some points, without the grid: every point of the orbit of a
+    resampled point gets the max over the orbit of the values minus the max over the orbit of the negated values,
+    the points of the orbit that were not resampled counting as zero.
+    :param points: (N, 3) integer array of distinct grid indices within the cell.
+    :param values: (N,) float32 array of the values at points.
+    :param shape: (nu, nv, nw) of the grid.
+    :param spacegroup: gemmi.SpaceGroup of the map, None for P1.
+    :return: (sorted linear indices in file order, float32 values) of the points set.
+    '''
+    mates, orbit_of, partial = point_orbits(points, shape, spacegroup)
+    return spread_orbits(mates, orbit_of, orbit_values(values, orbit_of, partial))
+
+
+def point_orbits(points, shape, spacegroup):
+    '''
+    :param points: (N, 3) integer array of distinct grid indices within the cell.
+    :param shape: (nu, nv, nw) of the grid.
+    :param spacegroup: gemmi.SpaceGroup of the grid, None for P1.
+    :return: (grid_mates of points, (N,) index of the orbit (set of symmetry mates) of each point, bool array of
+        the orbits with points of their own that are not in points).
+    '''
+    mates = grid_mates(points, shape, spacegroup)
+    orbits, orbit_of = np.unique(mates.min(axis=1), return_inverse=True)
+    orbit_of = orbit_of.ravel()
+    orbit_size = np.zeros(len(orbits), dtype=int)
+    orbit_size[orbit_of] = 1 + np.count_nonzero(np.diff(np.sort(mates, axis=1), axis=1), axis=1)
+    partial = np.bincount(orbit_of, minlength=len(orbits)) < orbit_size
+    return mates, orbit_of, partial
+
+
+def orbit_values(values, orbit_of, partial):
+    '''
+    :param values: (N,) float32 array of the values of the points.
+    :param orbit_of: (N,) index of the orbit of each point, see point_orbits.
+    :param partial: Bool array of the orbits with points of their own that are not set, counting as zero.
+    :return: float32 array of the value symmetrize gives each orbit: the max of its values minus the max of its
+        negated values.
+    '''
+    values = np.asarray(values, dtype=np.float32)
+    positive = np.full(len(partial), -np.inf, dtype=np.float32)
+    negative = np.full(len(partial), -np.inf, dtype=np.float32)
+    np.maximum.at(positive, orbit_of, values)
+    np.maximum.at(negative, orbit_of, -values)
+    positive[partial] = np.maximum(positive[partial], 0)
+    negative[partial] = np.maximum(negative[partial], 0)
+    return positive - negative
+
+
+def spread_orbits(mates, orbit_of, values):
+    '''
+    :param mates: grid_mates of the points, see point_orbits.
+    :param orbit_of: Index of the orbit of each point.
+    :param values: Value of each orbit.
+    :return: (sorted linear indices in file order, float32 values) of all the points of the orbits.
+    '''
+    indices, first = np.unique(mates.ravel(), return_index=True)
+    return indices, np.repeat(values[orbit_of], mates.shape[1])[first]
+
+
+def grid_mates(points, shape, spacegroup):
+    '''
+    :param points: (N, 3) integer array of grid indices within the cell.
+    :param shape: (nu, nv, nw) of the grid.
+    :param spacegroup: gemmi.SpaceGroup of the grid, None for P1.
+    :return: (N, number of symmetry operations) array of the linear indices (in file order) of the mates of each
+        point, the point itself included.
+    '''
+    shape = np.array(shape)
+    if spacegroup is None:
+        spacegroup = gemmi.find_spacegroup_by_name('P 1')
+    # Grid symmetry operations, as gemmi applies them to grid indices (rotations and translations in 1/24)
+    return np.column_stack([
+        np.ravel_multi_index(np.mod(multiply_indices(np.array(op.rot) // 24, points) +
+                                    np.array(op.tran) * shape // 24, shape).T, shape, order='F')
+        for op in spacegroup.operations()])
+
+
+def asymmetric_unit_points(points, shape, spacegroup):
+    '''
+    Group the points into orbits (sets of symmetry mates), so that a map interpolated at the points is symmetrized
+    by reducing the values of each orbit (see orbit_values) and writing the result to its mates, instead of
+    symmetrizing the whole cell (see resample_many asymmetric_unit). Every distinct point is kept, the orbits where
+    points overlap their own mates included, so the result is that of symmetrize. Of a point listed more than once
+    (a reference box wider than the cell) the last is kept, as it is the one whose value resample writes.
+    :param points: (N, 3) integer array of grid indices within the cell.
+    :param shape: (nu, nv, nw) of the grid.
+    :param spacegroup: gemmi.SpaceGroup of the grid, None for P1.
+    :return: (indices into points of the kept points, followed by their point_orbits).
+    '''
+    linear = np.ravel_multi_index(np.asarray(points).T, shape, order='F')
+    _, last = np.unique(linear[::-1], return_index=True)
+    picked = np.sort(len(points) - 1 - last)
+    return (picked,) + point_orbits(np.asarray(points)[picked], shape, spacegroup)
+
+
+def multiply_indices(matrix, points):
+    '''
+    :param matrix: (3, 3) integer array.
+    :param points: (N, 3) integer array.
+    :return: (N, 3) integer array of the points multiplied by matrix.
+    '''
+    return np.asarray(points) @ np.asarray(matrix).T
+
+
+def resample_reference(
+        moving_xmap: Xmap,
+        transform,
+        reference_structure
+):
+    '''
+    Point by point implementation of resample, kept as the reference to test the vectorised version against.
+    '''
+    interpolated_grid = gridFromTemplate(moving_xmap)
+    mask = gemmi.FloatGrid(moving_xmap.xmap.nu,
+                           moving_xmap.xmap.nv,
+                           moving_xmap.xmap.nw, )
+    mask.set_unit_cell(moving_xmap.xmap.unit_cell)
+    mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+
+    for model in reference_structure.structure:
+        for chain in model:
+            for residue in chain.get_polymer():
+                for atom in residue:
+                    mask.set_points_around(atom.pos, 5.0, 1.0)
+
+    mask_array = np.array(mask)
+    mask_indicies = np.hstack([x.reshape((len(x), 1))
+                              for x in np.nonzero(mask)])
+    fractional_coords = []
+    for model in reference_structure.structure:
+        for chain in model:
+            for residue in chain.get_polymer():
+                for atom in residue:
+                    fractional = moving_xmap.xmap.unit_cell.fractionalize(
+                        atom.pos)
+                    fractional_coords.append(
+                        [fractional.x, fractional.y, fractional.z])
+
+    fractional_coords_array = np.array(fractional_coords)
+    max_coord = np.max(fractional_coords_array, axis=0)
+    min_coord = np.min(fractional_coords_array, axis=0)
+
+    min_index = np.floor(
+        min_coord * np.array([interpolated_grid.nu, interpolated_grid.nv, interpolated_grid.nw]))
+    max_index = np.floor(
+        max_coord * np.array([interpolated_grid.nu, interpolated_grid.nv, interpolated_grid.nw]))
+
+    points = itertools.product(range(int(min_index[0]), int(max_index[0])),
+                               range(int(min_index[1]), int(max_index[1])),
+                               range(int(min_index[2]), int(max_index[2])),
+                               )
+
+    # Unpack the points, poitions and transforms
+    point_list: List[Tuple[int, int, int]] = []
+    position_list: List[Tuple[float, float, float]] = []
+    transform_list: List[gemmi.transform] = []
+    com_moving_list: List[np.array] = []
+    com_reference_list: List[np.array] = []
+
+    transform_rotate_reference_to_moving = transform.transform
+    transform_rotate_reference_to_moving.vec.fromlist([0.0, 0.0, 0.0])
+
+    transform_reference_to_centered = gemmi.Transform()
+    transform_reference_to_centered.vec.fromlist(
+        (-transform.com_reference).tolist())
+    transform_reference_to_centered.mat.fromlist(np.eye(3).tolist())
+
+    transform_centered_to_moving = gemmi.Transform()
+    transform_centered_to_moving.vec.fromlist(transform.com_moving.tolist())
+    transform_centered_to_moving.mat.fromlist(np.eye(3).tolist())
+
+    # indicies to positions
+    #   mask_array = np.array(mask)
+    # mask_indicies = np.hstack([x.reshape((len(x), 1))
+    #                          for x in np.nonzero(mask)])
+    #points2 = [x for x in points]
+    #ma, mb, mc = zip(*mask_indicies)
+    ##sma = set(ma)
+    #smb = set(mb)
+    #smc = set(mc)
+    #points_filtered = [(x, y, z) for x, y, z in points2 if x in sma and y in smb and z in smc]
+    for point in points:  # points_filtered:
+
+        position = interpolated_grid.point_to_position(
+            interpolated_grid.get_point(point[0], point[1], point[2]))
+
+        if mask.interpolate_value(position) <= 0:
+            continue
+        # Tranform to origin frame
+        trtc = transform_reference_to_centered.apply(position)
+        position_origin_reference = gemmi.Position(trtc[0], trtc[1], trtc[2])
+
+        # Rotate
+        trrtm = transform_rotate_reference_to_moving.apply(
+            position_origin_reference)
+        position_origin_moving = gemmi.Position(trrtm[0], trrtm[1], trrtm[2])
+
+        # Transform to moving frame
+        tctm = transform_centered_to_moving.apply(position_origin_moving)
+        position_moving = gemmi.Position(tctm[0], tctm[1], tctm[2])
+
+        # Interpolate moving map
+        interpolated_map_value = moving_xmap.xmap.interpolate_value(
+            position_moving)
+
+        # Set original point
+        interpolated_grid.set_value(
+            point[0], point[1], point[2], interpolated_map_value)
+
+    # interpolated_grid.symmetrize_max()
+    interpolated_array = np.array(interpolated_grid)
+
+    interpolated_grid_neg = gridFromTemplate(moving_xmap)
+    interpolated_array_neg = np.array(interpolated_grid_neg, copy=False)
+    interpolated_array_neg[:, :, :] = -interpolated_array[:, :, :]
+    interpolated_grid_neg.symmetrize_max()
+
+    interpolated_grid_pos = gridFromTemplate(moving_xmap)
+    interpolated_array_pos = np.array(interpolated_grid_pos, copy=False)
+    interpolated_array_pos[:, :, :] = interpolated_array[:, :, :]
+    interpolated_grid_pos.symmetrize_max()
+
+    interpolated_grid_sym = gridFromTemplate(moving_xmap)
+    interpolated_array_sym = np.array(interpolated_grid_sym, copy=False)
+    interpolated_array_sym[:, :, :] = interpolated_array_pos[:,
+                                                             :, :] - interpolated_array_neg[:, :, :]
+
+    return Xmap(interpolated_grid_sym)
+
+
+@dataclasses.dataclass()
+class CrystalMap:
+    '''
+    A map of a crystal, normalised once and kept in memory so that it can be resampled for every chain.
+    xmap holds the normalised map, template the map as read from disk whose header is reused by referenceSave.
+    in_place: if True xmap is the grid of template itself (normalised in place), for maps written as they are.
+    '''
+    path: Path
+    xmap: Xmap
+    template: gemmi.Ccp4Map
+    in_place: bool = False
+
+    @staticmethod
+    def from_file(file, in_place=False):
+        '''
+        Read a map once and normalise it (non finite values set to 0, then scaled to mean 0 and sd 1).
+        :param file: Path of the .map/.ccp4 file.
+        :param in_place: Bool, if True the map is normalised in the grid of the template instead of a copy, for maps
+            that are not resampled.
+        :return: CrystalMap
+        '''
+        ccp4 = gemmi.read_ccp4_map(str(file))
+        ccp4.setup()
+        if in_place:
+            xmap = Xmap(ccp4.grid)
+            array = np.array(xmap.xmap, copy=False)
+        else:
+            # Independent copy of the data, the template keeps the map as read
+            xmap = Xmap(gridFromTemplate(Xmap(ccp4.grid)))
+            array = np.array(xmap.xmap, copy=False)
+            array[:, :, :] = np.array(ccp4.grid, copy=False)
+        array[~np.isfinite(array)] = 0
+        array_mean = np.mean(array)
+        array_sd = np.std(array)
+        array[:, :, :] = (array[:, :, :] - array_mean) / array_sd
+        return CrystalMap(Path(file), xmap, ccp4, in_place)
+
+    def write(self, path, encoding=None):
+        '''
+        Write the normalised map with the header of the map read, for maps that are not resampled. It is written
+        from xmap, without copying it into the template.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        if self.in_place:
+            return map_io.write_ccp4_map(self.template, path, encoding=encoding)
+        return map_io.write_ccp4_data(map_io.header_words(self.template), np.array(self.xmap.xmap, copy=False), path,
+                                      encoding=encoding)
+
+
+# Bytes held per grid point of a chunk by each stage of the resampling of memory-mapped maps (measured with
+# tracemalloc, rounded up), see mapped_chunk_size. MappedMap.from_file: a float64 slab of the file and its deviations
+# from the mean. resample_mapped: the moved and fractional positions of the chunk, the indices and weights of their
+# trilinear stencil and the gathered corner values. SparseXmap.write: the dense slab, the indices of its non zero
+# points, its (quantised) copy in the type of the file and the bytes written.
+stats_point_bytes = 32
+resample_point_bytes = 192
+write_point_bytes = 48
+
+
+def mapped_chunk_size(memory_budget, point_bytes):
+    '''
+    Number of grid points a stage of the resampling of memory-mapped maps works on at once, so that its chunk
+    holds at most memory_budget bytes (see Align memory_budget). The stages run one after the other.
+    :param memory_budget: Size in bytes.
+    :param point_bytes: Bytes held per point by the stage, e.g. resample_point_bytes.
+    :return: int, at least 1024.
+    '''
+    return max(2 ** 10, int(memory_budget) // point_bytes)
+
+
+@dataclasses.dataclass()
+class MappedMap:
+    '''
+    A map of a crystal memory-mapped from its file rather than read, for maps too large to hold in memory (see
+    Align memory_budget). The values are normalised as CrystalMap does, when they are gathered: indexing it like
+    the (nu, nv, nw) array of the map only reads the points asked for.
+    The mean and standard deviation are computed in double precision over slabs of the file, so they (and the
+    normalised values) may differ from CrystalMap's in the last bits.
+    words holds the header words of the file, which the resampled map is written with (as referenceSave does).
+    write_chunk_size: maximum number of grid points per slab when the map is written without being resampled.
+    '''
+    path: Path
+    words: np.ndarray
+    data: np.ndarray
+    unit_cell: gemmi.UnitCell
+    spacegroup: gemmi.SpaceGroup
+    mean: np.float32
+    sd: np.float32
+    write_chunk_size: int = 2 ** 22
+
+    @staticmethod
+    def from_file(file, chunk_size=2 ** 22, write_chunk_size=2 ** 22):
+        '''
+        :param file: Path of the .map/.ccp4 file.
+        :param chunk_size: Maximum number of grid points of the slabs read to compute the mean and standard
+            deviation (at least one plane is always read).
+        :param write_chunk_size: See MappedMap.
+        :return: MappedMap, or None if the map cannot be memory-mapped (see map_io.ccp4_memmap).
+        '''
+        mapped = map_io.ccp4_memmap(file)
+        if mapped is None:
+            return None
+        words, data = mapped
+        ispg = int(words[23 - 1])
+        if ispg > 230:
+            return None
+        spacegroup = gemmi.find_spacegroup_by_number(ispg) if ispg > 0 else None
+        unit_cell = gemmi.UnitCell(*map_io.header_cell(words))
+
+        def slabs():
+            step = max(1, chunk_size // (data.shape[0] * data.shape[1]))
+            for start in range(0, data.shape[2], step):
+                slab = np.array(data[:, :, start:start + step], dtype=np.float64)
+                slab[~np.isfinite(slab)] = 0
+                yield slab
+
+        count = float(np.prod(data.shape))
+        mean = sum(float(np.sum(slab)) for slab in slabs()) / count
+        sd = np.sqrt(sum(float(np.sum((slab - mean) ** 2)) for slab in slabs()) / count)
+        return MappedMap(Path(file), words, data, unit_cell, spacegroup, np.float32(mean), np.float32(sd),
+                         write_chunk_size)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, index):
+        values = np.array(self.data[index], dtype=np.float32)
+        values[~np.isfinite(values)] = 0
+        return (values - self.mean) / self.sd
+
+    def write(self, path, encoding=None):
+        '''
+        Write the normalised map slab by slab, for maps that are not resampled.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        return write_slabs(self.words, self, path, self.write_chunk_size, encoding=encoding)
+
+    def write_cutout(self, low, high, path, encoding=None):
+        '''
+        Write the box of the normalised map between two orthogonal corners, see SparseXmap.write_cutout.
+        '''
+        cutout, start, index = cell_cutout(self.unit_cell, self.spacegroup, self.shape, low, high)
+        np.array(cutout, copy=False)[:, :, :] = self[index]
+        return map_io.write_grid_box(cutout, start, self.shape, path, encoding=encoding)
+
+
+@dataclasses.dataclass()
+class SparseXmap:
+    '''
+    A resampled map held as its non zero points, as resample_mapped returns it: sorted linear indices (in file
+    order, see SparseMask) and their values. It is written slab by slab without building the full grid, slicing it
+    as [:, :, start:stop] returns the dense slab. There is no full cell grid of it: cutouts are gathered from the
+    non zero points (see write_cutout).
+    chunk_size: maximum number of grid points per slab written.
+    '''
+    shape: tuple
+    unit_cell: gemmi.UnitCell
+    spacegroup: gemmi.SpaceGroup
+    indices: np.ndarray
+    values: np.ndarray
+    chunk_size: int = 2 ** 22
+
+    def __getitem__(self, index):
+        start, stop, _ = index[2].indices(self.shape[2])
+        plane = self.shape[0] * self.shape[1]
+        slab = np.zeros((self.shape[0], self.shape[1], stop - start), dtype=np.float32)
+        first, last = np.searchsorted(self.indices, [start * plane, stop * plane])
+        u, v, w = np.unravel_index(self.indices[first:last], self.shape, order='F')
+        slab[u, v, w - start] = self.values[first:last]
+        return slab
+
+    def write(self, words, path, encoding=None):
+        '''
+        :param words: Header words of the map, see MappedMap.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        return write_slabs(words, self, path, self.chunk_size, encoding=encoding)
+
+    def write_cutout(self, low, high, path, encoding=None):
+        '''
+        Write the box of the map between two orthogonal corners, as map_io.write_map_box writes it from the full cell.
+        :param low: Lowest orthogonal coordinates of the box.
+        :param high: Highest orthogonal coordinates of the box.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        cutout, start, index = cell_cutout(self.unit_cell, self.spacegroup, self.shape, low, high)
+        linear = np.ravel_multi_index(index, self.shape, order='F')
+        values = np.zeros(linear.shape, dtype=np.float32)
+        if len(self.indices) > 0:
+            found = np.minimum(np.searchsorted(self.indices, linear), len(self.indices) - 1)
+            present = self.indices[found] == linear
+            values[present] = self.values[found[present]]
+        np.array(cutout, copy=False)[:, :, :] = values
+        return map_io.write_grid_box(cutout, start, self.shape, path, encoding=encoding)
+
+
+def write_slabs(words, data, path, chunk_size, encoding=None):
+    '''
+    map_io.write_ccp4_data for maps that are not held in memory (SparseXmap, MappedMap), in slabs of at most
+    chunk_size grid points.
+    :param words: Header words of the map, see MappedMap.
+    :param data: SparseXmap or MappedMap.
+    :param path: Filepath of the uncompressed map.
+    :param chunk_size: Maximum number of grid points per slab.
+    :param encoding: None or one of map_io.map_encodings.
+    :return: str, filepath written.
+    '''
+    mode = map_io.quantised_modes[encoding][0] if encoding in map_io.quantised_modes else int(words[4 - 1])
+    return map_io.write_ccp4_data(words, data, path, encoding=encoding,
+                                  chunk_size=chunk_size * np.dtype(map_io.mode_dtypes[mode]).itemsize)
+
+
+def cell_cutout(unit_cell, spacegroup, shape, low, high):
+    '''
+    Grid of the box of a cell between two orthogonal corners, as map_io.write_map_box cuts it.
+    :param unit_cell: gemmi.UnitCell of the map.
+    :param spacegroup: gemmi.SpaceGroup of the map, or None (P1).
+    :param shape: (nu, nv, nw) of the grid of the cell.
+    :param low: Lowest orthogonal coordinates of the box.
+    :param high: Highest orthogonal coordinates of the box.
+    :return: (gemmi.FloatGrid of zeros of the size of the box, grid index of its first point (see
+        map_io.box_extent), np.ix_ index of its points in the (nu, nv, nw) array of the cell).
+    '''
+    start, size = map_io.box_extent(unit_cell, shape, low, high)
+    cutout = gemmi.FloatGrid(*[int(n) for n in size])
+    cutout.set_unit_cell(unit_cell)
+    cutout.spacegroup = gemmi.find_spacegroup_by_name('P 1') if spacegroup is None else spacegroup
+    return cutout, start, np.ix_(*[np.arange(s, s + n) % m for s, n, m in zip(start, size, shape)])
+
+
+@dataclasses.dataclass()
+class BoxXmap:
+    '''
+    A resampled map held as a box of its cell, as resample_many returns it with a box: grid holds the values of
+    the box (as a P1 map with the unit cell of the map), start is the grid index of its first point in the cell
+    (see map_io.box_extent) and shape the grid size of the cell. The points outside the reference mask are 0.
+    '''
+    grid: gemmi.FloatGrid
+    start: np.ndarray
+    shape: tuple
+
+    def write(self, path, encoding=None):
+        '''
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        return map_io.write_grid_box(self.grid, self.start, self.shape, path, encoding=encoding)
+
+    def write_cutout(self, low, high, path, encoding=None):
+        '''
+        Write a smaller box of the map, as map_io.write_map_box writes it from the full cell. Its points outside the
+        box of self are 0, as they would be in the full cell.
+        :param low: Lowest orthogonal coordinates of the cutout.
+        :param high: Highest orthogonal coordinates of the cutout.
+        :param path: Filepath of the uncompressed map.
+        :param encoding: None or one of map_io.map_encodings.
+        :return: str, filepath written.
+        '''
+        shape = np.array(self.shape)
+        start, size = map_io.box_extent(self.grid.unit_cell, shape, low, high)
+        cutout = gemmi.FloatGrid(*[int(n) for n in size])
+        cutout.set_unit_cell(self.grid.unit_cell)
+        cutout.spacegroup = self.grid.spacegroup
+        box_size = np.array([self.grid.nu, self.grid.nv, self.grid.nw])
+        # Position in the box of each index of the cutout along each axis, kept if within the box
+        offsets = [np.arange(s, s + n) - b for s, n, b in zip(start, size, self.start)]
+        offsets = [np.mod(offset, m) for offset, m in zip(offsets, shape)]
+        inside = [offset < n for offset, n in zip(offsets, box_size)]
+        np.array(cutout, copy=False)[np.ix_(*inside)] = \
+            np.array(self.grid, copy=False)[np.ix_(*[offset[keep] for offset, keep in zip(offsets, inside)])]
+        return map_io.write_grid_box(cutout, start, shape, path, encoding=encoding)
+
+
+def points_in_box(points, start, size, shape):
+    '''
+    Place grid points of the cell in a box of it, see BoxXmap.
+    :param points: (N, 3) grid indices within the cell.
+    :param start: Grid index of the first point of the box (see map_io.box_extent).
+    :param size: Number of points of the box along each axis.
+    :param shape: (nu, nv, nw) of the grid of the cell.
+    :return: (rows, box_points): the rows of points within the box and their (M, 3) indices in the box. A point is
+        listed once for each of its copies when the box is wider than the cell.
+    '''
+    shape = np.asarray(shape)
+    offsets = np.mod(points - np.asarray(start), shape)
+    all_rows, all_points = [], []
+    # Each point of the box is the copy of one point of the cell, only found in one of these
+    for copy in itertools.product(*[range(-(-int(n) // int(m))) for n, m in zip(size, shape)]):
+        shifted = offsets + np.array(copy) * shape
+        rows = np.nonzero(np.all(shifted < size, axis=1))[0]
+        all_rows.append(rows)
+        all_points.append(shifted[rows])
+    return np.concatenate(all_rows), np.concatenate(all_points)
+
+
+def referenceSave(template_map_path, xmap, path_to_save, template_map=None, encoding=None):
+    '''
+    Write xmap using the header of a template map. The data is written from xmap with the header words of the
+    template (see map_io.write_ccp4_data), the template is not modified.
+    :param template_map_path: Path of the template map, only read if template_map is not given.
+    :param xmap: Xmap to save.
+    :param path_to_save: Output path.
+    :param template_map: Optional gemmi.Ccp4Map already read (and setup) from template_map_path.
+    :param encoding: None or one of map_io.map_encodings, compressed maps are written to path_to_save.gz.
+    :return: str, filepath written.
+    '''
+    if template_map is None:
+        # Open Template map
+        template_map = gemmi.read_ccp4_map(str(template_map_path))
+        template_map.setup()
+    return map_io.write_ccp4_data(map_io.header_words(template_map), np.array(xmap.xmap, copy=False), path_to_save,
+                                  encoding=encoding)
+
+
+def gridFromTemplate(template, size=None):
+    '''
+    :param template: Xmap
+    :param size: Optional (nu, nv, nw) of a box of the cell (see BoxXmap), the grid is then P1.
+    :return: gemmi.FloatGrid of zeros with the unit cell of template, of its grid size or size.
+    '''
+    if size is not None:
+        interpolated_grid = gemmi.FloatGrid(*[int(n) for n in size])
+        interpolated_grid.set_unit_cell(template.xmap.unit_cell)
+        interpolated_grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        return interpolated_grid
+    interpolated_grid = gemmi.FloatGrid(
+        template.xmap.nu,
+        template.xmap.nv,
+        template.xmap.nw, )
+    interpolated_grid.set_unit_cell(template.xmap.unit_cell)
+    interpolated_grid.spacegroup = template.xmap.spacegroup
+    return interpolated_grid
@@ -6,7 +6,8 @@ import shutil
 from fragalysis_api import Align, set_up, convert_small_AA_chains, copy_extra_files, Sites, contextualize_crystal_ligands
 
 
-def import_single_file(in_file, out_dir, target, reduce_reference_frame, reference_pdb, biomol=None, covalent=False, self_ref=False, max_lig_len=0):
+def import_single_file(in_file, out_dir, target, reduce_reference_frame, reference_pdb, biomol=None, covalent=False, self_ref=False, max_lig_len=0,
+                       map_margin=None, map_encoding=None, in_memory=False):
     '''Formats a PDB file into fragalysis friendly format.
     1. Validates the naming of the pdbs.
     2. It aligns the pdbs (_bound.pdb file).
@@ -23,6 +24,9 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
     :param covalent: Bool, if True, will attempt to convert output .mol files to account for potential covalent attachments
     :param self_ref: Bool, if True, the import single file will align to itself.
     :max_lig_len: Integer, If >0 will convert all chains with fewer than max_lig_len residues to HETATM with the name LIG. [Currently broken, yikes]
+    :map_margin: Float, if given each ligand folder gets a box of the maps map_margin Angstrom around the ligand instead of the full maps.
+    :map_encoding: String, if given the aligned maps are written compressed (.gz): 'gzip' keeps the float values, 'int16' and 'int8' also quantise them.
+    :in_memory: Bool, if True the aligned structure and maps are handed straight to the ligand splitting and only written in the ligand folders, instead of going through the tmp{target} folder.
     :return: Hopefully, beautifully aligned files that be used with the fragalysis loader :)
     '''
 
@@ -31,7 +35,7 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
         os.makedirs(os.path.join(out_dir, 'aligned'))
         os.makedirs(os.path.join(out_dir, 'crystallographic'))
 
-    if not os.path.isdir(os.path.join(out_dir, f"tmp{target}/")):
+    if not in_memory and not os.path.isdir(os.path.join(out_dir, f"tmp{target}/")):
         os.makedirs(os.path.join(out_dir, f"tmp{target}/"))
 
     in_dir = os.path.dirname(in_file)
@@ -61,13 +65,39 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
     structure = Align(in_dir, "", rrf=reduce_reference_frame,
                       refset=False)
 
+    if in_memory:
+        # The aligned structure and maps go straight to the ligand splitting, nothing is written to tmp{target}
+        for aligned in structure.aligned_crystals(in_files=pdb_smiles_dict['pdb'],
+                                                  reference_file=in_file if self_ref else reference_pdb,
+                                                  sr=self_ref):
+            try:
+                _ = set_up(target_name=target,
+                           infile=None,
+                           out_dir=out_dir,
+                           rrf=reduce_reference_frame,
+                           smiles_file=None if aligned.smiles_file is None else os.path.abspath(aligned.smiles_file),
+                           biomol=biomol,
+                           covalent=covalent,
+                           keep_headers=True,
+                           map_margin=map_margin,
+                           aligned=aligned,
+                           map_encoding=map_encoding,
+                           name=aligned.name)
+
+            except AssertionError:
+                print(aligned.name, "is not suitable, please consider removal or editing")
+
+        finish_single_file(in_file=in_file, out_dir=out_dir, target=target)
+        return
+
     for i in pdb_smiles_dict['pdb']:
         if self_ref:
             structure.align_to_reference(
-                i, i, out_dir=os.path.join(out_dir, f"tmp{target}"), sr=True)
+                i, i, out_dir=os.path.join(out_dir, f"tmp{target}"), sr=True, map_encoding=map_encoding)
         else:
             structure.align_to_reference(
-                i, reference_pdb=reference_pdb, out_dir=os.path.join(out_dir, f"tmp{target}"), sr=False)
+                i, reference_pdb=reference_pdb, out_dir=os.path.join(out_dir, f"tmp{target}"), sr=False,
+                map_encoding=map_encoding)
 
     for smiles_file in pdb_smiles_dict['smiles']:
         if smiles_file:
@@ -97,7 +127,8 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
                            smiles_file=os.path.abspath(smiles),
                            biomol=biomol,
                            covalent=covalent,
-                           keep_headers=True)
+                           keep_headers=True,
+                           map_margin=map_margin)
 
             else:
                 _ = set_up(target_name=target,
@@ -106,7 +137,8 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
                            rrf=reduce_reference_frame,
                            biomol=biomol,
                            covalent=covalent,
-                           keep_headers=True)
+                           keep_headers=True,
+                           map_margin=map_margin)
 
         except AssertionError:
             print(aligned, "is not suitable, please consider removal or editing")
@@ -114,6 +146,15 @@ def import_single_file(in_file, out_dir, target, reduce_reference_frame, referen
                 if str(aligned) in file:
                     os.remove(os.path.join(out_dir, f"tmp{target}", str(file)))
 
+    finish_single_file(in_file=in_file, out_dir=out_dir, target=target)
+
+
+def finish_single_file(in_file, out_dir, target):
+    '''Copies the input files of an imported pdb to the crystallographic folder of the target and removes the tmp folders.
+    :param in_file: Filepath of the imported pdb, the files next to it sharing its name are copied too.
+    :param out_dir: Directory containing the processed pdbs.
+    :param target: Name of the target folder inside out_dir.
+    '''
     # Write clever method to copy in_file
     dest_dir = os.path.join(out_dir, target, 'crystallographic')
     globstr = in_file.replace('.pdb', '*')
@@ -169,6 +210,24 @@ if __name__ == "__main__":
                         help="Int, Convert all chains shorter than max_lig_len to HETATM LIG",
                         required=False,
                         default=0)
+    parser.add_argument("-mm",
+                        "--map_margin",
+                        help="Float, Cut the maps to a box with this margin (in Angstrom) around each ligand",
+                        type=float,
+                        required=False,
+                        default=None)
+    parser.add_argument("-im",
+                        "--in_memory",
+                        action="store_true",
+                        help="Hand the aligned structure and maps straight to the ligand splitting, without the tmp folder",
+                        required=False,
+                        default=False)
+    parser.add_argument("-me",
+                        "--map_encoding",
+                        help="Write the aligned maps compressed (gzip) or quantised and compressed (int16, int8)",
+                        choices=['gzip', 'int16', 'int8'],
+                        required=False,
+                        default=None)
 
     parser.add_argument(
         "-cs",
@@ -205,6 +264,9 @@ if __name__ == "__main__":
     covalent = args["covalent"]
     self_ref = args['self_reference']
     mll = args['max_lig_len']
+    map_margin = args['map_margin']
+    map_encoding = args['map_encoding']
+    in_memory = args['in_memory']
     cs = args['cluster_sites']
     cs_com = args['cluster_sites_com']
     cs_other = args['cluster_sites_other']
@@ -232,7 +294,10 @@ if __name__ == "__main__":
                            biomol=biomol,
                            covalent=covalent,
                            self_ref=self_ref,
-                           max_lig_len=mll)
+                           max_lig_len=mll,
+                           map_margin=map_margin,
+                           map_encoding=map_encoding,
+                           in_memory=in_memory)
         print(f'File has been aligned to {reference_pdb}')
         if cs:
             folder = os.path.join(out_dir, target)
@@ -12,7 +12,10 @@ from distutils.dir_util import copy_tree
 
 
 def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_reference_frame=False, biomol=None, covalent=False,
-               pdb_ref="", max_lig_len=0):
+               pdb_ref="", max_lig_len=0, jobs=1, map_margin=None, map_encoding=None,
+               align_cache=None, pipeline_depth=0, in_memory=False, replay_transforms=None,
+               map_box=None, memory_budget=None, chain_jobs=1,
+               asymmetric_unit=False):
     """Formats a lists of PDB files into fragalysis friendly format.
     1. Validates the naming of the pdbs.
     2. It aligns the pdbs (_bound.pdb file).
@@ -32,9 +35,24 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
     :param covalent: Bool, if True, will attempt to convert output .mol files to account for potential covalent attachments
     :pdb_ref: String, if provided, all pdb files will be aligned to the name of the file (sans extnesion) that is specified.
     :max_lig_len: Integer, If >0 will convert all chains with fewer than max_lig_len residues to HETATM with the name LIG. [Currently broken, yikes]
+    :jobs: Integer, number of processes used to align the crystals (and read them to choose the reference) in parallel.
+    :map_margin: Float, if given each ligand folder gets a box of the maps map_margin Angstrom around the ligand instead of the full maps.
+    :map_encoding: String, if given the aligned maps are written compressed (.gz): 'gzip' keeps the float values, 'int16' and 'int8' also quantise them.
+    :align_cache: String, optional directory where the aligned files of every crystal are kept. Crystals that did not change since a previous import using the same directory are not aligned again, and the resolution and length of the input pdbs are cached in it to choose the reference.
+    :pipeline_depth: Integer, if >0 (and jobs is 1) the crystals are read up to pipeline_depth ahead and the aligned files written in the background, overlapping disk access with the alignment.
+    :in_memory: Bool, if True the aligned structures and maps are handed straight to the ligand splitting and only written in the ligand folders, instead of going through the tmp{target} folder. Aligns in a single process, so it cannot be combined with jobs > 1 or align_cache.
+    :replay_transforms: String, optional output directory of a previous import of the target (out_dir/target, holding reference.pdb and the transforms folder), or a directory of the {name}_transform.json files of a previous alignment. The pdbs and maps are then moved with these transforms instead of being aligned (crystals without one are skipped), and the maps are resampled around the reference they were aligned to: the pdb_ref of in_dir if given, otherwise the reference.pdb of the previous import.
+    :map_box: Float, if given the aligned maps are written as P1 boxes around the reference model with this margin (in Angstrom) instead of the full unit cell.
+    :memory_budget: Float, if given maps larger than memory_budget megabytes are memory-mapped and resampled around the reference model only, instead of being read whole.
+    :chain_jobs: Integer, number of threads aligning the chains of a crystal (and resampling their maps) at once when reduce_reference_frame is set.
+    :asymmetric_unit: Bool, if True the maps are symmetrized per set of symmetry mates around the reference model instead of over the whole cell. The maps are the same.
     :return: Hopefully, beautifully aligned files that be used with the fragalysis loader :)
     """
 
+    if in_memory and (jobs > 1 or align_cache is not None):
+        raise ValueError('in_memory aligns in a single process without the alignment cache, jobs must be 1 and '
+                         'align_cache None')
+
     if validate:
         validation = Validate(in_dir)
 
@@ -56,7 +74,7 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
         os.makedirs(os.path.join(out_dir, 'aligned'))
         os.makedirs(os.path.join(out_dir, 'crystallographic'))
 
-    if not os.path.isdir(os.path.join(out_dir, f"tmp{target}/")):
+    if not in_memory and not os.path.isdir(os.path.join(out_dir, f"tmp{target}/")):
         os.makedirs(os.path.join(out_dir, f"tmp{target}/"))
 
     in_dir2 = in_dir
@@ -88,10 +106,63 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
                 pdb_smiles_dict['smiles'].append(None)
 
     print(pdb_smiles_dict['smiles'])
+    # Replaying skips choosing a reference, the transforms point to the one of the previous import
+    reference_file = None
+    if replay_transforms is not None:
+        replay_transforms, reference_file = replay_inputs(replay_transforms, in_dir, pdb_ref)
     print("Aligning protein structures")
+    # With an alignment cache, the resolution and length of every input pdb are kept next to the aligned files
+    # so re-imports choose the reference quickly
+    stats_cache = None
+    if align_cache is not None:
+        os.makedirs(align_cache, exist_ok=True)
+        stats_cache = os.path.join(align_cache, 'reference_stats.json')
     structure = Align(directory=in_dir, pdb_ref=pdb_ref,
-                      rrf=reduce_reference_frame)
-    structure.align(out_dir=os.path.join(out_dir, f"tmp{target}"))
+                      rrf=reduce_reference_frame,
+                      stats_cache=stats_cache,
+                      ref_jobs=jobs,
+                      box_margin=map_box,
+                      memory_budget=None if memory_budget is None else int(memory_budget * 2 ** 20),
+                      chain_jobs=chain_jobs,
+                      asymmetric_unit=asymmetric_unit)
+    if in_memory:
+        # The aligned structures and maps go straight to the ligand splitting, nothing is written to tmp{target}
+        print("Identifying ligands")
+        if replay_transforms is not None:
+            crystals = structure.replayed_crystals(transform_dir=replay_transforms, reference_file=reference_file)
+        else:
+            crystals = structure.aligned_crystals(pipeline_depth=pipeline_depth)
+        for aligned in crystals:
+            try:
+                _ = set_up(target_name=target,
+                           infile=None,
+                           out_dir=out_dir,
+                           rrf=reduce_reference_frame,
+                           smiles_file=None if aligned.smiles_file is None else os.path.abspath(aligned.smiles_file),
+                           biomol=biomol,
+                           covalent=covalent,
+                           keep_headers=True,
+                           map_margin=map_margin,
+                           aligned=aligned,
+                           map_encoding=map_encoding,
+                           name=aligned.name)
+                transform_dir = os.path.join(out_dir, target, 'transforms')
+                os.makedirs(transform_dir, exist_ok=True)
+                aligned.transform.to_json(filename=os.path.join(transform_dir, f'{aligned.name}_transform.json'))
+
+            except AssertionError:
+                print(aligned.name, "is not suitable, please consider removal or editing")
+
+        finish_target(structure=structure, in_dir=in_dir2, out_dir=out_dir, target=target, metadata=metadata,
+                      reference_file=reference_file)
+        return
+
+    if replay_transforms is not None:
+        structure.replay(out_dir=os.path.join(out_dir, f"tmp{target}"), transform_dir=replay_transforms,
+                         map_encoding=map_encoding, reference_file=reference_file)
+    else:
+        structure.align(out_dir=os.path.join(out_dir, f"tmp{target}"), jobs=jobs, map_encoding=map_encoding,
+                        cache_dir=align_cache, pipeline_depth=pipeline_depth)
 
     for smiles_file in pdb_smiles_dict['smiles']:
         if smiles_file:
@@ -126,7 +197,8 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
                            smiles_file=os.path.abspath(smiles),
                            biomol=biomol,
                            covalent=covalent,
-                           keep_headers=True)
+                           keep_headers=True,
+                           map_margin=map_margin)
 
             else:
                 _ = set_up(target_name=target,
@@ -135,7 +207,8 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
                            rrf=reduce_reference_frame,
                            biomol=biomol,
                            covalent=covalent,
-                           keep_headers=True)
+                           keep_headers=True,
+                           map_margin=map_margin)
 
         except AssertionError:
             print(aligned, "is not suitable, please consider removal or editing")
@@ -143,6 +216,41 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
                 if str(aligned) in file:
                     os.remove(os.path.join(out_dir, f"tmp{target}", str(file)))
 
+    finish_target(structure=structure, in_dir=in_dir2, out_dir=out_dir, target=target, metadata=metadata,
+                  reference_file=reference_file)
+
+
+def replay_inputs(replay_transforms, in_dir, pdb_ref=""):
+    """Finds the transforms and the reference of a replay (see xcimporter replay_transforms).
+    :param replay_transforms: Output directory of a previous import of the target, or a directory of transform files.
+    :param in_dir: Directory of the input files.
+    :param pdb_ref: String, if provided the name of the pdb of in_dir (sans extension) the transforms align to.
+    :return: (directory of the {name}_transform.json files, filepath of the reference pdb)
+    """
+    transform_dir = replay_transforms
+    if os.path.isdir(os.path.join(replay_transforms, 'transforms')):
+        transform_dir = os.path.join(replay_transforms, 'transforms')
+    if pdb_ref:
+        reference_file = os.path.join(in_dir, f'{pdb_ref}.pdb')
+    else:
+        reference_file = os.path.join(replay_transforms, 'reference.pdb')
+    if not os.path.isfile(reference_file):
+        raise ValueError(f'{reference_file} does not exist, replaying transforms needs the reference they align to: '
+                         f'give pdb_ref or the output directory of a previous import')
+    return transform_dir, reference_file
+
+
+def finish_target(structure, in_dir, out_dir, target, metadata=False, reference_file=None):
+    """Writes the metadata, reference and transforms of an imported target, copies its input files and removes the tmp
+    folders.
+    :param structure: The Align object the crystals were aligned with.
+    :param in_dir: Directory of the input files, copied to out_dir/target/crystallographic.
+    :param out_dir: Directory containing the processed pdbs.
+    :param target: Name of the target folder inside out_dir.
+    :param metadata: If True, the meta.csv files of the ligands are collected into out_dir/target/metadata.csv.
+    :param reference_file: Optional filepath of the reference pdb (of replayed transforms), otherwise the reference
+        structure chosen is written.
+    """
     if metadata:
         print("Preparing metadata file")
         metadata_fp = os.path.join(out_dir, target, "metadata.csv")
@@ -157,10 +265,21 @@ def xcimporter(in_dir, out_dir, target, metadata=False, validate=False, reduce_r
                             f.write(line)
 
     # Copy reference pdb to aligned folder as: reference.pdb, so single_import can file off with ease.
-    structure.write_align_ref(output=os.path.join(out_dir, target))
+    if reference_file is None:
+        structure.write_align_ref(output=os.path.join(out_dir, target))
+    elif not os.path.isfile(os.path.join(out_dir, target, 'reference.pdb')) or not os.path.samefile(
+            reference_file, os.path.join(out_dir, target, 'reference.pdb')):
+        copyfile(reference_file, os.path.join(out_dir, target, 'reference.pdb'))
+
+    # Keep the transform of every crystal (written to tmp{target} by the alignment), so that a later import can replay
+    # them, see replay_transforms
+    transform_dir = os.path.join(out_dir, target, 'transforms')
+    for transform_file in glob.glob(os.path.join(out_dir, f'tmp{target}', '*_transform.json')):
+        os.makedirs(transform_dir, exist_ok=True)
+        copyfile(transform_file, os.path.join(transform_dir, os.path.basename(transform_file)))
 
     # Move input files into Target/crystallographic folder
-    copy_tree(in_dir2, os.path.join(out_dir, target, 'crystallographic'))
+    copy_tree(in_dir, os.path.join(out_dir, target, 'crystallographic'))
 
     # Time to use a for loop?
     clean_up = [os.path.join(out_dir, f'maxliglen{target}'), os.path.join(
@@ -210,6 +329,70 @@ if __name__ == "__main__":
                         help="Int, Convert all chains shorter than max_lig_len to HETATM LIG",
                         required=False,
                         default=0)
+    parser.add_argument("-j",
+                        "--jobs",
+                        help="Int, Number of processes to align crystals with",
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument("-mm",
+                        "--map_margin",
+                        help="Float, Cut the maps to a box with this margin (in Angstrom) around each ligand",
+                        type=float,
+                        required=False,
+                        default=None)
+    parser.add_argument("-me",
+                        "--map_encoding",
+                        help="Write the aligned maps compressed (gzip) or quantised and compressed (int16, int8)",
+                        choices=['gzip', 'int16', 'int8'],
+                        required=False,
+                        default=None)
+    parser.add_argument("-ac",
+                        "--align_cache",
+                        help="Directory keeping the aligned files, unchanged crystals are restored from it instead of being realigned",
+                        required=False,
+                        default=None)
+    parser.add_argument("-im",
+                        "--in_memory",
+                        action="store_true",
+                        help="Hand the aligned structures and maps straight to the ligand splitting, without the tmp folder",
+                        required=False,
+                        default=False)
+    parser.add_argument("-pd",
+                        "--pipeline_depth",
+                        help="Int, Number of crystals read ahead while aligning (the outputs are then written in the background)",
+                        type=int,
+                        required=False,
+                        default=0)
+    parser.add_argument("-mb",
+                        "--map_box",
+                        help="Float, Write the aligned maps as P1 boxes around the reference model with this margin (in Angstrom)",
+                        type=float,
+                        required=False,
+                        default=None)
+    parser.add_argument("-mem",
+                        "--memory_budget",
+                        help="Float, Maps larger than this many megabytes are memory-mapped and resampled out of core",
+                        type=float,
+                        required=False,
+                        default=None)
+    parser.add_argument("-cj",
+                        "--chain_jobs",
+                        help="Int, Number of threads aligning the chains of a crystal at once with -rrf",
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument("-asu",
+                        "--asymmetric_unit",
+                        action="store_true",
+                        help="Symmetrize the maps per set of symmetry mates around the reference model instead of over the whole cell",
+                        required=False,
+                        default=False)
+    parser.add_argument("-rt",
+                        "--replay_transforms",
+                        help="Output directory of a previous import of the target (or a directory of _transform.json files), apply its transforms instead of aligning again",
+                        required=False,
+                        default=None)
 
     parser.add_argument(
         "-cs",
@@ -236,6 +419,9 @@ if __name__ == "__main__":
         default=1.00
     )
     args = vars(parser.parse_args())
+    if args['in_memory'] and (args['jobs'] > 1 or args['align_cache'] is not None):
+        parser.error('--in_memory aligns in a single process without the alignment cache, '
+                     'it cannot be used with --jobs or --align_cache')
 
     # user_id = args['user_id']
     in_dir = args["in_dir"]
@@ -247,6 +433,17 @@ if __name__ == "__main__":
     biomol = args["biomol_txt"]
     covalent = args["covalent"]
     mll = args['max_lig_len']
+    jobs = args['jobs']
+    map_margin = args['map_margin']
+    map_encoding = args['map_encoding']
+    align_cache = args['align_cache']
+    pipeline_depth = args['pipeline_depth']
+    in_memory = args['in_memory']
+    replay_transforms = args['replay_transforms']
+    map_box = args['map_box']
+    memory_budget = args['memory_budget']
+    chain_jobs = args['chain_jobs']
+    asymmetric_unit = args['asymmetric_unit']
     cs = args['cluster_sites']
     cs_com = args['cluster_sites_com']
     cs_other = args['cluster_sites_other']
@@ -272,7 +469,18 @@ if __name__ == "__main__":
                biomol=biomol,
                covalent=covalent,
                pdb_ref=reference,
-               max_lig_len=mll
+               max_lig_len=mll,
+               jobs=jobs,
+               map_margin=map_margin,
+               map_encoding=map_encoding,
+               align_cache=align_cache,
+               pipeline_depth=pipeline_depth,
+               in_memory=in_memory,
+               replay_transforms=replay_transforms,
+               map_box=map_box,
+               memory_budget=memory_budget,
+               chain_jobs=chain_jobs,
+               asymmetric_unit=asymmetric_unit
                )
     if cs:
         folder = os.path.join(out_dir, target)
@@ -1,4 +1,6 @@
+import filecmp
 import shutil
+import tracemalloc
 import unittest
 import os
 from pathlib import Path
@@ -7,7 +9,16 @@ from fragalysis_api import Align, set_up
 from glob import glob
 from shutil import rmtree
 
-from fragalysis_api.xcimporter.align import Structure
+import gemmi
+import numpy as np
+from pandda_gemmi.pandda_types import Xmap
+
+from fragalysis_api.xcimporter.align import Structure, StructureContext, assign_small_mols_to_chains, \
+    find_water_chains, split_chain_str, CAIndex, Transform, scan_pdb_stats, pdb_stats, can_rrf, SequenceScoreCache, \
+    read_ahead, BackgroundWriter
+from fragalysis_api.xcimporter.map_resample import resample, resample_reference, CrystalMap, referenceSave, \
+    ReferenceGeometryCache, gridFromTemplate, resample_many, symmetrize, ReferenceGeometry, grid_mates, model_box, \
+    MappedMap, mapped_chunk_size, resample_mapped, stats_point_bytes, resample_point_bytes, write_point_bytes
 
 
 class AlignTest(unittest.TestCase):
@@ -75,6 +86,33 @@ class EasyAlign(AlignTest):
                        for x in test_cases]
         [self.assertTrue(x) for x in test_exists]
 
+    def test_c_align_with_jobs(self):
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_map_jobs')
+        serial_dir = os.path.join('tests', 'data_for_tests', 'tmp_map')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self.align_obj_w_maps.align(out_dir=dir, jobs=2)
+        self.assertCountEqual(os.listdir(dir), os.listdir(serial_dir))
+        for x in os.listdir(serial_dir):
+            if x.endswith('_bound.pdb'):
+                self.assertTrue(filecmp.cmp(os.path.join(dir, x), os.path.join(serial_dir, x), shallow=False))
+
+    def test_d_replay_transforms(self):
+        """
+        tests that replaying the transforms of an alignment (to the same reference region) gives the same files
+        """
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_map_replay')
+        serial_dir = os.path.join('tests', 'data_for_tests', 'tmp_map')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        align_obj = Align(self.align_obj_w_maps.directory, refset=False)
+        align_obj.replay(out_dir=dir, transform_dir=serial_dir,
+                         reference_file=os.path.join(self.align_obj_w_maps.directory,
+                                                     f'{self.align_obj_w_maps._get_ref}.pdb'))
+        self.assertCountEqual(os.listdir(dir), os.listdir(serial_dir))
+        for x in os.listdir(serial_dir):
+            self.assertTrue(filecmp.cmp(os.path.join(dir, x), os.path.join(serial_dir, x), shallow=False))
+
     def test_align_rrf(self):
         dir = os.path.join('tests', 'data_for_tests', 'tmp_rrf')
         if not os.path.exists(dir):
@@ -86,6 +124,23 @@ class EasyAlign(AlignTest):
             os.path.join(dir, x)) for x in rrf_test_cases]
         [self.assertTrue(x) for x in rrf_test_exists]
 
+    def test_align_chains_with_threads(self):
+        """
+        tests that aligning the chains of a crystal in threads gives the same structures, in the same order
+        """
+        directory = os.path.join('tests', 'data_for_tests', 'examples_to_test2')
+        in_file = os.path.join(directory, '5g1o.pdb')
+        reference_file = os.path.join(directory, '5g1n.pdb')
+        reference_pdb = Structure.from_file(Path(reference_file))
+        aligned = {}
+        for chain_jobs in (1, 3):
+            align_obj = Align(directory, rrf=True, refset=False, chain_jobs=chain_jobs)
+            aligned[chain_jobs] = [(x.name, x.pdb_lines()) for x in
+                                   align_obj.align_chains(name='5g1o', in_file=in_file, reference_pdb=reference_pdb,
+                                                          reference_file=reference_file)]
+        self.assertEqual([x[0] for x in aligned[1]], [f'5g1o_{chain}' for chain in 'ABCDEF'])
+        self.assertEqual(aligned[1], aligned[3])
+
     def test_z_structure_class_tests(self):
         path = os.path.join('tests', 'data_for_tests',
                             'examples_to_test5', 'Mpro-x2119.pdb')
@@ -95,6 +150,339 @@ class EasyAlign(AlignTest):
         self.assertEqual(len([i for i in struc.protein_atoms()]), 2374)
         self.assertEqual(len([i for i in struc.all_atoms()]), 2732)
 
+    def test_structure_context(self):
+        path = os.path.join('tests', 'data_for_tests',
+                            'examples_to_test5', 'Mpro-x2119.pdb')
+        context = StructureContext.from_file(path)
+        self.assertCountEqual(context.water_chains, find_water_chains(path))
+        self.assertCountEqual(split_chain_str(
+            path, context=context), split_chain_str(path))
+        from_context = assign_small_mols_to_chains(context=context)
+        from_file = assign_small_mols_to_chains(f=path)
+        self.assertEqual([x.name for x in from_context.structure[0]],
+                         [x.name for x in from_file.structure[0]])
+        self.assertEqual(len([i for i in from_context.all_atoms()]),
+                         len([i for i in from_file.all_atoms()]))
+        # The parsed structure is left untouched for the next chain
+        self.assertEqual(len([i for i in Structure(context.structure).all_atoms()]), 2732)
+
+    def test_contact_chain_assignments(self):
+        """
+        tests that a small molecule chain goes to the protein chain it touches, even when the center of mass of another
+        chain is nearer, and to the nearest center of mass when it touches none
+        """
+        line = '{:6}{:5d}  CA  {} {}{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00 20.00           C\n'
+        lines = [line.format('ATOM', i + 1, 'ALA', 'A', i + 1, 2.0 * i, 0, 0) for i in range(21)]
+        lines += [line.format('ATOM', 30 + i, 'ALA', 'B', i + 1, 60.0 + 2.0 * i, 0, 0) for i in range(3)]
+        lines += [line.format('HETATM', 40, 'LIG', 'C', 1, 42.0, 0, 0),
+                  line.format('HETATM', 41, 'LIG', 'D', 1, 200.0, 0, 0)]
+        structure = gemmi.read_pdb_string(''.join(lines) + 'END\n')
+        context = StructureContext.from_structure(structure)
+        self.assertCountEqual(context.small_mol_chains, ['C', 'D'])
+        self.assertLess(context.chain_centers['C'].dist(context.chain_centers['B']),
+                        context.chain_centers['C'].dist(context.chain_centers['A']))
+        self.assertEqual(context.chain_assignments, {'C': 'A', 'D': 'B'})
+        assigned = assign_small_mols_to_chains(context=context)
+        self.assertEqual([x.name for x in assigned.structure[0]], ['A', 'B'])
+
+    def test_transform_many(self):
+        reference = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')))
+        # atom.pos is a reference to the atom, the coordinates are copied before align_to moves them
+        array = np.array([Transform.pos_to_list(atom.pos) for atom in moving.all_atoms()])
+        moving, transform = moving.align_to(reference)
+        self.assertTrue(np.array_equal(transform.apply_many(array),
+                                       [Transform.pos_to_list(transform.apply(gemmi.Position(*pos)))
+                                        for pos in array]))
+        self.assertTrue(np.array_equal(transform.apply_inverse_many(array),
+                                       [Transform.pos_to_list(atom.pos) for atom in moving.all_atoms()]))
+
+    def test_identity_transform(self):
+        """
+        tests that a crystal aligned to itself is recognised as not moving and is left exactly as it was read
+        """
+        path = os.path.join('tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')
+        other = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(path))
+        positions = np.array([Transform.pos_to_list(atom.pos) for atom in moving.all_atoms()])
+        moving, transform = moving.align_to(Structure.from_file(Path(path)), identity_tolerance=1e-4)
+        self.assertTrue(transform.is_identity(positions, 1e-4))
+        self.assertTrue(np.array_equal([Transform.pos_to_list(atom.pos) for atom in moving.all_atoms()], positions))
+        # The maps of a chain are written without being resampled, decided once per transform
+        self.assertTrue(self.align_obj_w_maps.is_identity(transform, moving, ReferenceGeometryCache()))
+        self.assertFalse(Align(self.align_obj_w_maps.directory, refset=False,
+                               identity_tolerance=None).is_identity(transform, moving))
+        moving, transform = Structure.from_file(Path(path)).align_to(other, identity_tolerance=1e-4)
+        self.assertFalse(transform.is_identity(positions, 1e-4))
+        self.assertFalse(self.align_obj_w_maps.is_identity(transform, other))
+
+    def test_can_rrf_sequence_cache(self):
+        files = sorted(glob(os.path.join('tests', 'data_for_tests', 'examples_to_test5', '*.pdb')))
+        reference = Structure.from_file(Path(files[0]))
+        cache = SequenceScoreCache()
+        shared = [can_rrf(f, files[0], reference=reference, sequence_cache=cache) for f in files]
+        self.assertEqual(shared, [can_rrf(f, files[0]) for f in files])
+        # Identical chains are only aligned once
+        self.assertEqual(len(cache._scores), 1)
+
+    def test_ca_index(self):
+        structure = gemmi.read_structure(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test0', '6epu.pdb'))
+        index = CAIndex.from_structure(structure)
+        keys = []
+        expected = []
+        for model in structure:
+            for chain in model:
+                for res in chain.get_polymer():
+                    keys.append((model.name, chain.name, res.seqid.num))
+                    expected.append(structure[model.name][chain.name][str(res.seqid.num)][0]['CA'][0].pos.tolist())
+        keys.append((structure[0].name, 'not a chain', 1))
+        found, positions = index.lookup(keys)
+        self.assertTrue(np.all(found[:-1]))
+        self.assertFalse(found[-1])
+        self.assertTrue(np.array_equal(positions[:-1], np.array(expected)))
+
+    def test_resample_matches_reference(self):
+        reference = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')))
+        moving, transform = moving.align_to(reference)
+        grid = gemmi.FloatGrid(76, 36, 30)
+        grid.set_unit_cell(moving.structure.cell)
+        grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=(76, 36, 30))
+        xmap = Xmap(grid)
+        vectorised = np.array(resample(xmap, transform, reference).xmap)
+        dense = np.array(resample(xmap, transform, reference, sparse=False).xmap)
+        point_by_point = np.array(resample_reference(xmap, transform, reference).xmap)
+        self.assertGreater(np.count_nonzero(point_by_point), 0)
+        self.assertTrue(np.allclose(vectorised, point_by_point, atol=1e-6))
+        self.assertTrue(np.array_equal(vectorised, dense))
+
+        # The cached geometry is built on the first call and reused while the grid geometry is unchanged
+        cache = ReferenceGeometryCache()
+        cached = np.array(resample(xmap, transform, reference, geometry_cache=cache).xmap)
+        self.assertIs(cache.get(xmap, reference), cache.get(Xmap(gridFromTemplate(xmap)), reference))
+        self.assertTrue(np.array_equal(vectorised, cached))
+
+        # Several maps, on two grid geometries, resampled in one call
+        other_grid = gemmi.FloatGrid(60, 30, 24)
+        other_grid.set_unit_cell(moving.structure.cell)
+        other_grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(other_grid, copy=False)[:, :, :] = np.random.RandomState(1).normal(size=(60, 30, 24))
+        scaled = Xmap(gridFromTemplate(xmap))
+        np.array(scaled.xmap, copy=False)[:, :, :] = np.array(xmap.xmap) * 2.0
+        xmaps = [xmap, Xmap(other_grid), scaled]
+        together = resample_many(xmaps, transform, reference)
+        for single, many in zip(xmaps, together):
+            self.assertTrue(np.array_equal(np.array(resample(single, transform, reference).xmap),
+                                           np.array(many.xmap)))
+
+    def test_resample_asymmetric_unit(self):
+        """
+        tests that symmetrizing per orbit gives the symmetrized map, the orbits where the mask overlaps its own
+        symmetry mates included
+        """
+        reference = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')))
+        moving, transform = moving.align_to(reference)
+        for name in ('P 1', 'C 1 2 1'):
+            grid = gemmi.FloatGrid(76, 36, 30)
+            grid.set_unit_cell(moving.structure.cell)
+            grid.spacegroup = gemmi.find_spacegroup_by_name(name)
+            np.array(grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=(76, 36, 30))
+            xmap = Xmap(grid)
+            symmetrized = np.array(resample_many([xmap], transform, reference)[0].xmap)
+            asymmetric_unit = np.array(resample_many([xmap], transform, reference, asymmetric_unit=True)[0].xmap)
+
+            # Orbits holding several distinct points of the mask
+            shape = np.array(symmetrized.shape)
+            geometry = ReferenceGeometry.from_xmap(xmap, reference)
+            orbit_keys = grid_mates(geometry.points, shape, grid.spacegroup).min(axis=1)
+            distinct = np.unique(np.ravel_multi_index(geometry.points.T, shape, order='F'), return_index=True)[1]
+            keys, counts = np.unique(orbit_keys[distinct], return_counts=True)
+            all_points = np.argwhere(np.ones(shape, dtype=bool))
+            overlapping = np.isin(grid_mates(all_points, shape, grid.spacegroup).min(axis=1),
+                                  keys[counts > 1]).reshape(shape)
+
+            self.assertEqual(np.count_nonzero(overlapping) > 0, name != 'P 1')
+            self.assertGreater(np.count_nonzero(asymmetric_unit), 0)
+            self.assertTrue(np.array_equal(symmetrized, asymmetric_unit))
+
+    def test_resample_box(self):
+        """
+        tests that resampling into a box of the cell gives the values of the full cell resampled, wrapping around the
+        cell for a box wider than it
+        """
+        reference = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')))
+        moving, transform = moving.align_to(reference)
+        grid = gemmi.FloatGrid(76, 36, 30)
+        grid.set_unit_cell(moving.structure.cell)
+        grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=(76, 36, 30))
+        xmap = Xmap(grid)
+        # In P1 symmetrize doubles the values
+        full = np.array(resample_many([xmap], transform, reference)[0].xmap) / 2
+        low, high = model_box(reference, 5.0)
+        centre = (low + high) / 2
+        for corners, wider in [((centre - 8, centre + 8), False), ((low, high), True)]:
+            box = resample_many([xmap], transform, reference, box=corners)[0]
+            size = np.array([box.grid.nu, box.grid.nv, box.grid.nw])
+            self.assertEqual(np.any(size > full.shape), wider)
+            index = np.ix_(*[np.arange(s, s + n) % m for s, n, m in zip(box.start, size, full.shape)])
+            self.assertGreater(np.count_nonzero(np.array(box.grid)), 0)
+            self.assertTrue(np.array_equal(np.array(box.grid), full[index]))
+
+    def test_symmetrize(self):
+        grid = gemmi.FloatGrid(24, 32, 40)
+        grid.set_unit_cell(gemmi.UnitCell(30, 40, 50, 90, 90, 90))
+        grid.spacegroup = gemmi.find_spacegroup_by_name('P 21 21 21')
+        values = np.zeros((24, 32, 40), dtype=np.float32)
+        values[2:10, 5:12, 8:20] = np.random.RandomState(0).normal(size=(8, 7, 12))
+        np.array(grid, copy=False)[:, :, :] = values
+        pos = gemmi.FloatGrid(24, 32, 40)
+        pos.set_unit_cell(grid.unit_cell)
+        pos.spacegroup = grid.spacegroup
+        np.array(pos, copy=False)[:, :, :] = values
+        pos.symmetrize_max()
+        neg = gemmi.FloatGrid(24, 32, 40)
+        neg.set_unit_cell(grid.unit_cell)
+        neg.spacegroup = grid.spacegroup
+        np.array(neg, copy=False)[:, :, :] = -values
+        neg.symmetrize_max()
+        # The result is written in place, into the grid passed in
+        result = symmetrize(grid, Xmap(grid))
+        self.assertIs(result, grid)
+        self.assertTrue(np.array_equal(np.array(result), np.array(pos) - np.array(neg)))
+
+    def test_pipeline_helpers(self):
+        self.assertEqual(list(read_ahead(lambda x: x * 2, [1, 2, 3, 4], depth=2)), [2, 4, 6, 8])
+
+        def read(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        results = read_ahead(read, [1, 2, 3, 4])
+        self.assertEqual([next(results), next(results)], [1, 2])
+        self.assertRaises(ValueError, next, results)
+
+        done = []
+        writer = BackgroundWriter(max_pending=1)
+        for i in range(5):
+            writer.submit(done.append, i)
+        writer.close()
+        self.assertEqual(done, [0, 1, 2, 3, 4])
+
+        def fail():
+            raise IOError('disk full')
+        writer = BackgroundWriter()
+        writer.submit(fail)
+        try:
+            # Raised here if the first call already failed
+            writer.submit(done.append, 5)
+        except IOError:
+            pass
+        self.assertRaises(IOError, writer.close)
+        self.assertNotIn(5, done)
+
+    def test_crystal_map_read_once(self):
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_crystal_map')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        ccp4 = gemmi.Ccp4Map()
+        ccp4.grid = gemmi.FloatGrid(20, 24, 28)
+        ccp4.grid.set_unit_cell(gemmi.UnitCell(40, 48, 56, 90, 90, 90))
+        ccp4.grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        array = np.array(ccp4.grid, copy=False)
+        array[:, :, :] = np.random.RandomState(0).normal(3.0, 2.0, size=(20, 24, 28))
+        array[0, 0, 0] = np.nan
+        ccp4.update_ccp4_header(2, True)
+        ccp4.write_ccp4_map(os.path.join(dir, 'test.ccp4'))
+
+        crystal_map = CrystalMap.from_file(Path(os.path.join(dir, 'test.ccp4')))
+        normalised = np.array(crystal_map.xmap.xmap, copy=False)
+        self.assertAlmostEqual(float(np.mean(normalised)), 0.0, places=4)
+        self.assertAlmostEqual(float(np.std(normalised)), 1.0, places=4)
+        # Saving through the cached template leaves the normalised map and the template untouched
+        template = np.array(crystal_map.template.grid)
+        for chain in ['A', 'B']:
+            referenceSave(template_map_path=None, xmap=crystal_map.xmap,
+                          path_to_save=os.path.join(dir, f'test_{chain}.ccp4'),
+                          template_map=crystal_map.template)
+        self.assertTrue(filecmp.cmp(os.path.join(dir, 'test_A.ccp4'), os.path.join(dir, 'test_B.ccp4'),
+                                    shallow=False))
+        self.assertTrue(np.array_equal(np.array(crystal_map.template.grid), template, equal_nan=True))
+        saved = gemmi.read_ccp4_map(os.path.join(dir, 'test_A.ccp4'))
+        self.assertTrue(np.allclose(np.array(saved.grid), normalised))
+        # Maps that are not resampled are written from the normalised grid, whether or not it is the template's
+        crystal_map.write(os.path.join(dir, 'test_copy.ccp4'))
+        CrystalMap.from_file(Path(os.path.join(dir, 'test.ccp4')), in_place=True).write(
+            os.path.join(dir, 'test_in_place.ccp4'))
+        self.assertTrue(filecmp.cmp(os.path.join(dir, 'test_copy.ccp4'), os.path.join(dir, 'test_in_place.ccp4'),
+                                    shallow=False))
+        rmtree(dir)
+
+    def test_mapped_memory_budget(self):
+        """
+        tests that the stages of the resampling of a memory-mapped map larger than the budget hold at most the
+        budget, plus what grows with the reference model (its masked points) while the values are resampled
+        """
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_mapped_map')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        reference = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x0978.pdb')))
+        moving = Structure.from_file(Path(os.path.join(
+            'tests', 'data_for_tests', 'examples_to_test5', 'Mpro-x2119.pdb')))
+        moving, transform = moving.align_to(reference)
+        shape = (100, 100, 100)
+        ccp4 = gemmi.Ccp4Map()
+        ccp4.grid = gemmi.FloatGrid(*shape)
+        ccp4.grid.set_unit_cell(gemmi.UnitCell(200, 200, 200, 90, 90, 90))
+        ccp4.grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(ccp4.grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=shape)
+        ccp4.update_ccp4_header(2, True)
+        path = os.path.join(dir, 'test.ccp4')
+        ccp4.write_ccp4_map(path)
+        budget = 2 ** 20
+        full_cell = 4 * int(np.prod(shape))
+        self.assertGreater(os.path.getsize(path), budget)
+
+        def peak(function):
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                result = function()
+                return result, tracemalloc.get_traced_memory()[1] - start
+            finally:
+                tracemalloc.stop()
+
+        mapped, used = peak(lambda: MappedMap.from_file(
+            path, chunk_size=mapped_chunk_size(budget, stats_point_bytes)))
+        self.assertLess(used, budget)
+        cache = ReferenceGeometryCache()
+        geometry = cache.get_cell(mapped.unit_cell, np.array(shape), reference)
+        resampled, used = peak(lambda: resample_mapped(
+            [mapped], transform, reference, chunk_size=mapped_chunk_size(budget, resample_point_bytes),
+            geometry_cache=cache, write_chunk_size=mapped_chunk_size(budget, write_point_bytes))[0])
+        self.assertLess(used, budget + 128 * len(geometry.points))
+        self.assertLess(used, full_cell)
+        for encoding in ['int8', 'gzip', None]:
+            written, used = peak(lambda: resampled.write(mapped.words, os.path.join(dir, 'test_aligned.ccp4'),
+                                                         encoding=encoding))
+            self.assertLess(used, budget)
+        self.assertTrue(np.array_equal(np.array(gemmi.read_ccp4_map(written).grid), resampled[:, :, :]))
+        rmtree(dir)
+
     def test_g_conversion_pdb_mol(self):
         dir = os.path.join('tests', 'data_for_tests', 'conv')
         dir2 = os.path.join(dir, 'target')
@@ -166,6 +554,36 @@ class EasyAlign(AlignTest):
         """
         self.assertEqual(self.align_obj._get_ref, '6epv')
 
+    def test_get_ref_lazily(self):
+        """
+        Tests the reference is only chosen (reading the pdbs) when first needed, then kept
+        """
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_lazy_ref')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        cache_file = os.path.join(dir, 'reference_stats.json')
+        align_obj = Align(self.align_obj.directory, pdb_ref='', stats_cache=cache_file)
+        self.assertFalse(os.path.isfile(cache_file))
+        self.assertEqual(align_obj._get_ref, '6epv')
+        self.assertTrue(os.path.isfile(cache_file))
+        os.remove(cache_file)
+        self.assertEqual(align_obj._get_ref, '6epv')
+        self.assertFalse(os.path.isfile(cache_file))
+        rmtree(dir)
+
+    def test_pdb_stats(self):
+        self.assertEqual(scan_pdb_stats(os.path.join(self.align_obj.directory, '6epv.pdb')), (1.79, 130, '6epv'))
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_stats')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        cache_file = os.path.join(dir, 'reference_stats.json')
+        files = sorted(self.align_obj._get_files)
+        stats = pdb_stats(files, cache_file=cache_file)
+        self.assertTrue(os.path.isfile(cache_file))
+        self.assertEqual(pdb_stats(files, cache_file=cache_file), stats)
+        self.assertEqual(pdb_stats(files, jobs=2), stats)
+        rmtree(dir)
+
     def test_get_ref_when_input_ref(self):
         """
         Tests it correctly assigns the input ref as the reference pdb for alignments
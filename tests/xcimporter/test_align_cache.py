@@ -0,0 +1,54 @@
+import os
+import unittest
+from shutil import rmtree
+
+from fragalysis_api.xcimporter.align_cache import AlignmentCache
+
+
+class AlignCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = os.path.join('tests', 'data_for_tests', 'tmp_align_cache')
+        cls.in_dir = os.path.join(cls.dir, 'input')
+        cls.out_dir = os.path.join(cls.dir, 'output')
+        for d in [cls.in_dir, cls.out_dir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.dir)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_store_and_restore(self):
+        """
+        tests that stored files are restored for the same inputs and options only
+        """
+        pdb = self.write(os.path.join(self.in_dir, 'x1.pdb'), 'ATOM\n')
+        ref = self.write(os.path.join(self.in_dir, 'ref.pdb'), 'REF\n')
+        event = self.write(os.path.join(self.in_dir, 'x1_event.ccp4'), 'MAP\n')
+        cache = AlignmentCache(os.path.join(self.dir, 'cache'))
+
+        key = cache.key(pdb, [event], ref, rrf=False, sr=False, map_encoding=None)
+        self.assertIsNone(cache.restore(key, self.out_dir))
+        bound = self.write(os.path.join(self.out_dir, 'x1_bound.pdb'), 'ALIGNED\n')
+        cache.store(key, [bound])
+        os.remove(bound)
+
+        self.assertEqual(cache.restore(key, self.out_dir), [bound])
+        with open(bound) as f:
+            self.assertEqual(f.read(), 'ALIGNED\n')
+
+        self.assertNotEqual(key, cache.key(pdb, [event], ref, rrf=False, sr=True, map_encoding=None))
+        self.assertNotEqual(key, cache.key(pdb, [], ref, rrf=False, sr=False, map_encoding=None))
+        self.write(event, 'CHANGED\n')
+        self.assertNotEqual(key, cache.key(pdb, [event], ref, rrf=False, sr=False, map_encoding=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import os
 import unittest
 from fragalysis_api import set_up
+from fragalysis_api.xcimporter.conversion_pdb_mol import write_map_cutout
 from shutil import rmtree
 
+import gemmi
+import numpy as np
+
 
 class ConversionTest(unittest.TestCase):
 
@@ -92,5 +96,36 @@ class PDBexample1(ConversionTest):
         self.assertEqual(len(file), 44)
 
 
+class MapCutout(ConversionTest):
+
+    def test_write_map_cutout(self):
+        """
+        tests that the cutout holds the values of the full map around the positions, with the right origin
+        """
+        dir = os.path.join('tests', 'data_for_tests', 'tmp_cutout')
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        ccp4 = gemmi.Ccp4Map()
+        ccp4.grid = gemmi.FloatGrid(40, 48, 56)
+        ccp4.grid.set_unit_cell(gemmi.UnitCell(40, 48, 56, 90, 90, 90))
+        ccp4.grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(ccp4.grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=(40, 48, 56))
+        ccp4.update_ccp4_header(2, True)
+        ccp4.write_ccp4_map(os.path.join(dir, 'full.ccp4'))
+        full = gemmi.read_ccp4_map(os.path.join(dir, 'full.ccp4'))
+        full.setup()
+
+        write_map_cutout(ccp4=full, positions=np.array([[1.5, 10.0, 20.0], [6.0, 12.0, 22.0]]), margin=2.2,
+                         path=os.path.join(dir, 'cut.ccp4'))
+        cut = gemmi.read_ccp4_map(os.path.join(dir, 'cut.ccp4'))
+        start = [cut.header_i32(i) for i in (5, 6, 7)]
+        self.assertEqual(start, [0, 8, 18])
+        self.assertEqual([cut.header_i32(i) for i in (1, 2, 3)], [9, 7, 7])
+        self.assertEqual([cut.header_i32(i) for i in (8, 9, 10)], [40, 48, 56])
+        self.assertTrue(np.array_equal(np.array(cut.grid),
+                                       np.array(full.grid)[0:9, 8:15, 18:25]))
+        rmtree(dir)
+
+
 if __name__ == '__main__':
     unittest.main()
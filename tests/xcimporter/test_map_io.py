@@ -0,0 +1,98 @@
+import gzip
+import os
+import unittest
+from shutil import rmtree
+
+import gemmi
+import numpy as np
+
+from fragalysis_api.xcimporter.map_io import write_ccp4_map, read_ccp4_map, quantisation, write_map_box, \
+    ccp4_memmap, write_ccp4_data
+
+
+class MapEncodings(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = os.path.join('tests', 'data_for_tests', 'tmp_map_io')
+        if not os.path.isdir(cls.dir):
+            os.makedirs(cls.dir)
+        cls.ccp4 = gemmi.Ccp4Map()
+        cls.ccp4.grid = gemmi.FloatGrid(20, 24, 28)
+        cls.ccp4.grid.set_unit_cell(gemmi.UnitCell(20, 24, 28, 90, 90, 90))
+        cls.ccp4.grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        np.array(cls.ccp4.grid, copy=False)[:, :, :] = np.random.RandomState(0).normal(size=(20, 24, 28))
+        cls.ccp4.update_ccp4_header(2, True)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.dir)
+
+    def test_gzip(self):
+        """
+        tests that the gzip encoding holds the same bytes as the plain map, whether compressed by one or several threads
+        """
+        plain = write_ccp4_map(self.ccp4, os.path.join(self.dir, 'plain.ccp4'))
+        with open(plain, 'rb') as f:
+            expected = f.read()
+        for jobs in (1, 3):
+            path = write_ccp4_map(self.ccp4, os.path.join(self.dir, f'gzip{jobs}.ccp4'), encoding='gzip', jobs=jobs,
+                                  chunk_size=4096)
+            self.assertEqual(path, os.path.join(self.dir, f'gzip{jobs}.ccp4.gz'))
+            with gzip.open(path, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+            self.assertTrue(np.array_equal(np.array(read_ccp4_map(path).grid), np.array(self.ccp4.grid)))
+
+    def test_quantised(self):
+        """
+        tests that the quantised encodings are read back within half a quantisation step
+        """
+        for encoding, mode in (('int16', 1), ('int8', 0)):
+            path = write_ccp4_map(self.ccp4, os.path.join(self.dir, f'{encoding}.ccp4'), encoding=encoding)
+            raw = gemmi.read_ccp4_map(path)
+            self.assertEqual(raw.header_i32(4), mode)
+            scale, offset = quantisation(raw)
+            decoded = read_ccp4_map(path)
+            self.assertEqual(decoded.header_i32(4), 2)
+            error = np.abs(np.array(decoded.grid) - np.array(self.ccp4.grid))
+            self.assertLessEqual(np.max(error), scale / 2 + 1e-6)
+        self.assertIsNone(quantisation(self.ccp4))
+
+    def test_map_box(self):
+        """
+        tests that a box written as P1 holds the values of the full map from its start, wrapping around the cell
+        """
+        grid = self.ccp4.grid
+        grid.spacegroup = gemmi.find_spacegroup_by_name('P 1 21 1')
+        path = write_map_box(grid, [-3.5, 2.5, 4.5], [6.5, 30.5, 9.5], os.path.join(self.dir, 'box.ccp4'), p1=True)
+        grid.spacegroup = gemmi.find_spacegroup_by_name('P 1')
+        box = gemmi.read_ccp4_map(path)
+        self.assertEqual(box.header_i32(23), 1)
+        start = [box.header_i32(w) for w in (5, 6, 7)]
+        size = [box.header_i32(w) for w in (1, 2, 3)]
+        self.assertEqual([box.header_i32(w) for w in (8, 9, 10)], [20, 24, 28])
+        self.assertLess(start[0], 0)
+        self.assertGreater(size[1], 24)
+        index = np.ix_(*[np.arange(s, s + n) % m for s, n, m in zip(start, size, (20, 24, 28))])
+        self.assertTrue(np.array_equal(np.array(box.grid, copy=False), np.array(grid)[index]))
+
+    def test_memmap(self):
+        """
+        tests that a memory-mapped map holds the data of the map and is written back to the same bytes, and that maps
+        which cannot be indexed as the full cell are not mapped
+        """
+        plain = write_ccp4_map(self.ccp4, os.path.join(self.dir, 'memmap.ccp4'))
+        words, data = ccp4_memmap(plain)
+        self.assertEqual(data.shape, (20, 24, 28))
+        self.assertTrue(np.array_equal(data, np.array(self.ccp4.grid)))
+        copy = write_ccp4_data(words, data, os.path.join(self.dir, 'memmap_copy.ccp4'), chunk_size=4096)
+        with open(plain, 'rb') as f, open(copy, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertIsNone(ccp4_memmap(write_ccp4_map(self.ccp4, os.path.join(self.dir, 'memmap.ccp4'),
+                                                     encoding='gzip')))
+        box = write_map_box(self.ccp4.grid, [1, 1, 1], [5, 5, 5], os.path.join(self.dir, 'memmap_box.ccp4'))
+        self.assertIsNone(ccp4_memmap(box))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import os
+from shutil import rmtree
 from fragalysis_api import xcimporter
 
 from fragalysis_api.xcimporter.single_import import import_single_file
@@ -49,6 +50,8 @@ class XcImporterTest(unittest.TestCase):
             os.path.join(self.out_dir, self.target)))
         self.assertTrue(expr=os.path.exists(os.path.join(
             self.out_dir, self.target, 'reference.pdb')))
+        # The reference stats are only cached with an align_cache, nothing is left in out_dir
+        self.assertFalse(os.path.isfile(os.path.join(self.out_dir, 'reference_stats.json')))
 
         import_single_file(in_file=self.in_file,
                            out_dir=self.out_dir,
@@ -65,6 +68,69 @@ class XcImporterTest(unittest.TestCase):
         self.assertTrue(expr=os.path.exists(os.path.join(
             self.out_dir, self.target, 'reference.pdb')))
 
+    def test_xcimporter_in_memory(self):
+        """
+        tests that handing the aligned crystals straight to the ligand splitting gives the same files as going through
+        the tmp folder
+        """
+        trees = []
+        for in_memory in [False, True]:
+            out_dir = os.path.join(self.out_dir, f'tmp_in_memory_{in_memory}')
+            xcimporter(
+                in_dir=self.in_dir,
+                out_dir=out_dir,
+                target=self.target,
+                reduce_reference_frame=self.rrf,
+                pdb_ref=self.reference,
+                map_margin=4.0,
+                in_memory=in_memory
+            )
+            self.assertFalse(os.path.exists(os.path.join(out_dir, f'tmp{self.target}')))
+            trees.append(aligned_tree(out_dir, self.target))
+            rmtree(out_dir)
+        self.assertGreater(len(trees[0]), 0)
+        self.assertEqual(trees[0], trees[1])
+        # In memory the crystals are aligned in a single process, without the alignment cache
+        with self.assertRaises(ValueError):
+            xcimporter(in_dir=self.in_dir, out_dir=self.out_dir, target=self.target, in_memory=True, jobs=2)
+
+    def test_xcimporter_replay_transforms(self):
+        """
+        tests that a target imported again by replaying the transforms kept in the output of a first import gives the
+        same files, with the reference of the first import
+        """
+        first_dir = os.path.join(self.out_dir, 'tmp_replay_first')
+        xcimporter(in_dir=self.in_dir, out_dir=first_dir, target=self.target, reduce_reference_frame=self.rrf,
+                   pdb_ref=self.reference)
+        first = os.path.join(first_dir, self.target)
+        self.assertIn('Mpro-x2097_A_transform.json', os.listdir(os.path.join(first, 'transforms')))
+        expected = aligned_tree(first_dir, self.target)
+        self.assertGreater(len(expected), 0)
+        for in_memory in [False, True]:
+            out_dir = os.path.join(self.out_dir, f'tmp_replay_{in_memory}')
+            xcimporter(in_dir=self.in_dir, out_dir=out_dir, target=self.target, reduce_reference_frame=self.rrf,
+                       replay_transforms=first, in_memory=in_memory)
+            self.assertEqual(aligned_tree(out_dir, self.target), expected)
+            with open(os.path.join(first, 'reference.pdb')) as a, \
+                    open(os.path.join(out_dir, self.target, 'reference.pdb')) as b:
+                self.assertEqual(a.read(), b.read())
+            rmtree(out_dir)
+        rmtree(first_dir)
+
+
+def aligned_tree(out_dir, target):
+    """
+    :return: Dict of the filepaths (relative to out_dir) of the aligned folder of an imported target to their content,
+        except the pngs (drawn, not copied).
+    """
+    tree = {}
+    for root, _, files in os.walk(os.path.join(out_dir, target, 'aligned')):
+        for f in files:
+            if not f.endswith('.png'):
+                with open(os.path.join(root, f), 'rb') as handle:
+                    tree[os.path.relpath(os.path.join(root, f), out_dir)] = handle.read()
+    return tree
+
 
 if __name__ == '__main__':
     unittest.main()